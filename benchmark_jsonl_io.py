@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+JSONL読み書きのベンチマーク
+
+従来の読み書き（テキストモードで1行ずつ strip → json.loads、
+1行ずつ json.dumps → write）と jsonl_io を比較します。
+orjson がインストールされていれば、標準jsonとorjsonの両方で測ります。
+どの方式でも読み込み結果・書き出したバイト列が同じであることも確認します。
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import jsonl_io
+
+DEFAULT_FILE = 'wisbee_character_improved/wisbee_improved_all.jsonl'
+
+
+def legacy_load(file_path):
+    """従来の load_jsonl_file と同じ読み込み"""
+    data = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    data.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+    return data
+
+
+def legacy_write(file_path, samples):
+    """従来の1行ずつの書き出し"""
+    with open(file_path, 'w', encoding='utf-8', newline='\n') as f:
+        for sample in samples:
+            f.write(json.dumps(sample, ensure_ascii=False) + '\n')
+
+
+def jsonl_io_write(file_path, samples):
+    with jsonl_io.JsonlWriter(file_path) as writer:
+        for sample in samples:
+            writer.write(sample)
+
+
+def best_time(func, repeat):
+    """最速の実行時間と結果（timeit と同様に計測中はGCを止める）"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best, result
+
+
+def fingerprint(samples):
+    """読み込み結果の比較用ダイジェスト（結果を保持したまま次の方式を測らないため）"""
+    digest = hashlib.sha256()
+    for sample in samples:
+        digest.update(repr(sample).encode('utf-8'))
+    return len(samples), digest.hexdigest()
+
+
+def report(label, seconds, baseline, size):
+    print(f"   {label:<22} {seconds * 1000:8.1f} ms  {size / seconds / 1e6:7.1f} MB/s  ({baseline / seconds:.2f}倍)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL読み書きのベンチマーク")
+    parser.add_argument('--file', default=DEFAULT_FILE, help="計測に使うJSONLファイル")
+    parser.add_argument('--repeat', type=int, default=5, help="各方式の繰り返し回数（最速値を採用）")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print(f"ファイルが見つかりません: {args.file}")
+        sys.exit(1)
+    size = os.path.getsize(args.file)
+
+    fast_backend = jsonl_io.orjson
+    backends = [('json', None)] + ([('orjson', fast_backend)] if fast_backend is not None else [])
+
+    print(f"📄 {args.file} ({size:,} bytes)")
+    print(f"   orjson: {'あり' if fast_backend is not None else 'なし（標準jsonのみ計測）'}")
+
+    # 読み込み
+    print("\n📖 読み込み")
+    baseline, samples = best_time(lambda: legacy_load(args.file), args.repeat)
+    expected = fingerprint(samples)
+    del samples
+    report('従来', baseline, baseline, size)
+    mismatches = 0
+    for name, module in backends:
+        jsonl_io.orjson = module
+        seconds, samples = best_time(lambda: jsonl_io.load_jsonl_file(args.file), args.repeat)
+        report(f'jsonl_io ({name})', seconds, baseline, size)
+        if fingerprint(samples) != expected:
+            print(f"   ❌ jsonl_io ({name}) の読み込み結果が従来と一致しません")
+            mismatches += 1
+        del samples
+    jsonl_io.orjson = fast_backend
+    print(f"   {expected[0]:,}サンプル")
+
+    # 書き込み
+    print("\n📝 書き込み")
+    samples = legacy_load(args.file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_path = os.path.join(tmp_dir, 'legacy.jsonl')
+        new_path = os.path.join(tmp_dir, 'jsonl_io.jsonl')
+        baseline, _ = best_time(lambda: legacy_write(legacy_path, samples), args.repeat)
+        report('従来', baseline, baseline, size)
+        seconds, _ = best_time(lambda: jsonl_io_write(new_path, samples), args.repeat)
+        report('jsonl_io', seconds, baseline, size)
+        with open(legacy_path, 'rb') as a, open(new_path, 'rb') as b:
+            if a.read() != b.read():
+                print("   ❌ 書き出したバイト列が従来と一致しません")
+                mismatches += 1
+
+    if mismatches:
+        sys.exit(1)
+    print("\n✅ 読み込み結果・書き出し内容とも従来と一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+カテゴリ別データのカラム形式シャード
+
+JSONLシャードでは同じペルソナ文（instruction）が全行に繰り返し現れます。
+この形式では1シャードを列ごとにまとめ、シャード単位で圧縮します。
+
+- instruction: シャード内の辞書 + 行ごとの辞書番号（u32）
+- input / output: 長さ（u32）の列 + UTF-8文字列を連結した列
+- 上記3キー（この順、値はすべて文字列）以外のサンプル: JSONのまま長さ付きで保存
+
+各行が上のどちらに入ったかを種別列に持つので、読み出し時は元の順序・
+キー順のまま load_jsonl_file と同じ辞書を返します。
+
+ファイル形式（リトルエンディアン）:
+  ヘッダ   magic "WCOL", version u16, 圧縮方式 u8, 予約 u8, 展開後サイズ u64, CRC32 u32, 行数 u32
+           （version 1 には行数がない。件数だけなら展開せずにヘッダから読める）
+  本体     以下を圧縮したもの
+           辞書件数 u32, (長さ u32 + 文字列) × 辞書件数
+           行数 u32, 種別 u8 × 行数
+           instruction番号 u32 × n, input長 u32 × n, output長 u32 × n, input列, output列
+           JSON長 u32 × m, JSON列
+"""
+
+import argparse
+import lzma
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Sequence
+
+from jsonl_io import dumps, iter_jsonl, loads
+
+MAGIC = b'WCOL'
+VERSION = 2
+HEADERS = {
+    1: struct.Struct('<4sHBBQI'),
+    2: struct.Struct('<4sHBBQII'),
+}
+HEADER = HEADERS[VERSION]
+PREFIX = struct.Struct('<4sH')
+COUNT = struct.Struct('<I')
+COLUMNAR_SUFFIX = '.wcol'
+COLUMNS = ('instruction', 'input', 'output')
+
+ROW_COLUMNAR = 0
+ROW_JSON = 1
+
+CODECS = {
+    'none': (0, lambda data: data, lambda data: data),
+    'zlib': (1, lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (2, lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+
+def _is_columnar(sample: Dict[str, Any]) -> bool:
+    """instruction / input / output の3キーだけを（この順で）持ち、値がすべて文字列か"""
+    return tuple(sample) == COLUMNS and all(isinstance(sample[key], str) for key in COLUMNS)
+
+
+def _u32_array(values: Sequence[int]) -> bytes:
+    return struct.pack(f'<{len(values)}I', *values)
+
+
+def _read_u32_array(buffer: memoryview, offset: int, count: int):
+    return struct.unpack_from(f'<{count}I', buffer, offset), offset + 4 * count
+
+
+def encode_shard(samples: Sequence[Dict[str, Any]]) -> bytes:
+    """サンプル列を圧縮前の本体バイト列に変換"""
+    dictionary: Dict[str, int] = {}
+    kinds = bytearray()
+    instruction_ids: List[int] = []
+    inputs: List[bytes] = []
+    outputs: List[bytes] = []
+    raw_rows: List[bytes] = []
+
+    for sample in samples:
+        if _is_columnar(sample):
+            kinds.append(ROW_COLUMNAR)
+            instruction_ids.append(dictionary.setdefault(sample['instruction'], len(dictionary)))
+            inputs.append(sample['input'].encode('utf-8'))
+            outputs.append(sample['output'].encode('utf-8'))
+        else:
+            kinds.append(ROW_JSON)
+            raw_rows.append(dumps(sample).encode('utf-8'))
+
+    parts = [COUNT.pack(len(dictionary))]
+    for instruction in dictionary:
+        encoded = instruction.encode('utf-8')
+        parts.append(COUNT.pack(len(encoded)))
+        parts.append(encoded)
+
+    parts.append(COUNT.pack(len(kinds)))
+    parts.append(bytes(kinds))
+    parts.append(_u32_array(instruction_ids))
+    parts.append(_u32_array([len(value) for value in inputs]))
+    parts.append(_u32_array([len(value) for value in outputs]))
+    parts.extend(inputs)
+    parts.extend(outputs)
+    parts.append(_u32_array([len(row) for row in raw_rows]))
+    parts.extend(raw_rows)
+    return b''.join(parts)
+
+
+def decode_shard(payload: bytes) -> Iterator[Dict[str, Any]]:
+    """本体バイト列からサンプルを元の順序で復元"""
+    buffer = memoryview(payload)
+    offset = 0
+
+    (dict_size,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    dictionary = []
+    for _ in range(dict_size):
+        (length,) = COUNT.unpack_from(buffer, offset)
+        offset += COUNT.size
+        dictionary.append(str(buffer[offset:offset + length], 'utf-8'))
+        offset += length
+
+    (row_count,) = COUNT.unpack_from(buffer, offset)
+    offset += COUNT.size
+    kinds = buffer[offset:offset + row_count]
+    offset += row_count
+    columnar_count = row_count - sum(kinds)
+
+    instruction_ids, offset = _read_u32_array(buffer, offset, columnar_count)
+    input_lengths, offset = _read_u32_array(buffer, offset, columnar_count)
+    output_lengths, offset = _read_u32_array(buffer, offset, columnar_count)
+    input_offset = offset
+    output_offset = input_offset + sum(input_lengths)
+    offset = output_offset + sum(output_lengths)
+    raw_lengths, raw_offset = _read_u32_array(buffer, offset, row_count - columnar_count)
+
+    columnar_index = raw_index = 0
+    for kind in kinds:
+        if kind == ROW_COLUMNAR:
+            input_end = input_offset + input_lengths[columnar_index]
+            output_end = output_offset + output_lengths[columnar_index]
+            yield {
+                'instruction': dictionary[instruction_ids[columnar_index]],
+                'input': str(buffer[input_offset:input_end], 'utf-8'),
+                'output': str(buffer[output_offset:output_end], 'utf-8'),
+            }
+            input_offset, output_offset = input_end, output_end
+            columnar_index += 1
+        else:
+            raw_end = raw_offset + raw_lengths[raw_index]
+            yield loads(bytes(buffer[raw_offset:raw_end]))
+            raw_offset = raw_end
+            raw_index += 1
+
+
+def write_columnar_file(file_path: str, samples: Sequence[Dict[str, Any]], codec: str = 'zlib') -> int:
+    """サンプル列をカラム形式で書き出し、書き込んだバイト数を返す"""
+    codec_id, compress, _ = CODECS[codec]
+    payload = encode_shard(samples)
+    body = compress(payload)
+    tmp_path = str(file_path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, codec_id, 0, len(payload), zlib.crc32(payload), len(samples)))
+        f.write(body)
+    os.replace(tmp_path, file_path)
+    return HEADER.size + len(body)
+
+
+def _unpack_header(data: bytes, file_path: str):
+    """ヘッダを読み、(圧縮方式, 展開後サイズ, CRC32, 行数, ヘッダの長さ) を返す（version 1 の行数はNone）"""
+    header = HEADERS.get(PREFIX.unpack_from(data, 0)[1]) if len(data) >= PREFIX.size else None
+    if header is None or len(data) < header.size:
+        raise ValueError(f"カラム形式ファイルではありません: {file_path}")
+    magic, _, codec_id, _, size, crc, *rows = header.unpack_from(data, 0)
+    if magic != MAGIC or codec_id not in CODEC_NAMES:
+        raise ValueError(f"カラム形式ファイルではありません: {file_path}")
+    return codec_id, size, crc, rows[0] if rows else None, header.size
+
+
+def columnar_row_count(file_path: str) -> int:
+    """カラム形式シャードの行数（ヘッダだけを読み、本体は展開しない）"""
+    with open(file_path, 'rb') as f:
+        data = f.read(HEADER.size)
+    rows = _unpack_header(data, file_path)[3]
+    if rows is None:
+        # version 1 のシャードはヘッダに行数がないので展開して数える
+        return len(load_columnar_file(file_path))
+    return rows
+
+
+def iter_columnar_file(file_path: str) -> Iterator[Dict[str, Any]]:
+    """カラム形式シャードのサンプルを順に返す"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    codec_id, size, crc, _, header_size = _unpack_header(data, file_path)
+    payload = CODECS[CODEC_NAMES[codec_id]][2](data[header_size:])
+    if len(payload) != size or zlib.crc32(payload) != crc:
+        raise ValueError(f"カラム形式ファイルが破損しています: {file_path}")
+    return decode_shard(payload)
+
+
+def load_columnar_file(file_path: str) -> List[Dict[str, Any]]:
+    """カラム形式シャードを読み込み（load_jsonl_file と同じ辞書のリストを返す）"""
+    return list(iter_columnar_file(file_path))
+
+
+def _raise_decode_error(file_path):
+    def on_error(line_num, e):
+        raise ValueError(f"JSONデコードエラー {file_path}:{line_num}: {e}")
+    return on_error
+
+
+def pack_directory(data_dir: str, codec: str = 'zlib', verify: bool = True) -> Dict[str, int]:
+    """ディレクトリ以下のJSONLシャードを同じ名前の .wcol に変換"""
+    stats = {'files': 0, 'samples': 0, 'jsonl_bytes': 0, 'columnar_bytes': 0}
+    for jsonl_path in sorted(Path(data_dir).rglob('*.jsonl')):
+        samples = list(iter_jsonl(str(jsonl_path), on_error=_raise_decode_error(jsonl_path)))
+        columnar_path = jsonl_path.with_suffix(COLUMNAR_SUFFIX)
+        stats['columnar_bytes'] += write_columnar_file(str(columnar_path), samples, codec)
+        if verify and load_columnar_file(str(columnar_path)) != samples:
+            raise ValueError(f"変換結果が一致しません: {jsonl_path}")
+        stats['files'] += 1
+        stats['samples'] += len(samples)
+        stats['jsonl_bytes'] += jsonl_path.stat().st_size
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONLシャードをカラム形式に変換")
+    parser.add_argument('data_dir', nargs='?', default='detailed_categorized_wisbee_data')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='zlib', help="シャードごとの圧縮方式")
+    args = parser.parse_args()
+
+    stats = pack_directory(args.data_dir, args.codec)
+    ratio = stats['columnar_bytes'] / stats['jsonl_bytes'] if stats['jsonl_bytes'] else 0
+    print(f"✅ {stats['files']}ファイル / {stats['samples']:,}サンプルを変換")
+    print(f"   JSONL: {stats['jsonl_bytes']:,} bytes → カラム形式: {stats['columnar_bytes']:,} bytes ({ratio:.1%})")
+
+
+if __name__ == "__main__":
+    main()
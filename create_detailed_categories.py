@@ -6,16 +6,39 @@ Wisbee詳細カテゴリ分類システム
 各カテゴリごとに適切な量のサンプルを振り分けます。
 """
 
+import argparse
 import json
 import os
 import re
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import hashlib
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+
+from keyword_matcher import KeywordMatcher
+from near_dedupe import NearDuplicateDetector, sample_text
+from dedupe_index import DedupeIndex
+from jsonl_index import index_is_current, index_path_for, rows_from_lines, write_index
+from columnar_store import CODECS, COLUMNAR_SUFFIX, columnar_row_count, load_columnar_file, write_columnar_file
+from jsonl_io import READ_BLOCK_SIZE, dumps, dumps_lines, iter_lines, line_number_at, load_jsonl_file, parse_line
+from shard_packer import load_shard_manifest, measure, shard_entry, shard_ranges, write_shard_manifest
+from embedding_classifier import DEFAULT_THRESHOLD as EMBEDDING_THRESHOLD, EmbeddingClassifier, numpy_available
+
+MANIFEST_FILE = 'manifest.json'
+SHARD_SUFFIXES = {'jsonl': '.jsonl', 'columnar': COLUMNAR_SUFFIX}
 
 class DetailedCategoryClassifier:
     def __init__(self):
         self.category_definitions = self._define_categories()
+        
+        # 全カテゴリのキーワードから一致判定用オートマトンを構築
+        # （同じキーワードが複数回定義されていれば、その回数分加点する）
+        self.keyword_categories = defaultdict(list)
+        for category, definition in self.category_definitions.items():
+            for keyword in definition['keywords']:
+                self.keyword_categories[keyword].append(category)
+        self.matcher = KeywordMatcher(self.keyword_categories)
     
     def _define_categories(self) -> Dict[str, Dict]:
         """詳細カテゴリの定義"""
@@ -306,19 +329,19 @@ class DetailedCategoryClassifier:
         text = self._extract_text_from_sample(sample)
         text_lower = text.lower()
         
-        # 各カテゴリとのマッチング度を計算
+        # テキストを1回走査して含まれるキーワードを検出
+        keyword_hits = defaultdict(int)
+        for keyword in self.matcher.find_all(text_lower):
+            for category in self.keyword_categories[keyword]:
+                keyword_hits[category] += 1
+        
+        # 各カテゴリとのマッチング度を計算（同点時は定義順を優先）
         category_scores = {}
         
         for category, definition in self.category_definitions.items():
-            score = 0
-            keywords = definition['keywords']
+            score = keyword_hits.get(category, 0)
             priority = definition['priority']
             
-            # キーワードマッチング
-            for keyword in keywords:
-                if keyword in text_lower:
-                    score += 1
-            
             # 優先度による重み付け（優先度が低いほど重要）
             if score > 0:
                 weight = 5 - priority  # priority 0->5, 1->4, 2->3, 3->2, 4->1
@@ -349,33 +372,295 @@ class DetailedCategoryClassifier:
         
         return text
 
-def load_jsonl_file(file_path: str) -> List[Dict[str, Any]]:
-    """JSONLファイルを読み込み"""
-    if not os.path.exists(file_path):
-        print(f"ファイルが見つかりません: {file_path}")
+def sample_hash(sample: Dict[str, Any]) -> str:
+    """重複判定用のサンプルハッシュ"""
+    content = dumps(sample, sort_keys=True)
+    return hashlib.md5(content.encode()).hexdigest()
+
+def split_byte_ranges(file_paths: List[str], num_ranges: int) -> List[Tuple[str, int, int]]:
+    """JSONLファイル群をほぼ同じバイト数の範囲に分割"""
+    sizes = [(path, os.path.getsize(path)) for path in file_paths if os.path.exists(path)]
+    total = sum(size for _, size in sizes)
+    target = max(total // max(num_ranges, 1), 1)
+    
+    ranges = []
+    for path, size in sizes:
+        for start in range(0, size, target):
+            ranges.append((path, start, min(start + target, size)))
+    return ranges
+
+_worker_classifier = None
+
+def _init_worker():
+    global _worker_classifier
+    _worker_classifier = DetailedCategoryClassifier()
+
+def classify_byte_range(byte_range: Tuple[str, int, int]) -> Dict[str, Any]:
+    """
+    バイト範囲内の行を読み込み、ハッシュとカテゴリを計算（ワーカープロセス用）
+    
+    範囲の開始位置から始まる行を担当し、途中から始まる行は前の範囲に任せる。
+    """
+    file_path, start, end = byte_range
+    started = time.time()
+    results = []
+    
+    # 範囲の大きさに合わせて読み込みブロックを小さくし、範囲外の読みすぎを防ぐ
+    block_size = min(READ_BLOCK_SIZE, max(end - start + 1, 64 * 1024))
+    for _, offset, line in iter_lines(file_path, start, end, block_size=block_size):
+        try:
+            sample = parse_line(line)
+        except ValueError as e:
+            # 範囲の途中から読んでいるので、行番号はファイル先頭から数え直す
+            print(f"JSONデコードエラー {file_path}:{line_number_at(file_path, offset)}（オフセット {offset}）: {e}")
+            continue
+        if sample is not None:
+            results.append((sample_hash(sample), _worker_classifier.classify_sample(sample), sample))
+    
+    return {
+        'results': results,
+        'worker': os.getpid(),
+        'seconds': time.time() - started
+    }
+
+def classify_parallel(input_files: List[str], workers: int):
+    """
+    複数プロセスでバイト範囲ごとに分類し、シリアル実行と同じ順序でマージ
+    
+    範囲の結果はファイル順・オフセット順に受け取るため、重複除去で
+    残るサンプルとカテゴリ内の並びはシリアル実行と一致する。
+    """
+    ranges = split_byte_ranges(input_files, workers * 4)
+    categorized_data = defaultdict(list)
+    seen_hashes = set()
+    total = 0
+    worker_stats = defaultdict(lambda: {'samples': 0, 'seconds': 0.0})
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        for chunk in pool.map(classify_byte_range, ranges):
+            stats = worker_stats[chunk['worker']]
+            stats['samples'] += len(chunk['results'])
+            stats['seconds'] += chunk['seconds']
+            
+            for content_hash, category, sample in chunk['results']:
+                total += 1
+                if content_hash not in seen_hashes:
+                    seen_hashes.add(content_hash)
+                    categorized_data[category].append(sample)
+    
+    print(f"\n⚙️ ワーカー別スループット（{len(ranges)}範囲）:")
+    for worker, stats in sorted(worker_stats.items()):
+        rate = stats['samples'] / stats['seconds'] if stats['seconds'] else 0
+        print(f"   PID {worker}: {stats['samples']}サンプル / {stats['seconds']:.2f}秒 ({rate:,.0f}サンプル/秒)")
+    
+    return categorized_data, total
+
+def remove_near_duplicates(categorized_data: Dict[str, List], threshold: float):
+    """カテゴリ別データからニア重複を除去し、(除去後のデータ, 検出器) を返す
+
+    ニア重複の組のどちらを残すかがカテゴリや入力の並び順に左右されないよう、
+    サンプルは内容ハッシュの順に検出器へ登録する（組のうち内容ハッシュの小さい方が残る）。
+    各カテゴリ内のサンプルの並びは元のまま。
+    """
+    detector = NearDuplicateDetector(threshold=threshold)
+    order = sorted((sample_hash(sample), category, position)
+                   for category, samples in categorized_data.items()
+                   for position, sample in enumerate(samples))
+    kept = set()
+    for _, category, position in order:
+        rep_index, _ = detector.add(sample_text(categorized_data[category][position]))
+        if rep_index is None:
+            kept.add((category, position))
+
+    filtered = defaultdict(list)
+    for category, samples in categorized_data.items():
+        for position, sample in enumerate(samples):
+            if (category, position) in kept:
+                filtered[category].append(sample)
+
+    return filtered, detector
+
+def reclassify_with_embeddings(classifier: DetailedCategoryClassifier, categorized_data: Dict[str, List],
+                               threshold: float, cache_dir: str):
+    """general_other のサンプルを埋め込みの類似度で振り分け直し、(振り分け後のデータ, 統計) を返す"""
+    embedder = EmbeddingClassifier(classifier.category_definitions, threshold=threshold, cache_dir=cache_dir)
+    hashes = {category: [sample_hash(sample) for sample in samples]
+              for category, samples in categorized_data.items()}
+    reclassified, stats = embedder.reclassify(categorized_data, hashes)
+    stats['cache_hits'] = embedder.cache_hits
+    return defaultdict(list, reclassified), stats
+
+def classifier_definition_hash(classifier: DetailedCategoryClassifier) -> str:
+    """カテゴリ定義のハッシュ（定義順も分類結果に影響するため順序込みで計算）"""
+    content = json.dumps(classifier.category_definitions, ensure_ascii=False)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def file_fingerprint(file_path: str, previous: Dict[str, Any] = None) -> Dict[str, Any]:
+    """入力ファイルの指紋（サイズ・更新時刻が前回と同じなら内容のハッシュは再計算しない）"""
+    stat = os.stat(file_path)
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+
+def load_manifest(output_dir: str) -> Dict[str, Any]:
+    """前回実行時のマニフェストを読み込み（無ければ空）"""
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest: Dict[str, Any], output_dir: str):
+    """マニフェストを書き出し（途中で落ちても壊れないよう置き換えで保存）"""
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_file, manifest_file)
+
+def manifest_is_current(manifest: Dict[str, Any], classifier_hash: str, input_files: List[str],
+                        options: Dict[str, Any]) -> bool:
+    """分類器・オプション・全入力ファイルが前回と同じならTrue"""
+    if not manifest or manifest.get('classifier_hash') != classifier_hash or manifest.get('options') != options:
+        return False
+    
+    existing = [path for path in input_files if os.path.exists(path)]
+    previous_files = manifest.get('files', {})
+    if sorted(existing) != sorted(previous_files):
+        return False
+    
+    for file_path in existing:
+        previous = previous_files[file_path]['fingerprint']
+        if file_fingerprint(file_path, previous)['sha256'] != previous['sha256']:
+            return False
+    return True
+
+def shard_path(output_dir: str, category: str, file_num: int, storage_format: str = 'jsonl') -> str:
+    """シャードファイルのパス"""
+    return os.path.join(output_dir, category, f"{category}_{file_num:03d}{SHARD_SUFFIXES[storage_format]}")
+
+def _shard_complete(filepath: str, storage_format: str) -> bool:
+    """シャード（JSONLなら今のデータに対する索引ファイルも）が揃っていればTrue"""
+    return os.path.exists(filepath) and (storage_format != 'jsonl' or index_is_current(filepath))
+
+def _remove_shard(filepath: str):
+    """シャードとその索引ファイルを削除"""
+    if os.path.exists(filepath):
+        os.remove(filepath)
+        print(f"削除: {filepath}")
+    if os.path.exists(index_path_for(filepath)):
+        os.remove(index_path_for(filepath))
+
+def _shard_numbers(output_dir: str, category: str) -> List[int]:
+    """カテゴリのディレクトリにあるシャードの番号（形式を問わない）"""
+    category_dir = os.path.join(output_dir, category)
+    if not os.path.isdir(category_dir):
+        return []
+    pattern = re.compile(rf"^{re.escape(category)}_(\d+)(?:{'|'.join(map(re.escape, SHARD_SUFFIXES.values()))})$")
+    return sorted({int(match.group(1)) for match in map(pattern.match, os.listdir(category_dir)) if match})
+
+def _partial_last_shard(output_dir: str, category: str, file_num: int, storage_format: str,
+                        samples_per_file: int, shard_budget: int = None, budget_unit: str = 'bytes') -> List[Dict]:
+    """番号file_numのシャードが埋まっていなければその内容を返す（埋まっていれば空のリスト）"""
+    filepath = shard_path(output_dir, category, file_num, storage_format)
+    if not file_num or not os.path.exists(filepath):
         return []
+    if storage_format == 'columnar' and shard_budget is None and columnar_row_count(filepath) >= samples_per_file:
+        # 件数はヘッダから分かるので、埋まっていれば展開しない
+        return []
+    samples = load_columnar_file(filepath) if storage_format == 'columnar' else load_jsonl_file(filepath)
+    if shard_budget is None:
+        full = len(samples) >= samples_per_file
+    else:
+        full = sum(measure(line, budget_unit) for line in dumps_lines(samples)) >= shard_budget
+    return [] if full else samples
+
+def shards_present(manifest: Dict[str, Any], output_dir: str, storage_format: str = 'jsonl') -> bool:
+    """マニフェストに記録された全シャードが指定の形式で揃っていればTrue"""
+    for category, hashes in manifest.get('shards', {}).items():
+        for file_num in range(1, len(hashes) + 1):
+            if not _shard_complete(shard_path(output_dir, category, file_num, storage_format), storage_format):
+                return False
+    return True
+
+def classify_incremental(classifier: DetailedCategoryClassifier, input_files: List[str], manifest: Dict[str, Any],
+                         classifier_hash: str):
+    """変更のあった入力ファイルだけを分類し直し、他はマニフェストの割り当てを再利用
+    
+    (カテゴリ別データ, 総サンプル数, ファイルごとのマニフェスト, 再分類したファイル) を返す。
+    """
+    previous_files = manifest.get('files', {}) if manifest.get('classifier_hash') == classifier_hash else {}
+    
+    categorized_data = defaultdict(list)
+    seen_hashes = set()
+    category_by_hash = {}
+    file_entries = {}
+    reclassified = []
+    total_samples = 0
     
-    data = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if line:
-                    try:
-                        item = json.loads(line)
-                        data.append(item)
-                    except json.JSONDecodeError as e:
-                        print(f"JSONデコードエラー {file_path}:{line_num}: {e}")
-    except Exception as e:
-        print(f"ファイル読み込みエラー {file_path}: {e}")
-    
-    return data
-
-def save_categorized_data(categorized_data: Dict[str, List], output_dir: str, samples_per_file: int = 100):
-    """カテゴリ別データをファイルに保存"""
+    for file_path in input_files:
+        if not os.path.exists(file_path):
+            continue
+        
+        previous = previous_files.get(file_path)
+        fingerprint = file_fingerprint(file_path, previous['fingerprint'] if previous else None)
+        print(f"📁 読み込み中: {file_path}")
+        data = load_jsonl_file(file_path)
+        total_samples += len(data)
+        
+        hashes = [sample_hash(sample) for sample in data]
+        if (previous and previous['fingerprint']['sha256'] == fingerprint['sha256']
+                and len(previous['assignments']) == len(data)):
+            names = previous['categories']
+            categories = [names[i] for i in previous['assignments']]
+            print(f"   {len(data)}サンプル（変更なし・前回の分類を再利用）")
+        else:
+            # 同じ内容のサンプルは同じカテゴリになるため、初出のものだけ分類
+            categories = []
+            for sample, content_hash in zip(data, hashes):
+                if content_hash not in category_by_hash:
+                    category_by_hash[content_hash] = classifier.classify_sample(sample)
+                categories.append(category_by_hash[content_hash])
+            reclassified.append(file_path)
+            print(f"   {len(data)}サンプル（再分類）")
+        
+        names = list(dict.fromkeys(categories))
+        lookup = {name: i for i, name in enumerate(names)}
+        file_entries[file_path] = {
+            'fingerprint': fingerprint,
+            'categories': names,
+            'assignments': [lookup[category] for category in categories]
+        }
+        
+        for sample, content_hash, category in zip(data, hashes, categories):
+            category_by_hash.setdefault(content_hash, category)
+            if content_hash not in seen_hashes:
+                seen_hashes.add(content_hash)
+                categorized_data[category].append(sample)
+    
+    return categorized_data, total_samples, file_entries, reclassified
+
+def save_categorized_data(categorized_data: Dict[str, List], output_dir: str, samples_per_file: int = 100,
+                          append: bool = False, previous_shards: Dict[str, List[str]] = None,
+                          storage_format: str = 'jsonl', codec: str = 'zlib',
+                          shard_budget: int = None, budget_unit: str = 'bytes'):
+    """カテゴリ別データをファイルに保存（appendなら既存ファイルの続き番号から追加）
+    
+    previous_shardsに前回のシャードごとのハッシュを渡すと、内容が変わった
+    シャードだけを書き直し、不要になったシャードを削除する。
+    storage_format='columnar' ではJSONLの代わりにカラム形式（codecで圧縮）で保存する。
+    shard_budgetを指定すると、samples_per_file件ごとではなく1シャードあたり
+    budget_unit（'bytes' / 'tokens'）の予算で大きさをそろえて分割する。
+    """
     os.makedirs(output_dir, exist_ok=True)
     
     saved_files = {}
+    shard_entries = []
     
     for category, samples in categorized_data.items():
         if not samples:
@@ -386,38 +671,109 @@ def save_categorized_data(categorized_data: Dict[str, List], output_dir: str, sa
         
         # ファイル分割
         file_count = 0
-        for i in range(0, len(samples), samples_per_file):
+        if append:
+            file_count = len([name for name in os.listdir(category_dir)
+                              if name.startswith(f"{category}_") and name.endswith(SHARD_SUFFIXES[storage_format])])
+            # 前回の最後のシャードが埋まっていなければ、その続きから詰めて同じ番号で書き直す
+            topped_up = _partial_last_shard(output_dir, category, file_count, storage_format,
+                                            samples_per_file, shard_budget, budget_unit)
+            if topped_up:
+                print(f"追記: {shard_path(output_dir, category, file_count, storage_format)} "
+                      f"の続きから詰めます（{len(topped_up)}サンプル）")
+                samples = topped_up + samples
+                file_count -= 1
+        shard_hashes = []
+        old_hashes = (previous_shards or {}).get(category, [])
+        all_lines = dumps_lines(samples)
+        for start, end in shard_ranges(all_lines, samples_per_file, shard_budget, budget_unit):
             file_count += 1
-            chunk = samples[i:i + samples_per_file]
-            filename = f"{category}_{file_count:03d}.jsonl"
-            filepath = os.path.join(category_dir, filename)
+            chunk = samples[start:end]
+            filepath = shard_path(output_dir, category, file_count, storage_format)
             
-            with open(filepath, 'w', encoding='utf-8') as f:
-                for sample in chunk:
-                    f.write(json.dumps(sample, ensure_ascii=False) + '\n')
+            lines = all_lines[start:end]
+            shard_entries.append(shard_entry(output_dir, filepath, category, lines))
+            content = ''.join(lines)
+            if storage_format == 'columnar':
+                # 圧縮方式を変えたときも書き直されるようにハッシュに含める
+                content_hash = hashlib.sha256(f"{codec}\n{content}".encode('utf-8')).hexdigest()
+            else:
+                content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            shard_hashes.append(content_hash)
+            if (previous_shards is not None and len(shard_hashes) <= len(old_hashes)
+                    and old_hashes[len(shard_hashes) - 1] == content_hash
+                    and _shard_complete(filepath, storage_format)):
+                continue
+            
+            if storage_format == 'columnar':
+                write_columnar_file(filepath, chunk, codec)
+            else:
+                with open(filepath, 'w', encoding='utf-8', newline='\n') as f:
+                    f.write(content)
+                # 行ごとのオフセット索引（ランダムアクセス用）
+                write_index(filepath, rows_from_lines(lines, category))
+            # 形式を切り替えた場合は同じ番号の別形式のシャードを消す
+            for other_format in SHARD_SUFFIXES:
+                if other_format != storage_format:
+                    _remove_shard(shard_path(output_dir, category, file_count, other_format))
             
             print(f"保存: {filepath} ({len(chunk)}サンプル)")
         
         saved_files[category] = {
             'total_samples': len(samples),
             'total_files': file_count,
-            'samples_per_file': samples_per_file
+            'samples_per_file': samples_per_file if shard_budget is None else None,
+            'shard_hashes': shard_hashes
         }
     
+    if not append:
+        # 今回書いた番号より後ろのシャードを削除する。前回より減ったシャード・空になった
+        # カテゴリのほか、マニフェストに記録のない以前の実行で書かれたシャードも対象
+        for category in sorted(os.listdir(output_dir)):
+            category_dir = os.path.join(output_dir, category)
+            if not os.path.isdir(category_dir):
+                continue
+            kept = saved_files.get(category, {}).get('total_files', 0)
+            stale = [file_num for file_num in _shard_numbers(output_dir, category) if file_num > kept]
+            for file_num in stale:
+                for shard_format in SHARD_SUFFIXES:
+                    _remove_shard(shard_path(output_dir, category, file_num, shard_format))
+            if (kept == 0 and (stale or category in (previous_shards or {}))
+                    and not os.listdir(category_dir)):
+                os.rmdir(category_dir)
+    
+    if append:
+        # 追記モードでは前回までのシャードも一覧に残す
+        written = {entry['path'] for entry in shard_entries}
+        shard_entries = [entry for entry in load_shard_manifest(output_dir).get('shards', [])
+                         if entry['path'] not in written] + shard_entries
+    write_shard_manifest(output_dir, shard_entries, shard_budget, budget_unit, samples_per_file)
+
     return saved_files
 
-def create_category_summary(classifier: DetailedCategoryClassifier, categorized_data: Dict[str, List], output_dir: str):
-    """カテゴリサマリーを作成"""
+def create_category_summary(classifier: DetailedCategoryClassifier, categorized_data: Dict[str, List], output_dir: str,
+                            previous: Dict[str, Any] = None, index: DedupeIndex = None):
+    """カテゴリサマリーを作成（previousを渡すと前回までの件数に加算）
+
+    indexを渡すと、次回の追記時に同じインデックスで作った出力か確かめられるよう
+    その識別情報も記録する。
+    """
+    counts = {category: info['sample_count']
+              for category, info in (previous or {}).get('categories', {}).items()}
+    for category, samples in categorized_data.items():
+        counts[category] = counts.get(category, 0) + len(samples)
+    
     summary = {
-        'total_categories': len(categorized_data),
-        'total_samples': sum(len(samples) for samples in categorized_data.values()),
+        'total_categories': len(counts),
+        'total_samples': sum(counts.values()),
         'categories': {}
     }
+    if index is not None:
+        summary['index'] = index.record()
     
-    for category, samples in categorized_data.items():
+    for category, count in counts.items():
         definition = classifier.category_definitions.get(category, {})
         summary['categories'][category] = {
-            'sample_count': len(samples),
+            'sample_count': count,
             'description': definition.get('description', ''),
             'keywords': definition.get('keywords', []),
             'priority': definition.get('priority', 99)
@@ -432,6 +788,40 @@ def create_category_summary(classifier: DetailedCategoryClassifier, categorized_
 
 def main():
     """メイン処理"""
+    parser = argparse.ArgumentParser(description="Wisbee詳細カテゴリ分類")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="分類に使うプロセス数（1ならシリアル実行）")
+    parser.add_argument('--near-dup-threshold', type=float, default=None,
+                        help="指定するとMinHashでニア重複も除去（推定Jaccard類似度のしきい値、例: 0.8）")
+    parser.add_argument('--index', default=None,
+                        help="永続重複インデックスのディレクトリ（指定すると前回以降の追加分だけを分類して追記）")
+    parser.add_argument('--incremental', action='store_true',
+                        help="マニフェストを使い、変更のあった入力だけを再分類して内容の変わったシャードだけを書き直す")
+    parser.add_argument('--format', dest='storage_format', choices=sorted(SHARD_SUFFIXES), default='jsonl',
+                        help="シャードの保存形式（columnar: instruction辞書化・列ごとに格納・シャード単位で圧縮）")
+    parser.add_argument('--codec', choices=sorted(CODECS), default='zlib',
+                        help="--format columnar のときの圧縮方式")
+    budget_group = parser.add_mutually_exclusive_group()
+    budget_group.add_argument('--shard-bytes', type=int, default=None,
+                              help="100件ごとではなく1シャードあたりのバイト数の予算で分割")
+    budget_group.add_argument('--shard-tokens', type=int, default=None,
+                              help="100件ごとではなく1シャードあたりの推定トークン数の予算で分割")
+    parser.add_argument('--classifier', choices=['keyword', 'embedding'], default='keyword',
+                        help="embedding: キーワードが一致せずgeneral_otherになったサンプルを埋め込みの類似度で振り分け直す（numpyが必要）")
+    parser.add_argument('--embedding-threshold', type=float, default=EMBEDDING_THRESHOLD,
+                        help="--classifier embedding で振り分けるコサイン類似度のしきい値")
+    parser.add_argument('--embedding-cache', default=None,
+                        help="埋め込みキャッシュのディレクトリ（既定: 出力ディレクトリ内のembedding_cache）")
+    args = parser.parse_args()
+    if args.classifier == 'embedding' and not numpy_available():
+        parser.error("--classifier embedding には numpy が必要です（pip install numpy）")
+    if args.incremental and args.index:
+        parser.error("--incremental と --index は同時に指定できません")
+    shard_budget = args.shard_bytes if args.shard_bytes is not None else args.shard_tokens
+    budget_unit = 'bytes' if args.shard_bytes is not None else 'tokens'
+    if shard_budget is not None and shard_budget <= 0:
+        parser.error("シャードの予算は正の値を指定してください")
+    
     print("🐝 Wisbee詳細カテゴリ分類システム開始")
     
     # 分類器を初期化
@@ -449,45 +839,132 @@ def main():
         'wisbee_model_nft_training_data.jsonl'
     ]
     
-    # 全データを読み込み
-    all_data = []
-    for file_path in input_files:
-        if os.path.exists(file_path):
-            print(f"📁 読み込み中: {file_path}")
-            data = load_jsonl_file(file_path)
-            all_data.extend(data)
-            print(f"   {len(data)}サンプル読み込み完了")
-    
-    print(f"\n📊 総データ数: {len(all_data)}サンプル")
+    # 出力ディレクトリ
+    output_dir = "detailed_categorized_wisbee_data"
+    embedding_cache = args.embedding_cache or os.path.join(output_dir, 'embedding_cache')
     
-    # 重複除去
-    print("🔄 重複除去中...")
-    seen_hashes = set()
-    unique_data = []
+    index = None
+    previous_summary = None
+    manifest = None
+    if args.incremental:
+        manifest = load_manifest(output_dir)
+        classifier_hash = classifier_definition_hash(classifier)
+        options = {'near_dup_threshold': args.near_dup_threshold, 'samples_per_file': 100,
+                   'storage_format': args.storage_format, 'codec': args.codec,
+                   'shard_budget': [budget_unit, shard_budget] if shard_budget is not None else None,
+                   'classifier': [args.classifier, args.embedding_threshold] if args.classifier == 'embedding' else 'keyword'}
+        if (manifest_is_current(manifest, classifier_hash, input_files, options)
+                and shards_present(manifest, output_dir, args.storage_format)):
+            print("\n✅ 入力ファイル・カテゴリ定義ともに前回から変更なし。処理をスキップします")
+            return
+        if args.workers > 1:
+            print("   差分モードでは変更のあったファイルのみをシリアルで分類します")
+    elif args.index:
+        index = DedupeIndex(args.index)
+        print(f"📇 重複インデックス: {args.index}（登録済み {len(index):,}件）")
+        summary_file = os.path.join(output_dir, 'category_summary.json')
+        if os.path.exists(summary_file):
+            with open(summary_file, 'r', encoding='utf-8') as f:
+                previous_summary = json.load(f)
+        # 出力がこのインデックスと一緒に作られたものでなければ追記しない
+        if previous_summary is not None and not index.matches(previous_summary.get('index')):
+            if len(index):
+                parser.error(f"{output_dir} は重複インデックス {args.index} と対応していません"
+                             "（別のインデックスか、インデックスなしで作られた出力です）。"
+                             "新しいインデックスのディレクトリを指定して作り直してください")
+            print("   新しいインデックスのため、出力を追記せずに作り直します")
+            previous_summary = None
+        if args.workers > 1:
+            # 追加分だけを読むため、インデックス使用時はシリアルで処理
+            print("   インデックス使用時は追加分のみをシリアルで分類します")
     
-    for item in all_data:
-        content = json.dumps(item, sort_keys=True, ensure_ascii=False)
-        content_hash = hashlib.md5(content.encode()).hexdigest()
+    if manifest is not None:
+        print("\n🔍 差分分類中...")
+        categorized_data, total_samples, file_entries, reclassified = classify_incremental(
+            classifier, input_files, manifest, classifier_hash)
+        unique_count = sum(len(samples) for samples in categorized_data.values())
+        print(f"\n📊 総データ数: {total_samples}サンプル")
+        print(f"   重複除去後: {unique_count}サンプル")
+        print(f"   再分類したファイル: {len(reclassified)}/{len(file_entries)}")
+        print("   分類完了")
+    elif args.workers > 1 and index is None:
+        # バイト範囲ごとに並列分類
+        print(f"\n🔍 詳細カテゴリ分類中（{args.workers}プロセス）...")
+        categorized_data, total_samples = classify_parallel(input_files, args.workers)
+        unique_count = sum(len(samples) for samples in categorized_data.values())
+        print(f"\n📊 総データ数: {total_samples}サンプル")
+        print(f"   重複除去後: {unique_count}サンプル")
+        print(f"   除去された重複: {total_samples - unique_count}サンプル")
+        print("   分類完了")
+    else:
+        # 全データを読み込み
+        all_data = []
+        for file_path in input_files:
+            if os.path.exists(file_path):
+                print(f"📁 読み込み中: {file_path}")
+                if index is not None:
+                    data = list(index.iter_new_samples(file_path))
+                else:
+                    data = load_jsonl_file(file_path)
+                all_data.extend(data)
+                print(f"   {len(data)}サンプル読み込み完了")
         
-        if content_hash not in seen_hashes:
-            seen_hashes.add(content_hash)
-            unique_data.append(item)
-    
-    print(f"   重複除去後: {len(unique_data)}サンプル")
-    print(f"   除去された重複: {len(all_data) - len(unique_data)}サンプル")
-    
-    # 詳細カテゴリ分類
-    print("\n🔍 詳細カテゴリ分類中...")
-    categorized_data = defaultdict(list)
-    
-    for i, sample in enumerate(unique_data):
-        if i % 500 == 0:
-            print(f"   進捗: {i}/{len(unique_data)} ({i/len(unique_data)*100:.1f}%)")
+        print(f"\n📊 総データ数: {len(all_data)}サンプル")
+        
+        # 重複除去
+        print("🔄 重複除去中...")
+        seen_hashes = set()
+        unique_data = []
+        
+        for item in all_data:
+            content_hash = sample_hash(item)
+            
+            if index is not None:
+                # 過去の実行で登録済みのサンプルも重複として除去
+                if index.add(bytes.fromhex(content_hash)):
+                    unique_data.append(item)
+            elif content_hash not in seen_hashes:
+                seen_hashes.add(content_hash)
+                unique_data.append(item)
+        
+        print(f"   重複除去後: {len(unique_data)}サンプル")
+        print(f"   除去された重複: {len(all_data) - len(unique_data)}サンプル")
+        
+        # 詳細カテゴリ分類
+        print("\n🔍 詳細カテゴリ分類中...")
+        categorized_data = defaultdict(list)
+        
+        for i, sample in enumerate(unique_data):
+            if i % 500 == 0:
+                print(f"   進捗: {i}/{len(unique_data)} ({i/len(unique_data)*100:.1f}%)")
+        
+            category = classifier.classify_sample(sample)
+            categorized_data[category].append(sample)
+        
+        print("   分類完了")
         
-        category = classifier.classify_sample(sample)
-        categorized_data[category].append(sample)
+        unique_count = len(unique_data)
     
-    print("   分類完了")
+    if args.classifier == 'embedding':
+        # 全カテゴリの埋め込みから重心を作るため、分類が出そろってから振り分け直す
+        print(f"\n🧭 埋め込みでgeneral_otherを再分類中（しきい値 {args.embedding_threshold}）...")
+        categorized_data, embedding_stats = reclassify_with_embeddings(
+            classifier, categorized_data, args.embedding_threshold, embedding_cache)
+        print(f"   対象: {embedding_stats['candidates']}サンプル → 振り分け: {embedding_stats['reassigned']}サンプル"
+              f"（キャッシュ利用 {embedding_stats['cache_hits']}件）")
+        for category, count in sorted(embedding_stats['categories'].items(), key=lambda x: x[1], reverse=True):
+            print(f"     → {category}: {count}サンプル")
+    
+    if args.near_dup_threshold is not None:
+        # 内容ハッシュの順にニア重複を除去（シリアル・並列・差分モードで同じ結果になる）
+        print(f"\n🔄 ニア重複除去中（しきい値 {args.near_dup_threshold}）...")
+        categorized_data, detector = remove_near_duplicates(categorized_data, args.near_dup_threshold)
+        unique_count -= detector.duplicates
+        os.makedirs(output_dir, exist_ok=True)
+        report_file = os.path.join(output_dir, 'near_duplicate_report.json')
+        report = detector.write_report(report_file)
+        print(f"   除去されたニア重複: {detector.duplicates}サンプル（{report['total_clusters']}クラスタ）")
+        print(f"   クラスタレポート: {report_file}")
     
     # 分類結果の表示
     print("\n📈 詳細分類結果:")
@@ -498,15 +975,31 @@ def main():
         description = definition.get('description', '')
         print(f"   {category}: {len(samples)}サンプル ({description})")
     
-    # 出力ディレクトリ
-    output_dir = "detailed_categorized_wisbee_data"
     print(f"\n💾 データ保存中（{output_dir}ディレクトリ）...")
     
     # カテゴリ別データを保存
-    saved_files = save_categorized_data(categorized_data, output_dir, samples_per_file=100)
+    saved_files = save_categorized_data(categorized_data, output_dir, samples_per_file=100,
+                                        append=previous_summary is not None,
+                                        previous_shards=manifest.get('shards', {}) if manifest is not None else None,
+                                        storage_format=args.storage_format, codec=args.codec,
+                                        shard_budget=shard_budget, budget_unit=budget_unit)
     
     # サマリー作成
-    summary = create_category_summary(classifier, categorized_data, output_dir)
+    summary = create_category_summary(classifier, categorized_data, output_dir, previous_summary, index)
+    
+    if index is not None:
+        # 出力を書き終えてからインデックスを確定させる
+        index.save()
+        index.close()
+    
+    if manifest is not None:
+        save_manifest({
+            'classifier_hash': classifier_hash,
+            'options': options,
+            'files': file_entries,
+            'shards': {category: info['shard_hashes'] for category, info in saved_files.items()}
+        }, output_dir)
+        print(f"📝 マニフェスト保存: {output_dir}/{MANIFEST_FILE}")
     
     print(f"\n📊 カテゴリサマリー保存: {output_dir}/category_summary.json")
     print("\n✅ 詳細カテゴリ分類完了！")
@@ -516,7 +1009,7 @@ def main():
     print("📋 詳細分類サマリー")
     print("="*60)
     print(f"総カテゴリ数: {len(categorized_data)}")
-    print(f"総サンプル数: {len(unique_data):,}")
+    print(f"総サンプル数: {unique_count:,}")
     print(f"出力ディレクトリ: {output_dir}")
     print("\n上位10カテゴリ:")
     
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+永続重複インデックス
+
+処理済みサンプルのMD5ダイジェスト（16バイト固定長）をソート済みの
+セグメントファイルとしてディスクに保存し、mmapした上で二分探索します。
+各入力ファイルの処理済みバイト位置も記録するため、次回以降は
+追記された行だけを読み込んでハッシュ化すれば済みます。
+
+  index_dir/
+    state.json            # セグメント一覧と入力ファイルごとの処理済み位置
+    segment_000001.bin    # ソート済みダイジェストの連結
+
+1回の実行で増えた分は新しいセグメントとして書き出し、セグメント数が
+MAX_SEGMENTSを超えたときだけ全体をマージして1本にまとめます。
+state.json には、保存のたびに追加分のダイジェストをつなげてハッシュした
+内容ダイジェストも記録します（同じ件数の別のインデックスや、同じ場所で
+作り直したインデックスを区別するため）。
+"""
+
+import hashlib
+import heapq
+import json
+import mmap
+import os
+from typing import Any, Dict, Iterator, List
+
+from jsonl_io import iter_lines, line_number_at, parse_line
+
+DIGEST_SIZE = 16
+MAX_SEGMENTS = 8
+HEAD_BYTES = 4096  # ファイルの書き換えを検出するために先頭だけハッシュする
+
+
+def _file_head_digest(file_path: str, length: int) -> str:
+    with open(file_path, 'rb') as f:
+        return hashlib.md5(f.read(min(length, HEAD_BYTES))).hexdigest()
+
+
+def _chain_digest(previous: str, digests: List[bytes]) -> str:
+    """前回までの内容ダイジェストに、今回追加したダイジェスト（ソート済み）をつなげる"""
+    h = hashlib.sha256(previous.encode('ascii'))
+    for digest in digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+class _Segment:
+    """mmapしたソート済みダイジェスト列"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = os.path.getsize(path) // DIGEST_SIZE
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+
+    def __contains__(self, digest: bytes) -> bool:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._map[mid * DIGEST_SIZE:(mid + 1) * DIGEST_SIZE]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(self.count):
+            yield self._map[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+class DedupeIndex:
+    """実行をまたいで保持される重複判定インデックス"""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+
+        self.state: Dict[str, Any] = {'segments': [], 'files': {}, 'next_segment': 1, 'digest': ''}
+        state_file = self._path('state.json')
+        if os.path.exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                self.state.update(json.load(f))
+
+        self._segments = [_Segment(self._path(name)) for name in self.state['segments']]
+        self._pending = set()
+        self._pending_files: Dict[str, Dict[str, Any]] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def __len__(self) -> int:
+        return sum(segment.count for segment in self._segments) + len(self._pending)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self._pending or any(digest in segment for segment in self._segments)
+
+    def content_digest(self) -> str:
+        """登録済みのダイジェスト全体を表すハッシュ（未保存の追加分も含む）"""
+        if not self._pending:
+            return self.state['digest']
+        return _chain_digest(self.state['digest'], sorted(self._pending))
+
+    def record(self) -> Dict[str, Any]:
+        """出力側に保存する、このインデックスの識別情報（パス・登録件数・内容ダイジェスト）"""
+        return {'path': os.path.abspath(self.index_dir), 'entries': len(self),
+                'digest': self.content_digest()}
+
+    def matches(self, record: Dict[str, Any]) -> bool:
+        """出力側に保存された識別情報が今のインデックスと一致するか
+
+        一致しなければ、その出力はこのインデックスと一緒に作られたものではなく、
+        追記すると既存のサンプルが重複する。
+        """
+        return record == self.record()
+
+    def add(self, digest: bytes) -> bool:
+        """ダイジェストを登録し、新規ならTrueを返す"""
+        if digest in self:
+            return False
+        self._pending.add(digest)
+        return True
+
+    def iter_new_samples(self, file_path: str) -> Iterator[Dict[str, Any]]:
+        """前回の続きから、入力ファイルに追記されたサンプルだけを返す
+
+        ファイルが縮んだり先頭が書き換わったりしていれば最初から読み直す
+        （既存サンプルはインデックスで重複として除かれる）。
+        """
+        if not os.path.exists(file_path):
+            print(f"ファイルが見つかりません: {file_path}")
+            return
+
+        key = os.path.abspath(file_path)
+        size = os.path.getsize(file_path)
+        previous = self.state['files'].get(key)
+
+        offset = 0
+        if (previous and previous['offset'] <= size
+                and _file_head_digest(file_path, previous['offset']) == previous['head']):
+            offset = previous['offset']
+        if offset and offset == size:
+            return
+
+        # 書き込み途中の最終行は次回に回す
+        for _, line_offset, line in iter_lines(file_path, offset, complete_only=True):
+            offset = line_offset + len(line) + 1
+            try:
+                sample = parse_line(line)
+            except ValueError as e:
+                print(f"JSONデコードエラー {file_path}:{line_number_at(file_path, line_offset)}（オフセット {line_offset}）: {e}")
+                continue
+            if sample is not None:
+                yield sample
+
+        self._pending_files[key] = {'offset': offset, 'head': _file_head_digest(file_path, offset)}
+
+    def save(self):
+        """今回追加したダイジェストと処理済み位置を書き出す"""
+        if self._pending:
+            name = f"segment_{self.state['next_segment']:06d}.bin"
+            self.state['next_segment'] += 1
+            digests = sorted(self._pending)
+            self._write_segment(name, digests)
+            self.state['digest'] = _chain_digest(self.state['digest'], digests)
+            self._segments.append(_Segment(self._path(name)))
+            self.state['segments'].append(name)
+            self._pending = set()
+
+        obsolete = self._compact() if len(self._segments) > MAX_SEGMENTS else []
+
+        self.state['files'].update(self._pending_files)
+        self._pending_files = {}
+
+        state_file = self._path('state.json')
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, state_file)
+
+        # 新しいstate.jsonが参照しなくなってから古いセグメントを削除
+        for segment in obsolete:
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+    def _write_segment(self, name: str, digests) -> None:
+        path = self._path(name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for digest in digests:
+                f.write(digest)
+        os.replace(tmp_path, path)
+
+    def _compact(self) -> List[_Segment]:
+        """全セグメントを1本にマージし、不要になったセグメントを返す"""
+        name = f"segment_{self.state['next_segment']:06d}.bin"
+        self.state['next_segment'] += 1
+        self._write_segment(name, heapq.merge(*self._segments))
+
+        obsolete = self._segments
+        self._segments = [_Segment(self._path(name))]
+        self.state['segments'] = [name]
+        return obsolete
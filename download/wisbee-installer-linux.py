@@ -10,8 +10,289 @@ import json
 import hashlib
 import requests
 import subprocess
+import threading
+import time
+import platform
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from urllib.request import urlretrieve
+
+# Pinned llama.cpp release
+LLAMA_CPP_VERSION = "b3600"
+LLAMA_CPP_REPO = "https://github.com/ggerganov/llama.cpp.git"
+LLAMA_CPP_RELEASES = "https://github.com/ggerganov/llama.cpp/releases/download"
+LLAMA_CPP_BINARIES = ["llama-cli", "llama-server", "main", "server"]
+
+def normalize_arch(machine):
+    machine = machine.lower()
+    if machine in ("amd64", "x86_64", "x64"):
+        return "x86_64"
+    if machine in ("arm64", "aarch64"):
+        return "arm64"
+    return machine
+
+def detect_cpu_features():
+    """Detect the SIMD features prebuilt llama.cpp binaries are compiled for"""
+    features = set()
+    if normalize_arch(platform.machine()) == "arm64":
+        features.add("neon")
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("flags"):
+                        flags = set(line.split(":", 1)[1].split())
+                        features.update(flag for flag in ("avx", "avx2", "avx512f") if flag in flags)
+                        break
+        except OSError:
+            pass
+    elif sys.platform == "darwin":
+        try:
+            output = subprocess.run(
+                ["sysctl", "-n", "machdep.cpu.features", "machdep.cpu.leaf7_features"],
+                capture_output=True, text=True
+            ).stdout.lower().split()
+            features.update(flag for flag in ("avx", "avx2", "avx512f") if flag in output)
+        except OSError:
+            pass
+    elif sys.platform == "win32":
+        import ctypes
+        # PF_AVX_INSTRUCTIONS_AVAILABLE, PF_AVX2_..., PF_AVX512F_...
+        for flag, feature in ((39, "avx"), (40, "avx2"), (41, "avx512f")):
+            if ctypes.windll.kernel32.IsProcessorFeaturePresent(flag):
+                features.add(feature)
+    return features
+
+def default_llama_index(version=LLAMA_CPP_VERSION):
+    """Prebuilt binaries published on the llama.cpp GitHub release, best first"""
+    def asset(name):
+        return f"{LLAMA_CPP_RELEASES}/{version}/llama-{version}-bin-{name}.zip"
+
+    builds = [
+        ("darwin", "arm64", ["neon"], "macos-arm64"),
+        ("darwin", "x86_64", [], "macos-x64"),
+        ("linux", "x86_64", ["avx2"], "ubuntu-x64"),
+        ("win32", "x86_64", ["avx512f"], "win-avx512-x64"),
+        ("win32", "x86_64", ["avx2"], "win-avx2-x64"),
+        ("win32", "x86_64", ["avx"], "win-avx-x64"),
+        ("win32", "x86_64", [], "win-noavx-x64"),
+    ]
+    return {"builds": [
+        {"version": version, "os": os_name, "arch": arch, "requires": requires, "url": asset(name)}
+        for os_name, arch, requires, name in builds
+    ]}
+
+def select_prebuilt(index, features, version=LLAMA_CPP_VERSION):
+    """Pick the first build for this version and platform the CPU supports"""
+    os_name = "linux" if sys.platform.startswith("linux") else sys.platform
+    arch = normalize_arch(platform.machine())
+    for build in index.get("builds", []):
+        if (build.get("version") == version
+                and build.get("os") == os_name
+                and build.get("arch") == arch
+                and set(build.get("requires", [])) <= features):
+            return build
+    return None
+
+class ModelDownloader:
+    """
+    Resumable, parallel, checksum-verified HTTP download
+
+    The file is fetched in several byte ranges at once into <name>.part.
+    Progress is recorded in <name>.part.json, so an interrupted download
+    continues where it stopped instead of starting from zero. While the
+    segments download, the contiguous prefix of the file is hashed with
+    SHA-256, and the result is checked before the file is moved into place.
+    The file is only moved into place once the byte count matches the
+    Content-Length, so a short download is caught even without a SHA-256.
+    On Ctrl-C the segments stop at their next chunk and the progress so far
+    is saved for the next run.
+    """
+
+    def __init__(self, url, dest, segments=4, expected_sha256=None,
+                 chunk_size=1024 * 1024, timeout=30, retries=3):
+        self.url = url
+        self.dest = Path(dest)
+        self.part_path = self.dest.with_name(self.dest.name + ".part")
+        self.state_path = self.dest.with_name(self.dest.name + ".part.json")
+        self.segments = segments
+        self.expected_sha256 = expected_sha256
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.state = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_save = 0
+
+    def probe(self):
+        """Return (size, supports_ranges, sha256) from a HEAD request"""
+        response = requests.head(self.url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+
+        size = int(response.headers.get("Content-Length", 0)) or None
+        supports_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+        # Hugging Face exposes the LFS object's SHA-256 as X-Linked-Etag
+        # on the redirect response. A plain ETag is not a content hash on
+        # other hosts, so it is never used.
+        sha256 = None
+        for r in response.history + [response]:
+            etag = r.headers.get("X-Linked-Etag", "")
+            etag = etag.replace("W/", "").strip('"')
+            if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag.lower()):
+                sha256 = etag.lower()
+                break
+        return size, supports_ranges, sha256
+
+    def download(self, progress=None):
+        """Download to dest, resuming a previous partial download if present"""
+        size, supports_ranges, remote_sha256 = self.probe()
+        expected = self.expected_sha256 or remote_sha256
+
+        if size is None or not supports_ranges:
+            # No ranges: a single sequential stream, nothing to resume from
+            self._new_state(size or 0, 1, expected)
+        elif not self._load_state(size):
+            self._new_state(size, self.segments, expected)
+        expected = self.state["sha256"] or expected
+
+        hasher = hashlib.sha256()
+        hashed = 0
+        self._stop.clear()
+        pool = ThreadPoolExecutor(max_workers=len(self.state["segments"]))
+        try:
+            futures = [pool.submit(self._fetch_segment, i, size is not None and supports_ranges)
+                       for i, (start, end, done) in enumerate(self.state["segments"])
+                       if end is None or done < end - start + 1]
+            pending = set(futures)
+            with open(self.part_path, "rb") as reader:
+                while pending:
+                    _, pending = wait(pending, timeout=0.5)
+                    hashed = self._hash_ready(reader, hasher, hashed)
+                    if progress:
+                        progress(self.downloaded(), size)
+                for future in futures:
+                    future.result()  # Re-raise segment errors; progress is kept
+                hashed = self._hash_ready(reader, hasher, hashed)
+        except BaseException:
+            # Ctrl-C included: don't wait for the other segments to finish
+            self._stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._save_state(force=True)
+            raise
+        pool.shutdown()
+
+        self._save_state(force=True)
+        if size is not None and self.downloaded() != size:
+            # A segment can end early without an error (e.g. a shorter range
+            # than requested); keep the partial file so the next run resumes it
+            raise IOError(f"Download incomplete: got {self.downloaded()} of {size} bytes")
+
+        digest = hasher.hexdigest()
+        if expected and digest != expected.lower():
+            self.part_path.unlink()
+            self.state_path.unlink()
+            raise ValueError(f"SHA-256 mismatch: expected {expected}, got {digest}")
+
+        os.replace(self.part_path, self.dest)
+        self.state_path.unlink()
+        return self.dest
+
+    def downloaded(self):
+        with self._lock:
+            return sum(done for _, _, done in self.state["segments"])
+
+    def _new_state(self, size, segments, sha256):
+        segment_size = max(size // segments, 1) if size else 0
+        ranges = []
+        for i in range(segments):
+            start = i * segment_size
+            end = size - 1 if i == segments - 1 else start + segment_size - 1
+            ranges.append([start, end if size else None, 0])
+        self.state = {"url": self.url, "size": size, "sha256": sha256, "segments": ranges}
+
+        with open(self.part_path, "wb") as f:
+            f.truncate(size)
+        self._save_state(force=True)
+
+    def _load_state(self, size):
+        if not self.part_path.exists() or not self.state_path.exists():
+            return False
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get("url") != self.url or state.get("size") != size:
+            return False
+        self.state = state
+        return True
+
+    def _save_state(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._last_save < 1:
+                return
+            self._last_save = time.time()
+            tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def _fetch_segment(self, index, ranged):
+        """Download one segment, retrying from where a dropped connection stopped"""
+        for attempt in range(self.retries):
+            try:
+                self._fetch_range(self.state["segments"][index], ranged)
+                return
+            except (requests.exceptions.RequestException, IOError):
+                # Without ranges a broken stream can't be continued
+                if not ranged or attempt == self.retries - 1 or self._stop.is_set():
+                    raise
+                if self._stop.wait(2 ** attempt):
+                    return
+
+    def _fetch_range(self, segment, ranged):
+        start, end, done = segment
+        headers = {"Range": f"bytes={start + done}-{end}"} if ranged else {}
+
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if ranged and response.status_code != 206:
+                raise IOError("Server ignored the Range request")
+            # Unbuffered, so recorded progress never runs ahead of the file
+            with open(self.part_path, "r+b", buffering=0) as f:
+                f.seek(start + done)
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if self._stop.is_set():
+                        return
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[f.write(view):]
+                    with self._lock:
+                        segment[2] += len(chunk)
+                    self._save_state()
+
+    def _hash_ready(self, reader, hasher, hashed):
+        """Hash the bytes between `hashed` and the end of the contiguous prefix"""
+        with self._lock:
+            ready = 0
+            for start, end, done in self.state["segments"]:
+                ready = start + done
+                if end is None or done < end - start + 1:
+                    break
+
+        reader.seek(hashed)
+        while hashed < ready:
+            block = reader.read(min(self.chunk_size * 8, ready - hashed))
+            if not block:
+                break
+            hasher.update(block)
+            hashed += len(block)
+        return hashed
 
 class WisbeeInstaller:
     def __init__(self):
@@ -22,8 +303,19 @@ class WisbeeInstaller:
         
         # Model info
         self.model_name = "jan-nano-4b-iQ4_XS.gguf"
-        self.model_url = "https://huggingface.co/Menlo/Jan-nano-gguf/resolve/main/jan-nano-4b-iQ4_XS.gguf"
+        self.model_url = os.environ.get(
+            "WISBEE_MODEL_URL",
+            "https://huggingface.co/Menlo/Jan-nano-gguf/resolve/main/jan-nano-4b-iQ4_XS.gguf"
+        )
         self.model_size = 2.27 * 1024 * 1024 * 1024  # 2.27GB in bytes
+        # Taken from the server's X-Linked-Etag when not set
+        self.model_sha256 = os.environ.get("WISBEE_MODEL_SHA256")
+        self.download_segments = 4
+
+        # llama.cpp binaries: a mirrored index can replace the GitHub releases
+        self.llama_version = LLAMA_CPP_VERSION
+        self.llama_index_url = os.environ.get("WISBEE_LLAMA_INDEX_URL")
+        self.build_dir = self.wisbee_dir / "build" / f"llama.cpp-{self.llama_version}"
         
     def setup_directories(self):
         """Create necessary directories"""
@@ -46,8 +338,8 @@ class WisbeeInstaller:
         
         try:
             # Download with progress
-            def download_progress(block_num, block_size, total_size):
-                downloaded = block_num * block_size
+            def download_progress(downloaded, total_size):
+                total_size = total_size or self.model_size
                 percent = min(100, (downloaded / total_size) * 100)
                 mb_downloaded = downloaded / (1024 * 1024)
                 mb_total = total_size / (1024 * 1024)
@@ -55,53 +347,121 @@ class WisbeeInstaller:
                 sys.stdout.write(f'\r   Progress: {percent:.1f}% ({mb_downloaded:.1f}MB / {mb_total:.1f}MB)')
                 sys.stdout.flush()
             
-            urlretrieve(self.model_url, model_path, reporthook=download_progress)
-            print("\n✅ Model downloaded successfully!")
+            downloader = ModelDownloader(
+                self.model_url, model_path,
+                segments=self.download_segments,
+                expected_sha256=self.model_sha256
+            )
+            downloader.download(progress=download_progress)
+            print("\n✅ Model downloaded and verified successfully!")
             
             return model_path
             
+        except ValueError as e:
+            # Checksum mismatch: the corrupt partial file has been removed
+            print(f"\n❌ Error verifying model: {e}")
+            return None
         except Exception as e:
             print(f"\n❌ Error downloading model: {e}")
-            if model_path.exists():
-                model_path.unlink()
+            print("   Run the installer again to resume the download.")
             return None
     
     def setup_llama_cpp(self):
-        """Setup llama.cpp for model inference"""
+        """Install a prebuilt llama.cpp matching this CPU, compiling only as a fallback"""
         llama_dir = self.app_dir / "llama.cpp"
         
         if llama_dir.exists():
             print("✅ llama.cpp already installed")
             return llama_dir
             
-        print("🔧 Setting up llama.cpp...")
+        print(f"🔧 Setting up llama.cpp {self.llama_version}...")
+        
+        features = detect_cpu_features()
+        build = select_prebuilt(self.load_llama_index(), features, self.llama_version)
+        if build is not None:
+            try:
+                self.install_prebuilt_llama_cpp(build, llama_dir)
+                print("✅ llama.cpp setup complete!")
+                return llama_dir
+            except Exception as e:
+                print(f"⚠️ Prebuilt llama.cpp unavailable ({e}), compiling instead")
+                shutil.rmtree(llama_dir, ignore_errors=True)
+        else:
+            print(f"ℹ️ No prebuilt llama.cpp for CPU features {sorted(features)}, compiling")
         
         try:
-            # Clone llama.cpp
-            subprocess.run([
-                "git", "clone",
-                "https://github.com/ggerganov/llama.cpp.git",
-                str(llama_dir)
-            ], check=True)
-            
-            # Build llama.cpp
-            os.chdir(llama_dir)
-            
-            # Check for Metal support (macOS)
-            if sys.platform == "darwin":
-                print("🍎 Building with Metal support for macOS...")
-                subprocess.run(["make", "LLAMA_METAL=1"], check=True)
-            else:
-                print("🔨 Building llama.cpp...")
-                subprocess.run(["make"], check=True)
-            
+            self.compile_llama_cpp(llama_dir)
             print("✅ llama.cpp setup complete!")
             return llama_dir
             
         except Exception as e:
             print(f"❌ Error setting up llama.cpp: {e}")
+            shutil.rmtree(llama_dir, ignore_errors=True)
             return None
     
+    def load_llama_index(self):
+        """Load the prebuilt binary index from the mirror, or use the GitHub releases"""
+        if self.llama_index_url:
+            try:
+                response = requests.get(self.llama_index_url, timeout=30)
+                response.raise_for_status()
+                return response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"⚠️ Could not load llama.cpp index: {e}")
+        return default_llama_index(self.llama_version)
+    
+    def install_prebuilt_llama_cpp(self, build, llama_dir):
+        """Download a prebuilt release archive and unpack its binaries"""
+        print(f"📥 Downloading prebuilt llama.cpp ({', '.join(build.get('requires', [])) or 'generic'})...")
+        archive = self.app_dir / f"llama-{self.llama_version}.zip"
+        ModelDownloader(build["url"], archive, segments=1,
+                        expected_sha256=build.get("sha256")).download()
+        
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                with zipfile.ZipFile(archive) as zf:
+                    zf.extractall(tmp_dir)
+                # Release archives nest binaries (e.g. build/bin); copy that directory flat
+                for directory, _, files in os.walk(tmp_dir):
+                    names = {Path(name).stem for name in files}
+                    if any(name in names for name in LLAMA_CPP_BINARIES):
+                        llama_dir.mkdir(parents=True, exist_ok=True)
+                        for name in files:
+                            target = llama_dir / name
+                            shutil.copy2(Path(directory) / name, target)
+                            os.chmod(target, 0o755)
+                        return
+            raise RuntimeError("archive contains no llama.cpp binaries")
+        finally:
+            archive.unlink()
+    
+    def compile_llama_cpp(self, llama_dir):
+        """Build the pinned release in a build directory kept between installs"""
+        # Reusing the source tree keeps object files, so rebuilds are incremental
+        if not self.build_dir.exists():
+            self.build_dir.parent.mkdir(parents=True, exist_ok=True)
+            subprocess.run([
+                "git", "clone", "--depth", "1",
+                "--branch", self.llama_version,
+                LLAMA_CPP_REPO,
+                str(self.build_dir)
+            ], check=True)
+        
+        jobs = str(os.cpu_count() or 1)
+        # Check for Metal support (macOS)
+        if sys.platform == "darwin":
+            print("🍎 Building with Metal support for macOS...")
+            subprocess.run(["make", "GGML_METAL=1", "-j", jobs], cwd=self.build_dir, check=True)
+        else:
+            print("🔨 Building llama.cpp...")
+            subprocess.run(["make", "-j", jobs], cwd=self.build_dir, check=True)
+        
+        llama_dir.mkdir(parents=True, exist_ok=True)
+        for name in LLAMA_CPP_BINARIES:
+            binary = self.build_dir / name
+            if binary.exists():
+                shutil.copy2(binary, llama_dir / name)
+    
     def create_launcher(self):
         """Create launcher script"""
         launcher_path = self.wisbee_dir / "wisbee.py"
@@ -119,7 +479,14 @@ from pathlib import Path
 # Paths
 WISBEE_DIR = Path.home() / ".wisbee"
 MODEL_PATH = WISBEE_DIR / "models" / "jan-nano-4b-iQ4_XS.gguf"
-LLAMA_PATH = WISBEE_DIR / "app" / "llama.cpp" / "main"
+LLAMA_DIR = WISBEE_DIR / "app" / "llama.cpp"
+
+def find_llama_cli():
+    """Locate the llama.cpp CLI (named main before llama-cli)"""
+    for name in ("llama-cli", "main", "llama-cli.exe", "main.exe"):
+        if (LLAMA_DIR / name).exists():
+            return LLAMA_DIR / name
+    return None
 
 def run_wisbee():
     """Run Wisbee with llama.cpp"""
@@ -128,7 +495,8 @@ def run_wisbee():
         print("❌ Model not found! Please run the installer first.")
         return
     
-    if not LLAMA_PATH.exists():
+    llama_path = find_llama_cli()
+    if llama_path is None:
         print("❌ llama.cpp not found! Please run the installer first.")
         return
     
@@ -137,7 +505,7 @@ def run_wisbee():
     
     # Run llama.cpp with the model
     cmd = [
-        str(LLAMA_PATH),
+        str(llama_path),
         "-m", str(MODEL_PATH),
         "-n", "512",  # Max tokens
         "-c", "2048",  # Context size
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+埋め込みベクトルによるカテゴリ分類（CPUのみ・NumPy）
+
+キーワードが1つも一致しないサンプルは general_other に入りますが、
+内容は既存カテゴリに近いものが多く含まれます。ここではサンプルを
+小さな埋め込みベクトルにし、カテゴリごとの重心とのコサイン類似度で
+振り分け直します。
+
+- 埋め込み: 正規化したテキストの文字1-gram・2-gramを符号付きで
+  ハッシュし（feature hashing）、IDFで重み付けしてから固定の±1乱数行列で
+  256次元に射影し、L2正規化する。外部モデルは使わない
+- IDF: ペルソナ文や定型の相づちのように多くのサンプルに現れるn-gramを
+  弱めるため、初回にコーパス全体の文書頻度から求めてキャッシュに固定する
+- バッチ処理: テキストをまとめて1本のコードポイント配列にし、
+  n-gramのハッシュ・集計・射影をバッチ単位の配列演算で行う
+- 重心: キーワードで分類できたサンプルの埋め込みの平均（サンプルが無い
+  カテゴリは説明とキーワードから作ったベクトル）
+- 判定: general_other のサンプル × 重心の行列積をバッチごとに計算し、
+  最大の類似度がしきい値以上ならそのカテゴリに移す
+- キャッシュ: 埋め込みをサンプルハッシュをキーにディスクへ追記保存し、
+  次回以降は計算済みのサンプルを読むだけにする
+
+既定のしきい値 0.4 は、キーワードで分類できたサンプルを1件ずつ除いた
+重心で分類し直したとき、約8割が元のカテゴリに一致する値です。
+
+NumPy はオプションです（無ければ利用時に ImportError）。
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from near_dedupe import normalize_text, sample_text
+
+FALLBACK_CATEGORY = 'general_other'
+
+EMBEDDING_DIM = 256
+HASH_DIM = 1 << 13
+NGRAM_SIZES = (1, 2)
+PROJECTION_SEED = 0x5EED
+DEFAULT_THRESHOLD = 0.4
+DEFAULT_BATCH_SIZE = 512
+
+CACHE_VERSION = 1
+CACHE_META = 'meta.json'
+CACHE_KEYS = 'keys.u64'
+CACHE_VECTORS = 'vectors.f16'
+CACHE_IDF = 'idf.f32'
+
+_NGRAM_MULTIPLIER = 0x100000001B3
+_SEPARATOR = '\x00'
+
+
+def numpy_available() -> bool:
+    return np is not None
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("埋め込み分類には numpy が必要です（pip install numpy）")
+
+
+def _mix64(values):
+    """uint64配列のハッシュ値をよく混ぜる（splitmix64の最終段）"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def projection_matrix(hash_dim: int = HASH_DIM, dim: int = EMBEDDING_DIM, seed: int = PROJECTION_SEED):
+    """(hash_dim, dim) の±1/√dim 乱数射影行列（NumPyの乱数に依存せず常に同じ値）"""
+    _require_numpy()
+    cells = np.arange(hash_dim * dim, dtype=np.uint64) + np.uint64(seed)
+    signs = (_mix64(cells) >> np.uint64(63)).astype(np.float32)
+    return ((1.0 - 2.0 * signs) / np.sqrt(dim)).astype(np.float32).reshape(hash_dim, dim)
+
+
+def hashed_features(texts: Sequence[str], hash_dim: int = HASH_DIM, ngram_sizes: Sequence[int] = NGRAM_SIZES):
+    """テキスト群の符号付きn-gramハッシュ頻度 (len(texts), hash_dim)
+
+    テキストを区切り文字でつないだ1本のコードポイント配列上で、
+    全テキストのn-gramを一度にハッシュする（区切りをまたぐn-gramは捨てる）。
+    """
+    _require_numpy()
+    normalized = [normalize_text(text).replace(_SEPARATOR, '') for text in texts]
+    lengths = np.fromiter((len(text) for text in normalized), dtype=np.int64, count=len(normalized))
+    counts = np.zeros(len(normalized) * hash_dim, dtype=np.float64)
+    if not len(normalized):
+        return counts.reshape(0, hash_dim).astype(np.float32)
+
+    joined = _SEPARATOR.join(normalized)
+    code_points = np.frombuffer(joined.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+    rows = np.repeat(np.arange(len(normalized), dtype=np.int64), lengths + 1)[:len(code_points)]
+    separators = np.concatenate(([0], np.cumsum(code_points == 0)))
+
+    for n in ngram_sizes:
+        count = len(code_points) - n + 1
+        if count <= 0:
+            continue
+        hashes = np.full(count, n, dtype=np.uint64)
+        for k in range(n):
+            hashes = hashes * np.uint64(_NGRAM_MULTIPLIER) + code_points[k:k + count]
+        hashes = _mix64(hashes)
+        valid = separators[n:n + count] == separators[:count]
+        hashes = hashes[valid]
+        buckets = rows[:count][valid] * hash_dim + (hashes % np.uint64(hash_dim)).astype(np.int64)
+        signs = 1.0 - 2.0 * (hashes >> np.uint64(63)).astype(np.float64)
+        counts += np.bincount(buckets, weights=signs, minlength=len(counts))
+
+    counts = counts.reshape(len(normalized), hash_dim)
+    # 長い文章で頻出n-gramが支配しないよう対数で抑える
+    return (np.sign(counts) * np.log1p(np.abs(counts))).astype(np.float32)
+
+
+def normalize_rows(vectors):
+    """行ごとにL2正規化（ゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def hash_keys(hashes: Sequence[str]):
+    """16進のサンプルハッシュ（md5）先頭64bitをキャッシュのキーにする"""
+    _require_numpy()
+    return np.frombuffer(b''.join(bytes.fromhex(h[:16]) for h in hashes), dtype='>u8').astype(np.uint64)
+
+
+class EmbeddingCache:
+    """サンプルハッシュ → 埋め込みベクトルの追記型ディスクキャッシュ
+
+    keys.u64（キーの列）と vectors.f16（float16の行列）に同じ順で追記する。
+    ベクトルを先に書くので、書き込み途中で止まっても開くときに
+    キーの数に揃えて切り詰めれば整合する。埋め込みの計算に使ったIDFも
+    idf.f32 に保存し、キャッシュを作り直すまで同じものを使う。
+    """
+
+    def __init__(self, cache_dir: str, config: Dict[str, Any]):
+        _require_numpy()
+        self.cache_dir = cache_dir
+        self.dim = config['dim']
+        self.keys_path = os.path.join(cache_dir, CACHE_KEYS)
+        self.vectors_path = os.path.join(cache_dir, CACHE_VECTORS)
+        self.idf_path = os.path.join(cache_dir, CACHE_IDF)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        meta_path = os.path.join(cache_dir, CACHE_META)
+        meta = {'version': CACHE_VERSION, **config}
+        previous = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        if previous != meta or not os.path.exists(self.idf_path):
+            # 埋め込みの作り方が変わった・IDFが無い場合は作り直す
+            self.clear()
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, indent=2)
+
+        self.idf = np.fromfile(self.idf_path, dtype='<f4') if os.path.exists(self.idf_path) else None
+        if self.idf is not None and len(self.idf) != config['hash_dim']:
+            self.clear()
+            self.idf = None
+
+        self.keys = np.fromfile(self.keys_path, dtype='<u8').astype(np.uint64) if os.path.exists(self.keys_path) \
+            else np.zeros(0, dtype=np.uint64)
+        vectors = np.fromfile(self.vectors_path, dtype='<f2') if os.path.exists(self.vectors_path) \
+            else np.zeros(0, dtype='<f2')
+        rows = min(len(self.keys), len(vectors) // self.dim)
+        self.keys = self.keys[:rows]
+        self.vectors = vectors[:rows * self.dim].reshape(rows, self.dim)
+        self._truncate(rows)
+        self._reindex()
+
+    def clear(self):
+        for path in (self.keys_path, self.vectors_path, self.idf_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def set_idf(self, idf):
+        """IDFを保存（以降の埋め込みはこのIDFで計算する）"""
+        self.idf = np.ascontiguousarray(idf, dtype='<f4')
+        tmp_path = self.idf_path + '.tmp'
+        self.idf.tofile(tmp_path)
+        os.replace(tmp_path, self.idf_path)
+
+    def _truncate(self, rows: int):
+        for path, size in ((self.keys_path, rows * 8), (self.vectors_path, rows * self.dim * 2)):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def _reindex(self):
+        self._order = np.argsort(self.keys, kind='stable')
+        self._sorted = self.keys[self._order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """キーごとのキャッシュ行番号（無ければ -1）"""
+        if not len(self._sorted):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+        found = self._sorted[positions] == keys
+        return np.where(found, self._order[positions], -1)
+
+    def append(self, keys, vectors):
+        """新しいキーと埋め込みを追記"""
+        if not len(keys):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype='<f2')
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.keys_path, 'ab') as f:
+            f.write(np.ascontiguousarray(keys, dtype='<u8').tobytes())
+        self.keys = np.concatenate((self.keys, keys))
+        self.vectors = np.concatenate((self.vectors, vectors))
+        self._reindex()
+
+
+class EmbeddingClassifier:
+    """general_other のサンプルを埋め込みの類似度で既存カテゴリへ振り分け直す"""
+
+    def __init__(self, category_definitions: Dict[str, Dict], threshold: float = DEFAULT_THRESHOLD,
+                 cache_dir: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        _require_numpy()
+        self.category_definitions = category_definitions
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.projection = projection_matrix()
+        self.cache = EmbeddingCache(cache_dir, self.config()) if cache_dir else None
+        self.idf = self.cache.idf if self.cache is not None else None
+        self.cache_hits = 0
+
+    @staticmethod
+    def config() -> Dict[str, Any]:
+        """埋め込みの作り方（変わるとキャッシュを作り直す）"""
+        return {'dim': EMBEDDING_DIM, 'hash_dim': HASH_DIM, 'ngram_sizes': list(NGRAM_SIZES),
+                'projection_seed': PROJECTION_SEED}
+
+    def fit_idf(self, texts: Sequence[str]):
+        """テキスト群の文書頻度からIDFを求める（キャッシュがあれば保存）"""
+        document_counts = np.zeros(HASH_DIM, dtype=np.int64)
+        for start in range(0, len(texts), self.batch_size):
+            document_counts += np.count_nonzero(hashed_features(texts[start:start + self.batch_size]), axis=0)
+        self.idf = np.log((len(texts) + 1) / (document_counts + 1)).astype(np.float32)
+        if self.cache is not None:
+            self.cache.set_idf(self.idf)
+
+    def embed_texts(self, texts: Sequence[str]):
+        """テキスト群をバッチごとに埋め込み (len(texts), EMBEDDING_DIM)"""
+        idf = self.idf if self.idf is not None else np.ones(HASH_DIM, dtype=np.float32)
+        embeddings = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            embeddings[start:start + len(batch)] = normalize_rows((hashed_features(batch) * idf) @ self.projection)
+        return embeddings
+
+    def embed_samples(self, samples: Sequence[Dict[str, Any]], hashes: Sequence[str]):
+        """サンプル群の埋め込み（キャッシュにあるものは読み、無いものだけ計算して追記）"""
+        if self.idf is None:
+            self.fit_idf([sample_text(sample) for sample in samples])
+        if self.cache is None:
+            return self.embed_texts([sample_text(sample) for sample in samples])
+
+        keys = hash_keys(hashes)
+        rows = self.cache.lookup(keys)
+        embeddings = np.zeros((len(samples), EMBEDDING_DIM), dtype=np.float32)
+        hit = rows >= 0
+        embeddings[hit] = self.cache.vectors[rows[hit]]
+        self.cache_hits += int(hit.sum())
+
+        # 同じサンプルが複数あっても計算・追記は1回
+        missing_keys, first, inverse = np.unique(keys[~hit], return_index=True, return_inverse=True)
+        missing = np.flatnonzero(~hit)
+        computed = self.embed_texts([sample_text(samples[i]) for i in missing[first]]).astype('<f2')
+        self.cache.append(missing_keys, computed)
+        embeddings[missing] = computed[inverse.ravel()]
+        return embeddings
+
+    def centroids(self, embeddings, labels, categories: Sequence[str]):
+        """カテゴリごとの重心 (len(categories), EMBEDDING_DIM)
+
+        キーワードで分類できたサンプルの埋め込みの平均。サンプルが無い
+        カテゴリは説明とキーワードをつないだテキストの埋め込みを使う。
+        """
+        sums = np.zeros((len(categories), EMBEDDING_DIM), dtype=np.float32)
+        np.add.at(sums, labels, embeddings)
+        counts = np.bincount(labels, minlength=len(categories))
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            seeds = []
+            for index in empty:
+                definition = self.category_definitions.get(categories[index], {})
+                seeds.append(' '.join([definition.get('description', '')] + list(definition.get('keywords', []))))
+            sums[empty] = self.embed_texts(seeds)
+        return normalize_rows(sums)
+
+    def reclassify(self, categorized_data: Dict[str, List], hashes: Dict[str, List[str]]
+                   ) -> Tuple[Dict[str, List], Dict[str, Any]]:
+        """general_other のサンプルを振り分け直した (カテゴリ別データ, 統計) を返す
+
+        hashes はカテゴリごとのサンプルハッシュ（categorized_data と同じ並び）。
+        振り分けたサンプルは移動先カテゴリの末尾に元の順序のまま追加する。
+        """
+        categories = [category for category in self.category_definitions if category != FALLBACK_CATEGORY]
+        fallback = categorized_data.get(FALLBACK_CATEGORY, [])
+        stats = {'candidates': len(fallback), 'reassigned': 0, 'threshold': self.threshold, 'categories': {}}
+        if not fallback:
+            return categorized_data, stats
+
+        # 全サンプルを1つの行列にまとめる（general_other は末尾）
+        samples, sample_hashes = [], []
+        for category in categories + [FALLBACK_CATEGORY]:
+            samples.extend(categorized_data.get(category, []))
+            sample_hashes.extend(hashes.get(category, []))
+        labels = np.repeat(np.arange(len(categories)),
+                           [len(categorized_data.get(category, [])) for category in categories])
+        embeddings = self.embed_samples(samples, sample_hashes)
+        centroids = self.centroids(embeddings[:len(labels)], labels, categories)
+
+        candidates = embeddings[len(labels):]
+        best = np.empty(len(candidates), dtype=np.int64)
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for start in range(0, len(candidates), self.batch_size):
+            similarity = candidates[start:start + self.batch_size] @ centroids.T
+            best[start:start + len(similarity)] = similarity.argmax(axis=1)
+            scores[start:start + len(similarity)] = similarity.max(axis=1)
+
+        moved = scores >= self.threshold
+        reclassified = {category: list(samples) for category, samples in categorized_data.items()}
+        reclassified[FALLBACK_CATEGORY] = [sample for sample, keep in zip(fallback, moved) if not keep]
+        for index in np.flatnonzero(moved):
+            category = categories[best[index]]
+            reclassified.setdefault(category, []).append(fallback[index])
+            stats['categories'][category] = stats['categories'].get(category, 0) + 1
+        if not reclassified[FALLBACK_CATEGORY]:
+            del reclassified[FALLBACK_CATEGORY]
+
+        stats['reassigned'] = int(moved.sum())
+        stats['mean_similarity'] = float(scores.mean())
+        return reclassified, stats
@@ -150,7 +150,9 @@ async function getRunPodResponse(message, temperature, env) {
       
       if (data.status === 'COMPLETED' && data.output) {
         console.log(`✅ RunPod response received on attempt ${attempt}`);
-        return data.output.text || data.output.response || data.output;
+        // Streaming handlers return the aggregated chunks; the last one is the summary
+        const output = Array.isArray(data.output) ? data.output[data.output.length - 1] : data.output;
+        return output.text || output.response || output;
       } else if (data.status === 'FAILED') {
         console.error('RunPod inference failed:', data.error);
         throw new Error(`RunPod inference failed: ${data.error || 'Unknown error'}`);
@@ -279,7 +279,9 @@ async function getLLMResponse(prompt, temperature, env) {
       if (response.ok) {
         const data = await response.json();
         if (data.status === 'COMPLETED' && data.output) {
-          return data.output.text || data.output.response || data.output || '';
+          // Streaming handlers return the aggregated chunks; the last one is the summary
+          const output = Array.isArray(data.output) ? data.output[data.output.length - 1] : data.output;
+          return output.text || output.response || output || '';
         }
       }
     } catch (error) {
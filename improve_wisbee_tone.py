@@ -4,11 +4,17 @@ Wisbee Training Data Tone Improvement
 過度にカジュアルな表現を修正し、より適切で詳細な回答に改善
 """
 
-import json
+import argparse
 import os
-import re
+import random
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from rewrite_engine import RewriteEngine
+from shard_concat import append_shard, build_index, open_output
+from jsonl_index import write_index
+from jsonl_io import JsonlWriter, iter_lines, parse_line
+
 # 修正すべき表現パターン
 TONE_FIXES = {
     # 過度にカジュアルな表現を削除・修正
@@ -44,6 +50,37 @@ TONE_FIXES = {
     r'あっという間': '短時間で',
 }
 
+# トーン調整の後処理（TONE_FIXESの後に順に適用）
+TONE_CLEANUPS = [
+    # 連続する感嘆符の調整
+    (r'！{2,}', '！'),
+    # 過度な絵文字の調整（3個以上連続を2個に）
+    (r'(✨|🎵|💡|🚀|🎮|📱){3,}', r'\1\1'),
+    # 末尾の調整
+    (r'よ〜！\s*$', 'よ！'),
+    (r'ね〜！\s*$', 'ね！'),
+]
+
+# 過度な関西弁を標準語に近づける
+KANSAI_ADJUSTMENTS = {
+    r'やん([！。]?)': r'ですね\1',
+    r'やで([！。]?)': r'ですよ\1',
+    r'やねん([！。]?)': r'なんです\1',
+    r'しはる': 'される',
+    r'はる': 'です',
+    r'やから': 'だから',
+    r'せやけど': 'でも',
+    r'ほんま': '本当に',
+    r'めっちゃ': 'とても',
+    r'なんぼ': 'どのくらい',
+    r'ちゃう': 'ます',
+    r'おおきに': 'ありがとう',
+}
+
+# ルールを一度だけコンパイルし、逐次適用と同じ結果を少ない走査で得る
+TONE_ENGINE = RewriteEngine(list(TONE_FIXES.items()) + TONE_CLEANUPS)
+KANSAI_ENGINE = RewriteEngine(KANSAI_ADJUSTMENTS.items())
+
 # 改善すべき内容パターン
 CONTENT_IMPROVEMENTS = {
     # より詳細な説明を追加
@@ -61,23 +98,7 @@ CONTENT_IMPROVEMENTS = {
 
 def improve_tone(text: str) -> str:
     """トーンを改善"""
-    improved = text
-    
-    # 基本的な表現修正
-    for pattern, replacement in TONE_FIXES.items():
-        improved = re.sub(pattern, replacement, improved)
-    
-    # 連続する感嘆符の調整
-    improved = re.sub(r'！{2,}', '！', improved)
-    
-    # 過度な絵文字の調整（3個以上連続を2個に）
-    improved = re.sub(r'(✨|🎵|💡|🚀|🎮|📱){3,}', r'\1\1', improved)
-    
-    # 末尾の調整
-    improved = re.sub(r'よ〜！\s*$', 'よ！', improved)
-    improved = re.sub(r'ね〜！\s*$', 'ね！', improved)
-    
-    return improved.strip()
+    return TONE_ENGINE.apply(text).strip()
 
 def enhance_content(text: str, instruction: str) -> str:
     """内容をより詳細で有用にする"""
@@ -95,116 +116,142 @@ def enhance_content(text: str, instruction: str) -> str:
     
     return enhanced
 
-def improve_wisbee_character(input_file: str, output_file: str):
-    """Wisbeeキャラクターデータを改善"""
-    print(f"📝 処理中: {input_file}")
+def improve_sample(data: dict) -> bool:
+    """1サンプルのoutputを改善し、変更があったかを返す"""
+    original_output = data['output']
+    
+    # トーン改善
+    improved_output = improve_tone(original_output)
     
-    improved_data = []
+    # 内容強化
+    improved_output = enhance_content(improved_output, data['instruction'])
+    
+    # より自然な関西弁表現に調整
+    improved_output = adjust_kansai_dialect(improved_output)
+    
+    data['output'] = improved_output
+    return improved_output != original_output
+
+def improve_file(input_file: str, output_file: str) -> dict:
+    """1ファイルを1行ずつ改善して書き出し、件数と出力先、書いた各行のバイト数を返す
+    
+    行のバイト数（改行込み）はマージファイルの行索引を読み直さずに作るために使う。
+    """
     changes_count = 0
+    total_count = 0
+    warnings = []
+    line_bytes = []
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line_num, line in enumerate(f, 1):
+    with JsonlWriter(output_file) as writer:
+        for line_num, _, line in iter_lines(input_file):
+            try:
+                data = parse_line(line)
+            except ValueError as e:
+                warnings.append(f"⚠️ Line {line_num}: JSONエラー - {e}")
+                continue
+            if data is None:
+                continue
+            
             try:
-                data = json.loads(line.strip())
-                original_output = data['output']
-                
-                # トーン改善
-                improved_output = improve_tone(original_output)
-                
-                # 内容強化
-                improved_output = enhance_content(improved_output, data['instruction'])
-                
-                # より自然な関西弁表現に調整
-                improved_output = adjust_kansai_dialect(improved_output)
-                
                 # 変更があった場合
-                if improved_output != original_output:
+                if improve_sample(data):
                     changes_count += 1
-                    
-                data['output'] = improved_output
-                improved_data.append(data)
                 
-            except json.JSONDecodeError as e:
-                print(f"⚠️ Line {line_num}: JSONエラー - {e}")
-                continue
             except Exception as e:
-                print(f"⚠️ Line {line_num}: 処理エラー - {e}")
+                warnings.append(f"⚠️ Line {line_num}: 処理エラー - {e}")
                 continue
+            
+            line_bytes.append(len(writer.write(data).encode('utf-8')))
+            total_count += 1
+    
+    return {
+        'input_file': input_file,
+        'output_file': output_file,
+        'changes': changes_count,
+        'total': total_count,
+        'warnings': warnings,
+        'line_bytes': line_bytes
+    }
+
+def _improve_file_task(paths):
+    return improve_file(*paths)
+
+def improve_wisbee_character(input_file: str, output_file: str):
+    """Wisbeeキャラクターデータを改善"""
+    print(f"📝 処理中: {input_file}")
     
-    # 改善されたデータを保存
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for data in improved_data:
-            f.write(json.dumps(data, ensure_ascii=False) + '\n')
+    result = improve_file(input_file, output_file)
+    for warning in result['warnings']:
+        print(warning)
     
-    print(f"✅ 完了: {changes_count}/{len(improved_data)} 項目を改善")
-    return changes_count
+    print(f"✅ 完了: {result['changes']}/{result['total']} 項目を改善")
+    return result['changes']
 
 def adjust_kansai_dialect(text: str) -> str:
     """関西弁をより自然で適切なレベルに調整"""
-    # 過度な関西弁を標準語に近づける
-    adjustments = {
-        r'やん([！。]?)': r'ですね\1',
-        r'やで([！。]?)': r'ですよ\1',
-        r'やねん([！。]?)': r'なんです\1',
-        r'しはる': 'される',
-        r'はる': 'です',
-        r'やから': 'だから',
-        r'せやけど': 'でも',
-        r'ほんま': '本当に',
-        r'めっちゃ': 'とても',
-        r'なんぼ': 'どのくらい',
-        r'ちゃう': 'ます',
-        r'おおきに': 'ありがとう',
-    }
-    
-    adjusted = text
-    for pattern, replacement in adjustments.items():
-        adjusted = re.sub(pattern, replacement, adjusted)
-    
-    return adjusted
+    return KANSAI_ENGINE.apply(text)
 
-def process_all_character_files():
-    """全てのWisbeeキャラクターファイルを処理"""
-    character_dir = Path('/Users/yuki/texttolora/detailed_categorized_wisbee_data/wisbee_character')
-    improved_dir = Path('/Users/yuki/texttolora/wisbee_character_improved')
+def process_all_character_files(root: str = '.', workers: int = None, shuffle: bool = False, seed: int = None):
+    """全てのWisbeeキャラクターファイルを並列に処理し、学習用のマージファイルも同時に作成
+    
+    shuffleを指定するとマージファイル内のファイルの並び順をシャッフルする。
+    """
+    character_dir = Path(root) / 'detailed_categorized_wisbee_data' / 'wisbee_character'
+    improved_dir = Path(root) / 'wisbee_character_improved'
     
     # 出力ディレクトリを作成
     improved_dir.mkdir(exist_ok=True)
+    merged_file = improved_dir / "wisbee_improved_all.jsonl"
+    index_file = improved_dir / "wisbee_improved_all.index.json"
+    
+    tasks = [(str(jsonl_file), str(improved_dir / f"improved_{jsonl_file.name}"))
+             for jsonl_file in sorted(character_dir.glob('*.jsonl'))]
+    if shuffle:
+        random.Random(seed).shuffle(tasks)
+    workers = workers or os.cpu_count() or 1
+    entries = []
+    offset = 0
+    rows = []  # マージファイルの行索引 (offset, length, category)
     
     total_changes = 0
-    total_files = 0
-    
-    print("🎯 Wisbeeキャラクターデータの改善を開始...")
+    total_entries = 0
     
-    for jsonl_file in character_dir.glob('*.jsonl'):
-        output_file = improved_dir / f"improved_{jsonl_file.name}"
-        changes = improve_wisbee_character(str(jsonl_file), str(output_file))
-        total_changes += changes
-        total_files += 1
+    print(f"🎯 Wisbeeキャラクターデータの改善を開始...（{len(tasks)}ファイル、{workers}プロセス）")
+    
+    # 結果はタスク順に受け取り、書き終わったファイルをそのままマージファイルへコピーする
+    merged_fd = open_output(merged_file)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(_improve_file_task, tasks):
+                for warning in result['warnings']:
+                    print(f"{warning} ({result['input_file']})")
+                print(f"📝 {Path(result['output_file']).name}: {result['changes']}/{result['total']} 項目を改善")
+                entry = append_shard(result['output_file'], merged_fd, offset)
+                entry['lines'] = result['total']
+                entries.append(entry)
+                # ワーカーが書いた行の位置を、マージファイル内の位置にずらして索引にする
+                row_offset = offset
+                for size in result['line_bytes']:
+                    rows.append((row_offset, size - 1, 'wisbee_character'))
+                    row_offset += size
+                if row_offset != offset + entry['bytes']:
+                    raise RuntimeError(f"{result['output_file']} の大きさが書き出した行と一致しません"
+                                       f"（{entry['bytes']} / {row_offset - offset} バイト）")
+                offset += entry['bytes']
+                total_changes += result['changes']
+                total_entries += result['total']
+    finally:
+        os.close(merged_fd)
     
     print(f"\n📊 改善完了:")
-    print(f"  - 処理ファイル数: {total_files}")
+    print(f"  - 処理ファイル数: {len(tasks)}")
     print(f"  - 総改善項目数: {total_changes}")
     print(f"  - 出力ディレクトリ: {improved_dir}")
+    build_index(merged_file, entries, shuffle, seed, index_file)
+    write_index(merged_file, rows)
+    print(f"✅ マージ完了: {merged_file} ({total_entries} エントリ)")
     
-    return improved_dir
-
-def create_merged_training_file(improved_dir: Path):
-    """改善されたファイルをマージして学習用ファイルを作成"""
-    output_file = improved_dir / "wisbee_improved_all.jsonl"
-    
-    print(f"\n📦 マージファイル作成中: {output_file}")
-    
-    total_entries = 0
-    with open(output_file, 'w', encoding='utf-8') as outf:
-        for jsonl_file in sorted(improved_dir.glob('improved_*.jsonl')):
-            with open(jsonl_file, 'r', encoding='utf-8') as inf:
-                for line in inf:
-                    outf.write(line)
-                    total_entries += 1
-    
-    print(f"✅ マージ完了: {total_entries} エントリ")
-    return output_file
+    return improved_dir, merged_file
 
 def generate_improvement_report(improved_dir: Path):
     """改善レポートを生成"""
@@ -235,14 +282,23 @@ def generate_improvement_report(improved_dir: Path):
 
 def main():
     """メイン処理"""
+    parser = argparse.ArgumentParser(description="Wisbee Training Data Improvement")
+    parser.add_argument('--root', default='.',
+                        help="detailed_categorized_wisbee_data を含むデータのルートディレクトリ")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="並列プロセス数（省略時はCPUコア数）")
+    parser.add_argument('--shuffle-shards', action='store_true',
+                        help="マージファイル内でファイル単位の並び順をシャッフル")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="シャッフルの乱数シード")
+    args = parser.parse_args()
+    
     print("🚀 Wisbee Training Data Improvement")
     print("=" * 50)
     
-    # 全ファイルを処理
-    improved_dir = process_all_character_files()
-    
-    # マージファイル作成
-    merged_file = create_merged_training_file(improved_dir)
+    # 全ファイルを処理（マージファイルも同じパスで作成）
+    improved_dir, merged_file = process_all_character_files(args.root, args.workers,
+                                                            args.shuffle_shards, args.seed)
     
     # レポート生成
     generate_improvement_report(improved_dir)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+JSONLシャードのバイトオフセット索引
+
+各JSONLファイルの横に `<ファイル名>.idx` を置き、行ごとの
+(開始オフセット, バイト長, カテゴリ) を固定長レコードで保存します。
+索引とデータをmmapで開くので、N番目のサンプルを読むのに前の行を
+パースする必要がなく、ランダムアクセス・サンプリング・スライスが
+O(1)で行えます。
+
+索引にはデータファイルのサイズと更新時刻を記録し、データファイルが
+索引を書いた後に変わっていれば古い索引として扱います（JsonlIndexは
+開くのを拒否するので、index_is_current() で確かめて作り直す）。
+
+ファイル形式（リトルエンディアン）:
+  ヘッダ   magic "WJIX", version u16, 予約 u16, 行数 u64, カテゴリ表の長さ u32, 予約 u32,
+           データファイルのサイズ u64, データファイルの更新時刻 u64（ナノ秒）
+  カテゴリ表 カテゴリ名のJSON配列（UTF-8、8バイト境界までパディング）
+  レコード  offset u64, length u32, category u16, 予約 u16 の16バイト × 行数
+"""
+
+import json
+import mmap
+import os
+import random
+import struct
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from jsonl_io import loads
+
+MAGIC = b'WJIX'
+VERSION = 2
+HEADER = struct.Struct('<4sHHQIIQQ')
+RECORD = struct.Struct('<QIHH')
+INDEX_SUFFIX = '.idx'
+SCAN_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def index_path_for(jsonl_path: str) -> str:
+    """JSONLファイルに対応する索引ファイルのパス"""
+    return str(jsonl_path) + INDEX_SUFFIX
+
+
+def _data_stamp(jsonl_path: str) -> Tuple[int, int]:
+    """データファイルの (サイズ, 更新時刻ns)"""
+    stat = os.stat(jsonl_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def index_is_current(jsonl_path: str) -> bool:
+    """索引ファイルがあり、今のデータファイルに対して書かれたものならTrue"""
+    try:
+        with open(index_path_for(jsonl_path), 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, _, _, _, _, size, mtime_ns = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and (size, mtime_ns) == _data_stamp(jsonl_path)
+    except OSError:
+        return False
+
+
+def write_index(jsonl_path: str, rows: Iterable[Tuple[int, int, str]]) -> str:
+    """(offset, length, category) の列から索引ファイルを書き出す
+
+    データファイルを書き終えてから呼ぶこと（その時点のサイズと更新時刻を記録する）。
+    """
+    categories: Dict[str, int] = {}
+    records = bytearray()
+    count = 0
+    for offset, length, category in rows:
+        category_id = categories.setdefault(category, len(categories))
+        records += RECORD.pack(offset, length, category_id, 0)
+        count += 1
+
+    table = json.dumps(list(categories), ensure_ascii=False).encode('utf-8')
+    table += b' ' * (-len(table) % 8)
+
+    index_path = index_path_for(jsonl_path)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, count, len(table), 0, *_data_stamp(jsonl_path)))
+        f.write(table)
+        f.write(records)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def rows_from_lines(lines: Iterable[str], category: str, start: int = 0) -> List[Tuple[int, int, str]]:
+    """書き出す行（改行込みの文字列）から索引の行情報を作る"""
+    rows = []
+    offset = start
+    for line in lines:
+        size = len(line.encode('utf-8'))
+        rows.append((offset, size - 1 if line.endswith('\n') else size, category))
+        offset += size
+    return rows
+
+
+def build_index(jsonl_path: str, category: str = '') -> str:
+    """既存のJSONLファイルを走査して索引を作る（JSONはパースしない）"""
+    def iter_rows():
+        offset = 0
+        pending = b''
+        with open(jsonl_path, 'rb') as f:
+            for block in iter(lambda: f.read(SCAN_BLOCK_SIZE), b''):
+                data = pending + block
+                start = 0
+                while True:
+                    end = data.find(b'\n', start)
+                    if end == -1:
+                        break
+                    if end > start:
+                        yield offset + start, end - start, category
+                    start = end + 1
+                offset += start
+                pending = data[start:]
+        if pending.strip():
+            yield offset, len(pending), category
+
+    return write_index(jsonl_path, iter_rows())
+
+
+class JsonlIndex:
+    """索引付きJSONLファイルへのランダムアクセス"""
+
+    def __init__(self, jsonl_path: str):
+        self.jsonl_path = str(jsonl_path)
+        self._index_file = open(index_path_for(self.jsonl_path), 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._data_file = None
+        try:
+            if len(self._index) < HEADER.size:
+                raise ValueError(f"索引ファイルの形式が不正です: {index_path_for(self.jsonl_path)}")
+            magic, version, _, self.count, table_size, _, size, mtime_ns = HEADER.unpack_from(self._index, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"索引ファイルの形式が不正です: {index_path_for(self.jsonl_path)}")
+            table_start = HEADER.size
+            self.categories: List[str] = json.loads(self._index[table_start:table_start + table_size])
+            self._records_start = table_start + table_size
+
+            self._data_file = open(self.jsonl_path, 'rb')
+            stat = os.fstat(self._data_file.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                raise ValueError(f"索引ファイルがデータファイルより古いため使えません: {index_path_for(self.jsonl_path)}")
+        except BaseException:
+            if self._data_file is not None:
+                self._data_file.close()
+            self._index.close()
+            self._index_file.close()
+            raise
+
+        self._data = (mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+                      if stat.st_size else b'')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data_file.close()
+        self._index.close()
+        self._index_file.close()
+
+    def record(self, i: int) -> Tuple[int, int, str]:
+        """i番目の行の (offset, length, category)"""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset, length, category_id, _ = RECORD.unpack_from(self._index, self._records_start + i * RECORD.size)
+        return offset, length, self.categories[category_id]
+
+    def category(self, i: int) -> str:
+        return self.record(i)[2]
+
+    def raw(self, i: int) -> bytes:
+        """i番目の行のバイト列（改行を除く）"""
+        offset, length, _ = self.record(i)
+        return self._data[offset:offset + length]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self.count))]
+        return loads(self.raw(key))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(self.count):
+            yield self[i]
+
+    def indices_by_category(self) -> Dict[str, List[int]]:
+        """カテゴリごとの行番号"""
+        result: Dict[str, List[int]] = {}
+        for i in range(self.count):
+            result.setdefault(self.category(i), []).append(i)
+        return result
+
+    def sample(self, k: int, seed: Optional[int] = None, category: Optional[str] = None) -> List[Dict[str, Any]]:
+        """k件を非復元抽出（categoryを指定するとそのカテゴリの行からのみ）"""
+        rng = random.Random(seed)
+        if category is None:
+            population: Sequence[int] = range(self.count)
+        else:
+            population = self.indices_by_category().get(category, [])
+        return [self[i] for i in rng.sample(population, min(k, len(population)))]
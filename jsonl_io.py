@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+JSONL読み書きの共通モジュール
+
+- 読み込み: バイナリのブロック単位で読み、ブロックごとに改行で分割して
+  まとめてデコードする（行ごとの decode / strip を行わない）
+- デコード: orjson がインストールされていれば使い、無ければ標準の json。
+  orjson は任意の依存で、読み込みが速くなるのは orjson を入れた場合だけ
+  （標準のjsonでは従来の1行ずつの読み込みと同程度）。64bitに収まらない
+  整数を含みうる行だけは orjson でも標準のjsonで読む
+- エンコード: ensure_ascii=False の JSONEncoder を使い回す。
+  orjson は区切り文字の空白を出力しないため、出力のバイト列（シャードの
+  ハッシュ等）を変えないようエンコードには使わない
+- 書き込み: 行をまとめてから書き出す
+"""
+
+import json
+import os
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# 読んだブロックの行をCPUキャッシュに載ったまま処理できる大きさ（大きくしすぎると遅くなる）
+READ_BLOCK_SIZE = 64 * 1024
+WRITE_BATCH_SIZE = 1024 * 1024
+
+# orjson は64bitに収まらない整数を黙って浮動小数点数にするので、19桁以上の数字の
+# 並びを含む行は標準のjsonで読む（文字列中の数字でも読み直すだけで結果は同じ）。
+# 正規表現より速いので、bytesは数字を '0' に置き換えてから部分文字列として探す
+_DIGITS_TO_ZERO = bytes.maketrans(b'123456789', b'0' * 9)
+_LONG_DIGITS = b'0' * 19
+_LONG_DIGITS_TEXT = re.compile(r'[0-9]{19}')
+
+_ENCODER = json.JSONEncoder(ensure_ascii=False)
+_SORTED_ENCODER = json.JSONEncoder(ensure_ascii=False, sort_keys=True)
+
+
+def backend() -> str:
+    """デコードに使うライブラリ名"""
+    return 'orjson' if orjson is not None else 'json'
+
+
+def _has_long_digits(data) -> bool:
+    """19桁以上の数字の並びを含むか（bytes / str）"""
+    if isinstance(data, (bytes, bytearray)):
+        return _LONG_DIGITS in data.translate(_DIGITS_TO_ZERO)
+    return _LONG_DIGITS_TEXT.search(data) is not None
+
+
+def loads(data):
+    """JSONをデコード（bytes / str）"""
+    if orjson is not None:
+        if not _has_long_digits(data):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # 1e400・BOM・孤立サロゲートなど orjson が受け付けない入力は標準のjsonに任せる
+                pass
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> str:
+    """json.dumps(obj, ensure_ascii=False[, sort_keys=True]) と同じ文字列"""
+    return (_SORTED_ENCODER if sort_keys else _ENCODER).encode(obj)
+
+
+def dumps_lines(samples: Iterable[Any]) -> List[str]:
+    """サンプルごとの改行付きJSON文字列"""
+    encode = _ENCODER.encode
+    return [encode(sample) + '\n' for sample in samples]
+
+
+def _iter_blocks(file_path: str, start: int = 0, end: Optional[int] = None, complete_only: bool = False,
+                 block_size: int = READ_BLOCK_SIZE) -> Iterator[Tuple[int, int, List[bytes]]]:
+    """ブロックごとに (先頭行の直前の行番号, 先頭行のバイトオフセット, 改行を除いた行のリスト) を返す
+
+    空白だけの行も含む。範囲の指定は iter_lines と同じ。
+    """
+    with open(file_path, 'rb') as f:
+        # startが行の途中なら次の行から始める
+        position = start - 1 if start > 0 else 0
+        skip_partial = start > 0
+        f.seek(position)
+
+        line_num = 0
+        pending = []  # 改行がまだ来ていない行の断片（ブロックより長い行は断片を溜めてから連結する）
+        pending_size = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            position += len(block)
+            if b'\n' not in block:
+                pending.append(block)
+                pending_size += len(block)
+                continue
+            line_offset = position - len(block) - pending_size
+            if pending:
+                pending.append(block)
+                block = b''.join(pending)
+            lines = block.split(b'\n')
+            last = lines.pop()
+            pending = [last] if last else []
+            pending_size = len(last)
+
+            if skip_partial and lines:
+                skip_partial = False
+                line_offset += len(lines[0]) + 1
+                del lines[0]
+            if end is not None and position > end:
+                # このブロック内で範囲が終わる
+                offset = line_offset
+                for i, line in enumerate(lines):
+                    if offset >= end:
+                        if i:
+                            yield line_num, line_offset, lines[:i]
+                        return
+                    offset += len(line) + 1
+            if lines:
+                yield line_num, line_offset, lines
+                line_num += len(lines)
+
+        if pending and not skip_partial and not complete_only:
+            line_offset = position - pending_size
+            if end is None or line_offset < end:
+                yield line_num, line_offset, [b''.join(pending)]
+
+
+def iter_lines(file_path: str, start: int = 0, end: Optional[int] = None, complete_only: bool = False,
+               block_size: int = READ_BLOCK_SIZE) -> Iterator[Tuple[int, int, bytes]]:
+    """(行番号, 行頭のバイトオフセット, 改行を除いた行) を順に返す
+
+    空白だけの行は飛ばす（行番号には数える）。start / end を指定すると
+    行頭が [start, end) に入る行だけを返す（行番号は start からの相対）。
+    complete_only なら改行で終わっていない最終行（書き込み途中）を返さない。
+    """
+    for line_num, line_offset, lines in _iter_blocks(file_path, start, end, complete_only, block_size):
+        for line in lines:
+            line_num += 1
+            if line and not line.isspace():
+                yield line_num, line_offset, line
+            line_offset += len(line) + 1
+
+
+def line_number_at(file_path: str, offset: int) -> int:
+    """バイトオフセットoffsetにある行の行番号（1始まり）
+
+    先頭から改行を数えるので、エラー表示のように稀にしか呼ばない場面で使う。
+    """
+    newlines = 0
+    with open(file_path, 'rb') as f:
+        remaining = offset
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            newlines += block.count(b'\n')
+            remaining -= len(block)
+    return newlines + 1
+
+
+def parse_line(line: bytes):
+    """1行をデコード（失敗時は ValueError）。空行相当ならNone"""
+    try:
+        return loads(line)
+    except ValueError:
+        # 全角スペースなど、JSONの空白ではないが str.strip() が取り除く文字を許容する
+        text = line.decode('utf-8').strip()
+        if not text:
+            return None
+        return json.loads(text)
+
+
+def iter_jsonl(file_path: str, on_error: Optional[Callable[[int, Exception], None]] = None,
+               **kwargs) -> Iterator[Dict[str, Any]]:
+    """JSONLファイルのサンプルを順に返す（デコードできない行は on_error(行番号, 例外) に渡して飛ばす）
+
+    行ごとの関数呼び出しを減らすため、ブロック単位でデコーダを直接呼ぶ。
+    失敗した行（空白だけの行を含む）だけ parse_line で読み直す。
+    """
+    fast_loads = orjson.loads if orjson is not None else None
+    std_loads = json.loads
+    for first_line, _, lines in _iter_blocks(file_path, **kwargs):
+        # 19桁以上の数字の並びがないブロックは、行ごとに確かめずに orjson で読む
+        check = fast_loads is not None and _has_long_digits(b'\n'.join(lines))
+        samples = []
+        append = samples.append
+        for line_num, line in enumerate(lines, first_line + 1):
+            try:
+                if fast_loads is not None and not (check and _has_long_digits(line)):
+                    append(fast_loads(line))
+                else:
+                    append(std_loads(line.decode('utf-8')))
+            except ValueError:
+                try:
+                    sample = parse_line(line)
+                except ValueError as e:
+                    if on_error is not None:
+                        on_error(line_num, e)
+                    continue
+                if sample is not None:
+                    append(sample)
+        yield from samples
+
+
+def iter_jsonl_file(file_path: str) -> Iterator[Dict[str, Any]]:
+    """JSONLファイルを読み込み、サンプルを順に返す（エラーは表示して続行）"""
+    if not os.path.exists(file_path):
+        print(f"ファイルが見つかりません: {file_path}")
+        return
+
+    def report(line_num, e):
+        print(f"JSONデコードエラー {file_path}:{line_num}: {e}")
+
+    try:
+        yield from iter_jsonl(file_path, on_error=report)
+    except Exception as e:
+        print(f"ファイル読み込みエラー {file_path}: {e}")
+
+
+def load_jsonl_file(file_path: str) -> List[Dict[str, Any]]:
+    """JSONLファイルを読み込み、データのリストを返す"""
+    return list(iter_jsonl_file(file_path))
+
+
+class JsonlWriter:
+    """行をまとめて書き出すJSONLライター"""
+
+    def __init__(self, file_path: str, batch_size: int = WRITE_BATCH_SIZE):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self._file = open(file_path, 'w', encoding='utf-8', newline='\n')
+        self._batch: List[str] = []
+        self._batch_chars = 0
+
+    def write(self, sample: Any) -> str:
+        """サンプルを1行として書き、書いた行を返す"""
+        line = _ENCODER.encode(sample) + '\n'
+        self.write_line(line)
+        return line
+
+    def write_line(self, line: str):
+        """エンコード済みの行（改行付き）を書く"""
+        self._batch.append(line)
+        self._batch_chars += len(line)
+        if self._batch_chars >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._file.write(''.join(self._batch))
+            self._batch = []
+            self._batch_chars = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
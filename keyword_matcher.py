@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+複数キーワード一括マッチャー
+
+Aho-Corasick法でキーワード群からオートマトンを一度だけ構築し、
+テキストを1回走査するだけで含まれる全キーワードを検出します。
+キーワード数やカテゴリ数が増えても、1サンプルあたりのコストは
+テキスト長にしか比例しません。
+"""
+
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+
+class KeywordMatcher:
+    """Aho-Corasickオートマトンによる部分文字列キーワード検出"""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = list(dict.fromkeys(keywords))
+
+        # トライ木: 状態ごとの遷移・失敗リンク・出力キーワード
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Set[str]] = [set()]
+
+        for keyword in self.keywords:
+            state = 0
+            for ch in keyword:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(set())
+                    self._goto[state][ch] = next_state
+                state = next_state
+            self._output[state].add(keyword)
+
+        # 幅優先で失敗リンクを張り、出力を失敗先から継承
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] |= self._output[self._fail[next_state]]
+
+        # 失敗リンクを辿った結果をキャッシュする決定性遷移表（遅延構築）
+        # キーワードに現れない文字は常に初期状態へ戻るためキャッシュしない
+        self._alphabet = frozenset(ch for keyword in self.keywords for ch in keyword)
+        self._delta: List[Dict[str, int]] = [dict(transitions) for transitions in self._goto]
+        # 出力のある状態だけを記録（走査中の集合操作を減らす）
+        self._outputs = {state: frozenset(out) for state, out in enumerate(self._output) if out}
+
+    def _transition(self, state: int, ch: str) -> int:
+        """失敗リンクを辿って遷移先を求め、結果をキャッシュ"""
+        origin = state
+        while True:
+            next_state = self._goto[state].get(ch)
+            if next_state is not None:
+                break
+            if state == 0:
+                next_state = 0
+                break
+            state = self._fail[state]
+        self._delta[origin][ch] = next_state
+        return next_state
+
+    def find_all(self, text: str) -> Set[str]:
+        """テキストに含まれるキーワードの集合を返す（`keyword in text` と同じ判定）"""
+        found = set(self._output[0])  # 空文字列キーワードは常に一致
+        delta = self._delta
+        outputs = self._outputs
+        alphabet = self._alphabet
+        state = 0
+
+        for ch in text:
+            next_state = delta[state].get(ch)
+            if next_state is None:
+                next_state = self._transition(state, ch) if ch in alphabet else 0
+            state = next_state
+            if state in outputs:
+                found |= outputs[state]
+
+        return found
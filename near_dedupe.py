@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+ニア重複検出（MinHash / LSH）
+
+完全一致のハッシュでは拾えない「絵文字や語尾だけが違う」サンプルを
+文字n-gramのMinHash署名で近似的に比較し、LSHバンディングで候補だけを
+照合します。全ペア比較をしないため、サンプル数が増えても1件あたりの
+コストはほぼ一定です。
+
+サンプル本体は保持せず、代表サンプルの署名とバンド表だけをメモリに
+置くので、ストリーミング処理で数百万件規模にも対応できます。
+"""
+
+import json
+import random
+import unicodedata
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from jsonl_io import dumps
+
+MERSENNE_PRIME = (1 << 61) - 1
+HASH_MASK = 0xFFFFFFFF
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 64
+DEFAULT_NGRAM_SIZE = 3  # 日本語は単語区切りがないため文字3-gramを使用
+
+
+def sample_text(sample: Dict[str, Any]) -> str:
+    """サンプルから比較用のテキストを抽出"""
+    text = ""
+    if 'conversations' in sample:
+        for conv in sample['conversations']:
+            text += conv.get('value', '') + " "
+    elif 'instruction' in sample and 'output' in sample:
+        text += sample.get('instruction', '') + " " + sample.get('input', '') + " " + sample['output']
+    elif 'messages' in sample:
+        for msg in sample['messages']:
+            text += msg.get('content', '') + " "
+    elif 'text' in sample:
+        text += sample['text']
+    else:
+        text = dumps(sample, sort_keys=True)
+    return text
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角と大文字・小文字を揃え、空白を取り除く"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(text.split())
+
+
+def char_ngrams(text: str, n: int = DEFAULT_NGRAM_SIZE) -> Set[str]:
+    """文字n-gramの集合（n文字未満のテキストは全体を1要素とする）"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """しきい値付近で偽陽性・偽陰性の合計が最小になる (バンド数, 行数) を選ぶ"""
+    def area(func, lower, upper, steps=100):
+        width = (upper - lower) / steps
+        return sum(func(lower + (i + 0.5) * width) for i in range(steps)) * width
+
+    best, best_error = (num_perm, 1), float('inf')
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positive = area(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+            false_negative = area(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+            error = false_positive + false_negative
+            if error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class NearDuplicateDetector:
+    """MinHash署名とLSHバンド表によるストリーミングなニア重複判定"""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = DEFAULT_NUM_PERM,
+                 ngram_size: int = DEFAULT_NGRAM_SIZE, seed: int = 1, max_examples: int = 5):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ngram_size = ngram_size
+        self.max_examples = max_examples
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+        if np is not None:
+            # a を上位・下位32bitに分け、uint64 の範囲で (a * h + b) mod p を計算する
+            a = np.array([a for a, _ in self._perms], dtype=np.uint64)[:, None]
+            self._a_high, self._a_low = a >> np.uint64(32), a & np.uint64(HASH_MASK)
+            self._b = np.array([b for _, b in self._perms], dtype=np.uint64)[:, None]
+
+        # 代表サンプルの署名を1本の配列に連結して保持（1件あたり num_perm * 4 バイト）
+        self._signatures = array('I')
+        self._rep_indices = array('Q')
+        # (バンド番号, バンドの署名) のハッシュ → そのバンドを持つ代表サンプルの通し番号
+        self._buckets: Dict[int, List[int]] = {}
+
+        self.processed = 0
+        self.duplicates = 0
+        self.clusters: Dict[int, Dict[str, Any]] = {}
+
+    def signature(self, text: str) -> Optional[array]:
+        """正規化済みテキストのMinHash署名（n-gramが無ければNone）"""
+        grams = char_ngrams(normalize_text(text), self.ngram_size)
+        if not grams:
+            return None
+        hashes = [zlib.crc32(gram.encode('utf-8')) for gram in grams]
+        if np is None:
+            return array('I', (min([(a * h + b) % MERSENNE_PRIME for h in hashes]) & HASH_MASK
+                               for a, b in self._perms))
+        return array('I', self._minhash(np.array(hashes, dtype=np.uint64)).tobytes())
+
+    def _minhash(self, hashes):
+        """全置換 × 全n-gramの (a * h + b) mod p の最小値を配列演算で求める（結果は整数演算と同じ）"""
+        p = np.uint64(MERSENNE_PRIME)
+
+        def mod_p(x):
+            # 2^61 ≡ 1 (mod p) を使って畳み込む（x < 2^64）
+            x = (x & p) + (x >> np.uint64(61))
+            return np.where(x >= p, x - p, x)
+
+        # a * h = a_high * h * 2^32 + a_low * h（a_high < 2^29, h < 2^32）
+        high = self._a_high * hashes[None, :]
+        # high * 2^32 = (high >> 29) * 2^61 + (high の下位29bit) * 2^32 ≡ (high >> 29) + 下位29bit * 2^32
+        high = mod_p((high >> np.uint64(29)) + ((high & np.uint64((1 << 29) - 1)) << np.uint64(32)))
+        low = mod_p(self._a_low * hashes[None, :])
+        values = mod_p(mod_p(high + low) + self._b)
+        return (values.min(axis=1) & np.uint64(HASH_MASK)).astype(np.uint32)
+
+    def _band_keys(self, signature: array) -> List[int]:
+        return [hash((band, signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+                for band in range(self.bands)]
+
+    def _similarity(self, signature: array, rep: int) -> float:
+        start = rep * self.num_perm
+        stored = self._signatures[start:start + self.num_perm]
+        return sum(1 for x, y in zip(signature, stored) if x == y) / self.num_perm
+
+    def _best_match(self, signature: array, reps: List[int]) -> Tuple[Optional[int], float]:
+        """候補の代表のうち推定類似度が最大のもの（同点なら通し番号の小さい方）"""
+        if not reps:
+            return None, 0.0
+        if np is None:
+            best_rep, best_similarity = None, 0.0
+            for rep in reps:
+                similarity = self._similarity(signature, rep)
+                if similarity > best_similarity:
+                    best_rep, best_similarity = rep, similarity
+            return best_rep, best_similarity
+
+        stored = np.frombuffer(self._signatures, dtype=np.uint32).reshape(-1, self.num_perm)[reps]
+        similarities = (stored == np.frombuffer(signature, dtype=np.uint32)).sum(axis=1) / self.num_perm
+        best = int(similarities.argmax())
+        return reps[best], float(similarities[best])
+
+    def add(self, text: str) -> Tuple[Optional[int], float]:
+        """テキストを登録し、ニア重複なら (代表の入力番号, 推定類似度) を返す
+
+        重複でなければ代表として登録し (None, 1.0) を返す。
+        """
+        index = self.processed
+        self.processed += 1
+
+        signature = self.signature(text)
+        if signature is None:
+            return None, 1.0
+
+        keys = self._band_keys(signature)
+        # どのバンドで一致した代表とも比較する（バンドごとに最初の代表だけでは取りこぼす）
+        candidates = set()
+        for key in keys:
+            candidates.update(self._buckets.get(key, ()))
+        best_rep, best_similarity = self._best_match(signature, sorted(candidates))
+
+        if best_rep is not None and best_similarity >= self.threshold:
+            self.duplicates += 1
+            rep_index = self._rep_indices[best_rep]
+            cluster = self.clusters.setdefault(rep_index, {'size': 1, 'members': []})
+            cluster['size'] += 1
+            if len(cluster['members']) < self.max_examples:
+                cluster['members'].append({
+                    'index': index,
+                    'similarity': round(best_similarity, 3),
+                    'preview': text[:80]
+                })
+            return rep_index, best_similarity
+
+        rep = len(self._rep_indices)
+        self._rep_indices.append(index)
+        self._signatures.extend(signature)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(rep)
+        return None, 1.0
+
+    def report(self) -> Dict[str, Any]:
+        """クラスタレポート（大きいクラスタ順）"""
+        clusters = sorted(self.clusters.items(), key=lambda x: x[1]['size'], reverse=True)
+        return {
+            'threshold': self.threshold,
+            'num_perm': self.num_perm,
+            'bands': self.bands,
+            'rows': self.rows,
+            'ngram_size': self.ngram_size,
+            'total_samples': self.processed,
+            'near_duplicates_removed': self.duplicates,
+            'total_clusters': len(clusters),
+            'clusters': [
+                {'representative_index': rep_index, **cluster}
+                for rep_index, cluster in clusters
+            ]
+        }
+
+    def write_report(self, path: str) -> Dict[str, Any]:
+        """クラスタレポートをJSONで保存"""
+        report = self.report()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+def iter_near_unique(samples: Iterable[Dict[str, Any]],
+                     detector: NearDuplicateDetector) -> Iterator[Dict[str, Any]]:
+    """ニア重複を除いたサンプルを順に返す（先に現れたものを代表として残す）
+
+    ニア重複の組のどちらが残るかは流す順序で決まる。順序に左右されたくない
+    場合は、安定したキー（入力ファイルと行番号、内容ハッシュなど）で並べてから渡す。
+    """
+    for sample in samples:
+        rep_index, _ = detector.add(sample_text(sample))
+        if rep_index is None:
+            yield sample
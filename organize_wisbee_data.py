@@ -4,35 +4,51 @@ Wisbeeトレーニングデータ整理スクリプト
 
 既存のWisbeeトレーニングデータを収集し、カテゴリ別に分類して
 100サンプルごとのチャンクに分割します。
+
+読み込み → 重複除去 → 分類 → チャンク書き出しをジェネレータで
+1サンプルずつ流すため、メモリ使用量はコーパスサイズに依存しません。
 """
 
+import argparse
 import json
 import os
 import re
-from collections import defaultdict
 import hashlib
 
-def load_jsonl_file(file_path):
-    """JSONLファイルを読み込み、データのリストを返す"""
-    if not os.path.exists(file_path):
-        print(f"ファイルが見つかりません: {file_path}")
-        return []
-    
-    data = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if line:
-                    try:
-                        item = json.loads(line)
-                        data.append(item)
-                    except json.JSONDecodeError as e:
-                        print(f"JSONデコードエラー {file_path}:{line_num}: {e}")
-    except Exception as e:
-        print(f"ファイル読み込みエラー {file_path}: {e}")
-    
-    return data
+from keyword_matcher import KeywordMatcher
+from near_dedupe import NearDuplicateDetector, iter_near_unique
+from dedupe_index import DedupeIndex
+from jsonl_index import index_path_for, rows_from_lines, write_index
+from jsonl_io import dumps, dumps_lines, iter_jsonl_file
+from shard_packer import (
+    fixed_ranges, load_shard_manifest, measure, pack_balanced, shard_entry, write_shard_manifest,
+)
+
+# カテゴリ判定用キーワード（先に一致したカテゴリが優先）
+CATEGORY_KEYWORDS = [
+    # Hamada関連（特定のキャラクター）
+    ('hamada', ['hamada', 'ハマダ', '浜田']),
+    # プログラミング関連
+    ('programming', [
+        'python', 'javascript', 'html', 'css', 'プログラミング', 'コード', 'バグ', 
+        'デバッグ', 'アルゴリズム', 'データ構造', '関数', 'クラス', 'オブジェクト',
+        'api', 'フレームワーク', 'ライブラリ', 'git', 'github', 'sql', 'database'
+    ]),
+    # 科学・数学関連
+    ('science_math', [
+        '数学', '物理', '化学', '生物', '科学', '実験', '理論', '公式', '方程式',
+        '統計', '確率', '微積分', '代数', '幾何', '量子', '相対性理論', 'dna'
+    ]),
+    # アート・文化関連
+    ('art_culture', [
+        'アート', '芸術', '美術', '音楽', '文学', '詩', '小説', '映画', '演劇',
+        '絵画', '彫刻', 'デザイン', '文化', '歴史', '哲学', '宗教', '伝統'
+    ]),
+]
+
+CATEGORY_MATCHER = KeywordMatcher(
+    keyword for _, keywords in CATEGORY_KEYWORDS for keyword in keywords
+)
 
 def categorize_sample(sample):
     """サンプルをカテゴリに分類"""
@@ -48,80 +64,216 @@ def categorize_sample(sample):
     
     text = text.lower()
     
-    # プログラミング関連
-    programming_keywords = [
-        'python', 'javascript', 'html', 'css', 'プログラミング', 'コード', 'バグ', 
-        'デバッグ', 'アルゴリズム', 'データ構造', '関数', 'クラス', 'オブジェクト',
-        'api', 'フレームワーク', 'ライブラリ', 'git', 'github', 'sql', 'database'
-    ]
-    
-    # 科学・数学関連
-    science_keywords = [
-        '数学', '物理', '化学', '生物', '科学', '実験', '理論', '公式', '方程式',
-        '統計', '確率', '微積分', '代数', '幾何', '量子', '相対性理論', 'dna'
-    ]
+    # 定義順に、いずれかのキーワードを含む最初のカテゴリを採用
+    matched = CATEGORY_MATCHER.find_all(text)
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(keyword in matched for keyword in keywords):
+            return category
+    return 'general'
+
+def create_chunks(data, chunk_size=100, budget=None, unit='bytes'):
+    """データを指定サイズのチャンクに分割（budgetを指定するとバイト数・推定トークン数の予算で分割）"""
+    if budget is None:
+        ranges = fixed_ranges(len(data), chunk_size)
+    else:
+        ranges = pack_balanced([measure(line, unit) for line in dumps_lines(data)], budget)
+    return [data[start:end] for start, end in ranges]
+
+def chunk_path(base_dir, category, chunk_num):
+    """チャンクファイルのパス"""
+    return os.path.join(base_dir, category, f"{category}_chunk_{chunk_num:03d}.jsonl")
+
+def write_chunk(category, chunk_num, chunk, base_dir, lines=None):
+    """1チャンクをファイルに保存（linesにエンコード済みの行を渡すと再エンコードしない）"""
+    os.makedirs(os.path.join(base_dir, category), exist_ok=True)
+    filepath = chunk_path(base_dir, category, chunk_num)
     
-    # アート・文化関連
-    art_keywords = [
-        'アート', '芸術', '美術', '音楽', '文学', '詩', '小説', '映画', '演劇',
-        '絵画', '彫刻', 'デザイン', '文化', '歴史', '哲学', '宗教', '伝統'
-    ]
+    if lines is None:
+        lines = dumps_lines(chunk)
+    with open(filepath, 'w', encoding='utf-8', newline='\n') as f:
+        f.writelines(lines)
+    # 行ごとのオフセット索引（ランダムアクセス用）
+    write_index(filepath, rows_from_lines(lines, category))
     
-    # Hamada関連（特定のキャラクター）
-    hamada_keywords = ['hamada', 'ハマダ', '浜田']
-    
-    # キーワードチェック
-    if any(keyword in text for keyword in hamada_keywords):
-        return 'hamada'
-    elif any(keyword in text for keyword in programming_keywords):
-        return 'programming'
-    elif any(keyword in text for keyword in science_keywords):
-        return 'science_math'
-    elif any(keyword in text for keyword in art_keywords):
-        return 'art_culture'
-    else:
-        return 'general'
+    print(f"保存完了: {filepath} ({len(chunk)}サンプル)")
+    return filepath
 
-def create_chunks(data, chunk_size=100):
-    """データを指定サイズのチャンクに分割"""
-    chunks = []
-    for i in range(0, len(data), chunk_size):
-        chunks.append(data[i:i + chunk_size])
-    return chunks
+def remove_stale_chunks(base_dir, chunk_counts):
+    """作り直した出力に残る、以前の実行で書かれた今回より後ろの番号のチャンクを削除"""
+    for category in sorted(os.listdir(base_dir)):
+        category_dir = os.path.join(base_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        pattern = re.compile(rf"^{re.escape(category)}_chunk_(\d+)\.jsonl$")
+        for name in sorted(os.listdir(category_dir)):
+            match = pattern.match(name)
+            if match and int(match.group(1)) > chunk_counts.get(category, 0):
+                filepath = os.path.join(category_dir, name)
+                os.remove(filepath)
+                if os.path.exists(index_path_for(filepath)):
+                    os.remove(index_path_for(filepath))
+                print(f"削除: {filepath}")
 
 def save_chunks(category, chunks, base_dir):
     """チャンクをファイルに保存"""
-    category_dir = os.path.join(base_dir, category)
-    os.makedirs(category_dir, exist_ok=True)
-    
     for i, chunk in enumerate(chunks, 1):
-        filename = f"{category}_chunk_{i:03d}.jsonl"
-        filepath = os.path.join(category_dir, filename)
+        write_chunk(category, i, chunk, base_dir)
+
+class ChunkWriter:
+    """カテゴリ別のチャンクを、chunk_sizeに達した時点で書き出す
+    
+    budgetを指定すると件数ではなく1チャンクあたりのバイト数・推定トークン数
+    （unit）の予算で区切る。最後の満杯のチャンクは書き出しを1つ遅らせ、
+    close時に端数と合わせて均等に分け直す（小さな端数チャンクを作らない）。
+    
+    chunk_counts（追記モード）を渡すと、前回の最後のチャンクが埋まっていない
+    カテゴリはそのチャンクを読み込んで続きから詰め、同じ番号で書き直す
+    （追記のたびに小さなチャンクが増えないように）。
+    """
+    
+    def __init__(self, base_dir, chunk_size=100, chunk_counts=None, budget=None, unit='bytes'):
+        self.base_dir = base_dir
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.unit = unit
+        self.buffers = {}
+        # 予算モードで書き出しを保留している直前のチャンク（行, 大きさ）
+        self.held = {}
+        self.buffer_sizes = {}
+        # 追記モードでは既存チャンクの続き番号から書き出す
+        self.chunk_counts = dict(chunk_counts or {})
+        self.sample_counts = {}
+        self.shards = []
+    
+    def add(self, category, sample):
+        """サンプルを追加し、チャンクが埋まったら保存"""
+        if category not in self.buffers:
+            self.buffers[category] = []
+            self.held[category] = []
+            self.buffer_sizes[category] = 0
+            self.chunk_counts.setdefault(category, 0)
+            self.sample_counts[category] = 0
+            self._top_up(category)
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            for item in chunk:
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        buffer = self.buffers[category]
+        self.sample_counts[category] += 1
+        if self.budget is None:
+            buffer.append(sample)
+            if len(buffer) >= self.chunk_size:
+                self._flush(category)
+            return
         
-        print(f"保存完了: {filepath} ({len(chunk)}サンプル)")
+        line = dumps(sample) + '\n'
+        size = measure(line, self.unit)
+        if buffer and self.buffer_sizes[category] + size > self.budget:
+            # 保留中のチャンクを書き出し、埋まったチャンクを新たに保留する
+            self._write_held(category)
+            self.held[category] = buffer
+            buffer = self.buffers[category] = []
+            self.buffer_sizes[category] = 0
+        buffer.append((sample, line, size))
+        self.buffer_sizes[category] += size
+    
+    def close(self):
+        """残りの端数チャンクを保存"""
+        for category, buffer in self.buffers.items():
+            if self.budget is not None:
+                items = self.held[category] + buffer
+                self.held[category] = []
+                for start, end in pack_balanced([size for _, _, size in items], self.budget):
+                    self._write(category, items[start:end])
+                self.buffers[category] = []
+            elif buffer:
+                self._flush(category)
+    
+    def _top_up(self, category):
+        """前回の最後のチャンクが埋まっていなければ、バッファに読み込んで続きから詰める"""
+        last = self.chunk_counts[category]
+        filepath = chunk_path(self.base_dir, category, last)
+        if not last or not os.path.exists(filepath):
+            return
+        samples = list(iter_jsonl_file(filepath))
+        if self.budget is None:
+            if len(samples) >= self.chunk_size:
+                return
+            self.buffers[category] = samples
+        else:
+            lines = dumps_lines(samples)
+            items = [(sample, line, measure(line, self.unit)) for sample, line in zip(samples, lines)]
+            size = sum(item_size for _, _, item_size in items)
+            if size >= self.budget:
+                return
+            self.buffers[category] = items
+            self.buffer_sizes[category] = size
+        self.chunk_counts[category] = last - 1
+        print(f"追記: {filepath} の続きから詰めます（{len(samples)}サンプル）")
+    
+    def _write_held(self, category):
+        if self.held[category]:
+            self._write(category, self.held[category])
+            self.held[category] = []
+    
+    def _write(self, category, items):
+        """予算モードのチャンク（サンプル, 行, 大きさ）を保存"""
+        self.chunk_counts[category] += 1
+        lines = [line for _, line, _ in items]
+        filepath = write_chunk(category, self.chunk_counts[category], [sample for sample, _, _ in items],
+                               self.base_dir, lines)
+        self.shards.append(shard_entry(self.base_dir, filepath, category, lines))
+    
+    def _flush(self, category):
+        self.chunk_counts[category] += 1
+        chunk = self.buffers[category]
+        lines = dumps_lines(chunk)
+        filepath = write_chunk(category, self.chunk_counts[category], chunk, self.base_dir, lines)
+        self.shards.append(shard_entry(self.base_dir, filepath, category, lines))
+        self.buffers[category] = []
 
-def remove_duplicates(data):
-    """重複するサンプルを除去"""
+def sample_hash(item):
+    """サンプルの内容ハッシュ（キー順に依存しない）"""
+    content = dumps(item, sort_keys=True)
+    return hashlib.md5(content.encode()).hexdigest()
+
+def iter_unique(samples, index=None):
+    """重複するサンプルを除去しながら順に返す
+    
+    indexを渡すと、過去の実行で登録済みのサンプルも重複として除去する。
+    """
     seen_hashes = set()
-    unique_data = []
     
-    for item in data:
+    for item in samples:
         # サンプルの内容をハッシュ化
-        content = json.dumps(item, sort_keys=True, ensure_ascii=False)
-        content_hash = hashlib.md5(content.encode()).hexdigest()
+        content_hash = sample_hash(item)
         
-        if content_hash not in seen_hashes:
+        if index is not None:
+            if index.add(bytes.fromhex(content_hash)):
+                yield item
+        elif content_hash not in seen_hashes:
             seen_hashes.add(content_hash)
-            unique_data.append(item)
-    
-    return unique_data
+            yield item
+
+def remove_duplicates(data):
+    """重複するサンプルを除去"""
+    return list(iter_unique(data))
 
 def main():
     """メイン処理"""
+    parser = argparse.ArgumentParser(description="Wisbeeトレーニングデータ整理")
+    parser.add_argument('--near-dup-threshold', type=float, default=None,
+                        help="指定するとMinHashでニア重複も除去（推定Jaccard類似度のしきい値、例: 0.8）")
+    parser.add_argument('--index', default=None,
+                        help="永続重複インデックスのディレクトリ（指定すると前回以降の追加分だけを処理して追記）")
+    budget_group = parser.add_mutually_exclusive_group()
+    budget_group.add_argument('--shard-bytes', type=int, default=None,
+                              help="100件ごとではなく1チャンクあたりのバイト数の予算で分割")
+    budget_group.add_argument('--shard-tokens', type=int, default=None,
+                              help="100件ごとではなく1チャンクあたりの推定トークン数の予算で分割")
+    args = parser.parse_args()
+    shard_budget = args.shard_bytes if args.shard_bytes is not None else args.shard_tokens
+    budget_unit = 'bytes' if args.shard_bytes is not None else 'tokens'
+    if shard_budget is not None and shard_budget <= 0:
+        parser.error("チャンクの予算は正の値を指定してください")
+    
     print("🐝 Wisbeeトレーニングデータ整理開始")
     
     # 入力ファイルのリスト
@@ -135,75 +287,129 @@ def main():
         'wisbee_model_nft_training_data.jsonl'
     ]
     
-    # 全データを収集
-    all_data = []
+    # 出力ディレクトリの準備
+    output_dir = "organized_wisbee_data"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    stats_file = os.path.join(output_dir, 'organization_stats.json')
+    index = None
+    previous = {}
+    if args.index:
+        index = DedupeIndex(args.index)
+        print(f"📇 重複インデックス: {args.index}（登録済み {len(index):,}件）")
+        if os.path.exists(stats_file):
+            with open(stats_file, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        # 出力がこのインデックスと一緒に作られたものでなければ追記しない
+        if previous and not index.matches(previous.get('index')):
+            if len(index):
+                parser.error(f"{output_dir} は重複インデックス {args.index} と対応していません"
+                             "（別のインデックスか、インデックスなしで作られた出力です）。"
+                             "新しいインデックスのディレクトリを指定して作り直してください")
+            print("   新しいインデックスのため、出力を追記せずに作り直します")
+            previous = {}
+    previous_categories = previous.get('categories', {})
+    
     file_stats = {}
+    counts = {'original': 0}
     
-    for file_path in input_files:
-        print(f"\n📁 ファイル処理中: {file_path}")
-        data = load_jsonl_file(file_path)
-        file_stats[file_path] = len(data)
-        all_data.extend(data)
-        print(f"   読み込み完了: {len(data)}サンプル")
+    def iter_all_samples():
+        """全入力ファイルのサンプルを順に流す"""
+        for file_path in input_files:
+            print(f"\n📁 ファイル処理中: {file_path}")
+            file_stats[file_path] = 0
+            samples = index.iter_new_samples(file_path) if index is not None else iter_jsonl_file(file_path)
+            for sample in samples:
+                file_stats[file_path] += 1
+                counts['original'] += 1
+                yield sample
+            print(f"   読み込み完了: {file_stats[file_path]}サンプル")
     
-    print(f"\n📊 総データ数: {len(all_data)}サンプル")
+    # 読み込み → 重複除去 → 分類 → チャンク保存を1パスで実行
+    print(f"\n💾 重複除去・分類・保存中（{output_dir}ディレクトリ）...")
+    writer = ChunkWriter(output_dir, chunk_size=100, chunk_counts={
+        category: info['total_chunks'] for category, info in previous_categories.items()
+    }, budget=shard_budget, unit=budget_unit)
+    samples = iter_unique(iter_all_samples(), index)
+    detector = None
+    if args.near_dup_threshold is not None:
+        # 分類より前に、input_files の順・各ファイルの行順で流すので、ニア重複の組では
+        # この順で先に現れたサンプルが残る（カテゴリの並びには左右されない）
+        detector = NearDuplicateDetector(threshold=args.near_dup_threshold)
+        samples = iter_near_unique(samples, detector)
+    for sample in samples:
+        writer.add(categorize_sample(sample), sample)
+    writer.close()
+    if not previous:
+        remove_stale_chunks(output_dir, writer.chunk_counts)
+    if index is not None:
+        # 出力を書き終えてからインデックスを確定させる
+        index_record = index.record()
+        index.save()
+        index.close()
     
-    # 重複除去
-    print("\n🔄 重複除去中...")
-    unique_data = remove_duplicates(all_data)
-    print(f"   重複除去後: {len(unique_data)}サンプル")
-    print(f"   除去された重複: {len(all_data) - len(unique_data)}サンプル")
+    total_original = counts['original']
+    total_unique = sum(writer.sample_counts.values())
     
-    # カテゴリ別分類
-    print("\n📂 カテゴリ別分類中...")
-    categorized_data = defaultdict(list)
+    print(f"\n📊 総データ数: {total_original}サンプル")
+    print(f"   重複除去後: {total_unique}サンプル")
+    print(f"   除去された重複: {total_original - total_unique}サンプル")
     
-    for sample in unique_data:
-        category = categorize_sample(sample)
-        categorized_data[category].append(sample)
+    if detector is not None:
+        report_file = os.path.join(output_dir, 'near_duplicate_report.json')
+        report = detector.write_report(report_file)
+        print(f"   うちニア重複: {detector.duplicates}サンプル（{report['total_clusters']}クラスタ）")
+        print(f"   クラスタレポート: {report_file}")
     
     # 分類結果の表示
     print("\n📈 分類結果:")
-    total_samples = 0
-    for category, data in categorized_data.items():
-        print(f"   {category}: {len(data)}サンプル")
-        total_samples += len(data)
-    
-    print(f"   合計: {total_samples}サンプル")
-    
-    # 出力ディレクトリの準備
-    output_dir = "organized_wisbee_data"
-    os.makedirs(output_dir, exist_ok=True)
+    for category, count in writer.sample_counts.items():
+        print(f"   {category}: {count}サンプル")
+    print(f"   合計: {total_unique}サンプル")
     
-    # カテゴリ別にチャンク分割して保存
-    print(f"\n💾 データ保存中（{output_dir}ディレクトリ）...")
-    chunk_info = {}
+    if previous:
+        # 追記モードでは前回までの統計に今回の分を加算
+        print(f"   （今回の追加分。累計は {previous['total_unique_samples'] + total_unique}サンプル）")
+        for file_path, count in previous.get('input_files', {}).items():
+            file_stats[file_path] = file_stats.get(file_path, 0) + count
+        total_original += previous['total_original_samples']
+        total_unique += previous['total_unique_samples']
     
-    for category, data in categorized_data.items():
-        print(f"\n📝 {category}カテゴリ処理中...")
-        chunks = create_chunks(data, chunk_size=100)
-        save_chunks(category, chunks, output_dir)
-        chunk_info[category] = {
-            'total_samples': len(data),
-            'total_chunks': len(chunks),
-            'samples_per_chunk': 100
-        }
+    chunk_info = {category: dict(info) for category, info in previous_categories.items()}
+    for category, count in writer.sample_counts.items():
+        info = chunk_info.setdefault(category, {'total_samples': 0, 'total_chunks': 0,
+                                                'samples_per_chunk': 100 if shard_budget is None else None})
+        info['total_samples'] += count
+        info['total_chunks'] = writer.chunk_counts[category]
     
     # 統計情報をJSONファイルに保存
     stats = {
         'input_files': file_stats,
-        'total_original_samples': len(all_data),
-        'total_unique_samples': len(unique_data),
-        'duplicates_removed': len(all_data) - len(unique_data),
+        'total_original_samples': total_original,
+        'total_unique_samples': total_unique,
+        'duplicates_removed': total_original - total_unique,
+        'near_duplicates_removed': previous.get('near_duplicates_removed', 0) + (detector.duplicates if detector is not None else 0),
         'categories': chunk_info,
         'output_directory': output_dir
     }
+    if index is not None:
+        # 次回の追記時に、同じインデックスで作った出力か確かめるための識別情報
+        stats['index'] = index_record
     
-    stats_file = os.path.join(output_dir, 'organization_stats.json')
     with open(stats_file, 'w', encoding='utf-8') as f:
         json.dump(stats, f, ensure_ascii=False, indent=2)
     
+    # チャンクごとの大きさの一覧（追記モードでは前回までのチャンクも含める）
+    shards = writer.shards
+    if previous:
+        written = {shard['path'] for shard in shards}
+        shards = [shard for shard in load_shard_manifest(output_dir).get('shards', [])
+                  if shard['path'] not in written] + shards
+    shard_manifest = write_shard_manifest(output_dir, shards, shard_budget, budget_unit, 100)
+    
     print(f"\n📊 統計情報を保存: {stats_file}")
+    print(f"   チャンク一覧: {shard_manifest['total_shards']}チャンク "
+          f"({shard_manifest['min_bytes']:,}〜{shard_manifest['max_bytes']:,} bytes)")
     print("\n✅ データ整理完了！")
     
     # サマリーの表示
@@ -211,8 +417,8 @@ def main():
     print("📋 整理サマリー")
     print("="*50)
     print(f"入力ファイル数: {len(input_files)}")
-    print(f"元データ総数: {len(all_data):,}サンプル")
-    print(f"重複除去後: {len(unique_data):,}サンプル")
+    print(f"元データ総数: {total_original:,}サンプル")
+    print(f"重複除去後: {total_unique:,}サンプル")
     print(f"出力ディレクトリ: {output_dir}")
     print("\nカテゴリ別内訳:")
     for category, info in chunk_info.items():
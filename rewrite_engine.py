@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+コンパイル済み置換エンジン
+
+(パターン, 置換文字列) の順序付きリストを一度だけコンパイルし、
+「上から順に re.sub を適用する」のと同じ結果を、できるだけ少ない
+走査回数で得ます。
+
+隣り合うルールは、一括置換しても逐次適用と結果が変わらないと
+判定できる限り1本の選択（alternation）正規表現にまとめます。
+次の場合はそこで段（ステージ）を区切り、逐次の意味を保ちます。
+
+- 前のルールの置換結果が、後のルールの一致を新たに作りうる（連鎖）
+- 2つのルールの一致が部分的に重なりうる（適用順で結果が変わる）
+- 前のルールが文字を削除する（前後がつながって新たな一致ができる）
+
+判定は、パターンが一致しうる文字列を有限個に展開できるルールでは
+文字列同士の重なりで厳密に、それ以外は使われる文字集合で保守的に行います。
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+MAX_LANGUAGE = 256  # 展開する一致文字列の上限
+MAX_REPEAT_EXPAND = 8
+
+
+def _expand(items) -> Optional[Set[str]]:
+    """構文木が一致しうる文字列の集合（有限かつ小さい場合のみ、それ以外はNone）"""
+    results = {''}
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            options = {chr(av)}
+        elif op is sre_parse.IN:
+            options = set()
+            for item_op, item_av in av:
+                if item_op is sre_parse.LITERAL:
+                    options.add(chr(item_av))
+                elif item_op is sre_parse.RANGE and item_av[1] - item_av[0] < MAX_LANGUAGE:
+                    options.update(chr(c) for c in range(item_av[0], item_av[1] + 1))
+                else:
+                    return None
+        elif op is sre_parse.SUBPATTERN:
+            options = _expand(av[-1])
+        elif op is sre_parse.BRANCH:
+            options = set()
+            for branch in av[1]:
+                branch_options = _expand(branch)
+                if branch_options is None:
+                    return None
+                options |= branch_options
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, sub = av
+            if high is sre_parse.MAXREPEAT or high > MAX_REPEAT_EXPAND:
+                return None
+            sub_options = _expand(sub)
+            if sub_options is None:
+                return None
+            options, current = set(), {''}
+            for count in range(high + 1):
+                if count >= low:
+                    options |= current
+                current = {a + b for a in current for b in sub_options}
+                if len(current) > MAX_LANGUAGE:
+                    return None
+        else:
+            return None
+
+        if options is None:
+            return None
+        results = {a + b for a in results for b in options}
+        if len(results) > MAX_LANGUAGE:
+            return None
+    return results
+
+
+def _chars(items) -> Optional[Set[str]]:
+    """構文木に現れうる文字の集合（任意の文字に一致しうる場合はNone）"""
+    chars = set()
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op is sre_parse.LITERAL:
+                    chars.add(chr(item_av))
+                elif item_op is sre_parse.RANGE and item_av[1] - item_av[0] < MAX_LANGUAGE:
+                    chars.update(chr(c) for c in range(item_av[0], item_av[1] + 1))
+                else:
+                    return None
+        elif op is sre_parse.AT:
+            continue
+        else:
+            if op is sre_parse.SUBPATTERN:
+                subs = [av[-1]]
+            elif op is sre_parse.BRANCH:
+                subs = av[1]
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                subs = [av[2]]
+            else:
+                return None
+            for sub in subs:
+                sub_chars = _chars(sub)
+                if sub_chars is None:
+                    return None
+                chars |= sub_chars
+    return chars
+
+
+def _partial_overlap(a: str, b: str) -> bool:
+    """aの末尾とbの先頭（またはその逆）が部分的に重なりうるか"""
+    for k in range(1, min(len(a), len(b))):
+        if a.endswith(b[:k]) or b.endswith(a[:k]):
+            return True
+    return False
+
+
+def _overlaps(a: str, b: str) -> bool:
+    """2つの文字列が（包含を含め）どこかで重なりうるか"""
+    return a in b or b in a or _partial_overlap(a, b)
+
+
+class RewriteRule:
+    """1つの置換ルールと、その一致・置換結果の静的な情報"""
+
+    def __init__(self, pattern: str, replacement: str):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.regex = re.compile(pattern)
+
+        try:
+            parsed = list(sre_parse.parse(pattern))
+        except Exception:
+            parsed = None
+
+        self.language = _expand(parsed) if parsed is not None else None
+        if self.language is not None and '' in self.language:
+            self.language = None  # 空文字列に一致するルールは解析しない
+
+        if self.language is not None:
+            self.outputs = {self.regex.sub(replacement, s) for s in self.language}
+            self.chars = set(''.join(self.language))
+            self.output_chars = set(''.join(self.outputs))
+            self.deletes = '' in self.outputs
+        else:
+            self.outputs = None
+            self.chars = _chars(parsed) if parsed is not None else None
+            # 後方参照で一致部分がそのまま出力されうるため、パターン側の文字も含める
+            literal_part = re.sub(r'\\(\d+|g<[^>]*>)', '', replacement)
+            self.output_chars = None if self.chars is None else self.chars | set(literal_part)
+            self.deletes = replacement == ''
+
+        # 正規表現の記号を含まない単純な文字列置換か
+        self.literal = self.language == {pattern} and '\\' not in replacement
+
+    def conflicts_with(self, later: 'RewriteRule') -> bool:
+        """このルールの後に適用されるlaterと、1回の走査にまとめられないならTrue"""
+        if self.deletes:
+            return True
+
+        if self.language is None or later.language is None:
+            if self.chars is None or later.chars is None or self.output_chars is None:
+                return True
+            return bool(self.chars & later.chars) or bool(self.output_chars & later.chars)
+
+        for a in self.language:
+            for b in later.language:
+                # 一致同士の部分的な重なり、または後のルールが前のルールを含む場合
+                if _partial_overlap(a, b) or (a != b and a in b):
+                    return True
+        for output in self.outputs:
+            for b in later.language:
+                # 置換結果が後のルールの一致を作りうる場合
+                if output and _overlaps(output, b):
+                    return True
+        return False
+
+
+class _Stage:
+    """1回の走査で適用するルール群"""
+
+    def __init__(self, rules: List[RewriteRule]):
+        self.rules = rules
+        if len(rules) == 1:
+            self._apply = self._apply_single
+        elif all(rule.literal for rule in rules):
+            self._table: Dict[str, str] = {}
+            for rule in rules:
+                self._table.setdefault(rule.pattern, rule.replacement)
+            self._regex = re.compile('|'.join(re.escape(rule.pattern) for rule in rules))
+            self._apply = self._apply_literals
+        else:
+            self._regex = re.compile('|'.join(f'({rule.pattern})' for rule in rules))
+            # 各ルールを包む外側のグループ番号 → ルール
+            self._group_rules: Dict[int, RewriteRule] = {}
+            group = 1
+            for rule in rules:
+                self._group_rules[group] = rule
+                group += 1 + rule.regex.groups
+            self._apply = self._apply_mixed
+
+    def _apply_single(self, text: str) -> str:
+        rule = self.rules[0]
+        return rule.regex.sub(rule.replacement, text)
+
+    def _apply_literals(self, text: str) -> str:
+        table = self._table
+        return self._regex.sub(lambda m: table[m.group()], text)
+
+    def _apply_mixed(self, text: str) -> str:
+        group_rules = self._group_rules
+
+        def replace(m):
+            # 外側のグループは内側より後に閉じるため lastindex がルールを指す
+            rule = group_rules[m.lastindex]
+            return rule.regex.match(m.string, m.start()).expand(rule.replacement)
+
+        return self._regex.sub(replace, text)
+
+    def apply(self, text: str) -> str:
+        return self._apply(text)
+
+
+class RewriteEngine:
+    """順序付き置換ルールを、逐次適用と同じ結果になるようまとめて適用する"""
+
+    def __init__(self, rules: Iterable[Tuple[str, str]]):
+        self.rules = [RewriteRule(pattern, replacement) for pattern, replacement in rules]
+
+        self.stages: List[_Stage] = []
+        current: List[RewriteRule] = []
+        for rule in self.rules:
+            if any(earlier.conflicts_with(rule) for earlier in current):
+                self.stages.append(_Stage(current))
+                current = []
+            current.append(rule)
+        if current:
+            self.stages.append(_Stage(current))
+
+    def apply(self, text: str) -> str:
+        for stage in self.stages:
+            text = stage.apply(text)
+        return text
+
+    def apply_sequential(self, text: str) -> str:
+        """参照用：ルールを1つずつ re.sub で適用"""
+        for rule in self.rules:
+            text = rule.regex.sub(rule.replacement, text)
+        return text
+
+    def describe(self) -> List[List[str]]:
+        """ステージごとのパターン一覧"""
+        return [[rule.pattern for rule in stage.rules] for stage in self.stages]
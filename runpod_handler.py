@@ -10,61 +10,934 @@ import os
 import json
 import requests
 from typing import Dict, Any
-import tempfile
 import shutil
+import threading
+import time
+import queue
+import asyncio
+import hashlib
+import re
+import socket
+import tarfile
+import tempfile
+import uuid
+import zipfile
+import platform
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # Model configuration
 MODEL_URL = "https://huggingface.co/Menlo/Jan-nano-gguf/resolve/main/jan-nano-4b-iQ4_XS.gguf"
 MODEL_PATH = "/workspace/jan-nano-4b-iQ4_XS.gguf"
 LLAMA_CPP_PATH = "/workspace/llama.cpp"
+LLAMA_CPP_REPO = "https://github.com/ggerganov/llama.cpp.git"
+LLAMA_CPP_VERSION = os.environ.get("LLAMA_CPP_VERSION", "b3600")  # Pinned release tag
+LLAMA_CPP_BUILD_FLAGS = ["GGML_CUDA=1"]
+LLAMA_CPP_BINARIES = ["llama-server", "llama-cli", "server", "main"]
+# Index of prebuilt binaries on a mirror; falls back to <cache>/llama-cpp-index.json
+LLAMA_CPP_INDEX_URL = os.environ.get("LLAMA_CPP_INDEX_URL")
+
+# Artifact cache shared by all workers through the network volume
+ARTIFACT_CACHE_DIR = os.environ.get(
+    "ARTIFACT_CACHE_DIR",
+    "/runpod-volume/wisbee-cache" if os.path.isdir("/runpod-volume") else "/workspace/cache"
+)
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Large reads and writes for multi-GB artifacts
+LOCK_STALE_SECONDS = 120  # A lock not refreshed for this long belongs to a dead worker
+
+# Inference settings shared by the resident server and the CLI fallback
+CONTEXT_SIZE = 2048
+GPU_LAYERS = 35
+BATCH_SIZE = 512
+
+# Resident llama.cpp server configuration
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = int(os.environ.get("LLAMA_SERVER_PORT", "8080"))
+SERVER_STARTUP_TIMEOUT = 300  # Seconds to wait for the model to load
+HEALTH_CHECK_INTERVAL = 10  # Seconds between watchdog health checks
+MAX_HEALTH_FAILURES = 3  # Consecutive failed checks before a restart
+REQUEST_TIMEOUT = 300  # Seconds per completion request
+
+# Continuous batching: concurrent jobs share the server's decode batch
+PARALLEL_SLOTS = int(os.environ.get("LLAMA_PARALLEL_SLOTS", "4"))  # Sequences decoded together
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW_MS", "20")) / 1000  # Seconds to collect arrivals
+
+# KV state cache: evaluated system prompts and chat sessions saved by the server
+KV_CACHE_DIR = "/workspace/kv_cache"
+KV_CACHE_MAX_BYTES = int(os.environ.get("KV_CACHE_MAX_MB", "4096")) * 1024 * 1024
+
+DEFAULT_SYSTEM_PROMPT = "You are Wisbee, a helpful AI assistant powered by jan-nano XS model. You prioritize user privacy and provide accurate, helpful responses."
+
+class ArtifactCache:
+    """
+    Content-addressed artifact store on the network volume
+
+    Artifacts live in objects/<sha256> and are looked up through
+    refs/<key>.json, where the key names the model version or the
+    llama.cpp version and build flags. Writes go to a temp file and are
+    renamed into place, so readers never see a partial artifact. A lock
+    file per key makes concurrent cold workers wait for the first one's
+    download instead of fetching the same artifact again.
+    """
+
+    def __init__(self, root=ARTIFACT_CACHE_DIR):
+        self.root = root
+        for name in ("objects", "refs", "locks", "tmp"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def get(self, key):
+        """Return the cached path for key, or None if it isn't cached"""
+        try:
+            with open(os.path.join(self.root, "refs", f"{key}.json")) as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+        path = os.path.join(self.root, "objects", ref["sha256"])
+        if os.path.exists(path) and os.path.getsize(path) == ref["size"]:
+            return path
+        return None
+
+    @contextmanager
+    def lock(self, key):
+        """Hold an exclusive per-key lock that works across hosts"""
+        path = os.path.join(self.root, "locks", f"{key}.lock")
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > LOCK_STALE_SECONDS:
+                        os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(1)
+
+        os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+        os.close(fd)
+
+        # Refresh the lock while held so waiting workers don't treat it as stale
+        released = threading.Event()
+
+        def heartbeat():
+            while not released.wait(LOCK_STALE_SECONDS / 4):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            yield
+        finally:
+            released.set()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, key, chunks, expected_sha256=None):
+        """Store an iterable of byte chunks under key and return its path"""
+        tmp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+            digest = hasher.hexdigest()
+            if expected_sha256 and digest != expected_sha256:
+                raise ValueError(f"SHA-256 mismatch for {key}: expected {expected_sha256}, got {digest}")
+
+            path = os.path.join(self.root, "objects", digest)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._write_ref(key, {"sha256": digest, "size": size})
+        return path
+
+    def put_file(self, key, source_path):
+        """Store a local file under key and return its path"""
+        def chunks():
+            with open(source_path, "rb") as f:
+                while True:
+                    chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+        return self.put(key, chunks())
+
+    def fetch(self, key, url):
+        """Return the cached artifact for key, downloading url on a miss"""
+        path = self.get(key)
+        if path is not None:
+            return path
+
+        with self.lock(key):
+            # Another worker may have finished the download while we waited
+            path = self.get(key)
+            if path is not None:
+                return path
+
+            print(f"Downloading {url} into artifact cache...")
+            with requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                return self.put(key, response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                                expected_sha256=linked_sha256(response))
+
+    def _write_ref(self, key, ref):
+        ref_path = os.path.join(self.root, "refs", f"{key}.json")
+        tmp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        with open(tmp_path, "w") as f:
+            json.dump(ref, f)
+        os.replace(tmp_path, ref_path)
+
+def linked_sha256(response):
+    """SHA-256 of a Hugging Face LFS file, sent as X-Linked-Etag on the redirect"""
+    for r in response.history + [response]:
+        etag = r.headers.get("X-Linked-Etag", "").replace("W/", "").strip('"').lower()
+        if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag):
+            return etag
+    return None
+
+def model_cache_key():
+    """Cache key for the model, versioned by its download URL"""
+    name = os.path.basename(MODEL_URL).replace(".gguf", "")
+    return f"model-{name}-{hashlib.sha256(MODEL_URL.encode()).hexdigest()[:12]}"
+
+def llama_cpp_cache_key():
+    """Cache key for llama.cpp binaries: version plus build flags"""
+    flags = hashlib.sha256(" ".join(LLAMA_CPP_BUILD_FLAGS).encode()).hexdigest()[:12]
+    return f"llama-cpp-{LLAMA_CPP_VERSION}-{flags}"
 
 def download_model():
     """Download the quantized model if not exists"""
-    if not os.path.exists(MODEL_PATH):
-        print(f"Downloading model from {MODEL_URL}...")
-        response = requests.get(MODEL_URL, stream=True)
-        response.raise_for_status()
-        
-        with open(MODEL_PATH, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        print(f"Model downloaded to {MODEL_PATH}")
-    else:
+    if os.path.exists(MODEL_PATH):
         print("Model already exists")
+        return
 
-def setup_llama_cpp():
-    """Setup llama.cpp if not exists"""
-    if not os.path.exists(LLAMA_CPP_PATH):
-        print("Setting up llama.cpp...")
-        
-        # Clone llama.cpp
+    path = ArtifactCache().fetch(model_cache_key(), MODEL_URL)
+    # Point MODEL_PATH at the shared copy instead of duplicating 2GB
+    if os.path.lexists(MODEL_PATH):
+        os.remove(MODEL_PATH)  # Dangling link to an evicted artifact
+    os.symlink(path, MODEL_PATH)
+    print(f"Model available at {MODEL_PATH} -> {path}")
+
+def detect_cpu_features():
+    """Return the CPU/accelerator features prebuilt binaries can require"""
+    features = set()
+    machine = platform.machine().lower()
+    if machine in ("arm64", "aarch64"):
+        features.add("neon")
+
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    features.update(flag for flag in ("avx", "avx2", "avx512f", "fma", "f16c") if flag in flags)
+                    break
+    except OSError:
+        pass
+
+    if shutil.which("nvidia-smi"):
+        features.add("cuda")
+    return features
+
+def load_llama_cpp_index(cache):
+    """
+    Load the prebuilt binary index from the mirror or the artifact cache
+
+    Format:
+    {"builds": [{"version": "b3600", "os": "linux", "arch": "x86_64",
+                 "requires": ["avx2", "cuda"], "url": "...", "sha256": "..."}]}
+    Builds are listed in order of preference.
+    """
+    try:
+        if LLAMA_CPP_INDEX_URL:
+            response = requests.get(LLAMA_CPP_INDEX_URL, timeout=30)
+            response.raise_for_status()
+            return response.json()
+        with open(os.path.join(cache.root, "llama-cpp-index.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError, requests.exceptions.RequestException) as e:
+        print(f"No llama.cpp binary index available: {e}")
+        return {"builds": []}
+
+def select_prebuilt(index, features):
+    """Pick the first build for this version and platform the CPU supports"""
+    system = platform.system().lower()
+    machine = platform.machine().lower()
+    for build in index.get("builds", []):
+        if (build.get("version") == LLAMA_CPP_VERSION
+                and build.get("os") == system
+                and build.get("arch") == machine
+                and set(build.get("requires", [])) <= features):
+            return build
+    return None
+
+def build_llama_cpp(cache, key):
+    """Compile llama.cpp in a build directory kept on the volume and cache the binaries"""
+    # Reusing the source tree keeps object files, so rebuilds are incremental
+    build_dir = os.path.join(cache.root, "build", f"llama.cpp-{LLAMA_CPP_VERSION}")
+    if not os.path.exists(build_dir):
+        print(f"Cloning llama.cpp {LLAMA_CPP_VERSION}...")
         subprocess.run([
-            "git", "clone", 
-            "https://github.com/ggerganov/llama.cpp.git",
-            LLAMA_CPP_PATH
+            "git", "clone", "--depth", "1",
+            "--branch", LLAMA_CPP_VERSION,
+            LLAMA_CPP_REPO,
+            build_dir
         ], check=True)
-        
-        # Build llama.cpp with CUDA support
-        os.chdir(LLAMA_CPP_PATH)
-        subprocess.run(["make", "LLAMA_CUDA=1"], check=True)
-        
-        print("llama.cpp setup complete")
-    else:
+
+    # Build llama.cpp with CUDA support
+    print(f"Building llama.cpp {LLAMA_CPP_VERSION}...")
+    subprocess.run(["make", *LLAMA_CPP_BUILD_FLAGS, "-j", str(os.cpu_count() or 1)],
+                   cwd=build_dir, check=True)
+
+    # Publish the binaries so other cold workers skip the build
+    archive_path = os.path.join(cache.root, "tmp", f"{key}.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as tar:
+        for name in LLAMA_CPP_BINARIES:
+            path = os.path.join(build_dir, name)
+            if os.path.isfile(path):
+                tar.add(path, arcname=name)
+    try:
+        return cache.put_file(key, archive_path)
+    finally:
+        os.remove(archive_path)
+
+def install_llama_cpp_archive(archive):
+    """Unpack a binary archive (tar.gz or zip) into LLAMA_CPP_PATH"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as zf:
+                zf.extractall(tmp_dir)
+        else:
+            with tarfile.open(archive) as tar:
+                tar.extractall(tmp_dir)
+
+        # Release archives nest binaries (e.g. build/bin); copy that directory flat
+        for directory, _, files in os.walk(tmp_dir):
+            if any(name in files for name in LLAMA_CPP_BINARIES):
+                os.makedirs(LLAMA_CPP_PATH, exist_ok=True)
+                for name in files:
+                    target = os.path.join(LLAMA_CPP_PATH, name)
+                    shutil.copy2(os.path.join(directory, name), target)
+                    os.chmod(target, 0o755)
+                return
+    raise RuntimeError("llama.cpp archive contains no known binaries")
+
+def setup_llama_cpp():
+    """
+    Provision llama.cpp binaries if not already installed
+
+    Resolution order: binaries cached on the volume for this version and
+    build flags, then a matching prebuilt from the binary index, then a
+    compile in a cached build directory.
+    """
+    if os.path.exists(LLAMA_CPP_PATH):
         print("llama.cpp already exists")
+        return
+
+    cache = ArtifactCache()
+    key = llama_cpp_cache_key()
+    with cache.lock(key):
+        archive = cache.get(key)
+        if archive is not None:
+            print(f"Using llama.cpp {LLAMA_CPP_VERSION} from artifact cache")
+        else:
+            features = detect_cpu_features()
+            build = select_prebuilt(load_llama_cpp_index(cache), features)
+            if build is not None:
+                print(f"Downloading prebuilt llama.cpp {LLAMA_CPP_VERSION} ({', '.join(sorted(build.get('requires', [])))})...")
+                with requests.get(build["url"], stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    archive = cache.put(key, response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                                        expected_sha256=build.get("sha256"))
+            else:
+                print(f"No prebuilt llama.cpp for features {sorted(features)}, compiling")
+                archive = build_llama_cpp(cache, key)
+
+        install_llama_cpp_archive(archive)
+        print("llama.cpp setup complete")
+
+def find_llama_binary(names):
+    """Return the first llama.cpp binary found under LLAMA_CPP_PATH"""
+    # make builds put binaries in the repo root, cmake builds in build/bin
+    for directory in (LLAMA_CPP_PATH, os.path.join(LLAMA_CPP_PATH, "build", "bin")):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+class LlamaServer:
+    """
+    Resident llama.cpp HTTP server
+
+    The model is loaded once when the server starts and stays resident,
+    so each job only pays for prompt processing and generation. A
+    watchdog thread polls /health and restarts the process if it exits
+    or stops responding.
+    """
+
+    def __init__(self, binary, model_path, host=SERVER_HOST, port=SERVER_PORT):
+        self.binary = binary
+        self.model_path = model_path
+        self.host = host
+        self.port = port
+        self.base_url = f"http://{host}:{port}"
+        self.process = None
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    def command(self):
+        """Build the llama.cpp server command line"""
+        return [
+            self.binary,
+            "-m", self.model_path,
+            "--host", self.host,
+            "--port", str(self.port),
+            "-c", str(CONTEXT_SIZE * PARALLEL_SLOTS),  # Shared by all slots
+            "--n-gpu-layers", str(GPU_LAYERS),
+            "-b", str(BATCH_SIZE),
+            "--parallel", str(PARALLEL_SLOTS),
+            "--cont-batching",
+            "--slot-save-path", KV_CACHE_DIR,
+        ]
+
+    def start(self):
+        """Start the server process and wait until the model is loaded"""
+        os.makedirs(KV_CACHE_DIR, exist_ok=True)
+        with self._lock:
+            self._spawn()
+        if not self.wait_until_ready():
+            raise RuntimeError("llama.cpp server did not become ready")
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        """Stop the watchdog and terminate the server process"""
+        self._stopping.set()
+        with self._lock:
+            self._terminate()
+
+    def is_running(self):
+        """Check whether the server process is alive"""
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self, timeout=2):
+        """Check whether the server answers /health with the model loaded"""
+        if not self.is_running():
+            return False
+        try:
+            response = requests.get(f"{self.base_url}/health", timeout=timeout)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def wait_until_ready(self, timeout=SERVER_STARTUP_TIMEOUT):
+        """Wait for the model to finish loading"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.is_running():
+                return False
+            if self.is_healthy():
+                return True
+            time.sleep(0.5)
+        return False
+
+    def ensure_running(self):
+        """Restart the server if it has crashed, then wait until it is ready"""
+        if self.is_healthy():
+            return True
+        with self._lock:
+            if not self.is_running():
+                print("llama.cpp server is not running, restarting...")
+                self._spawn()
+                self.restarts += 1
+        return self.wait_until_ready()
 
-def handler(job):
+    def completion(self, payload, timeout=REQUEST_TIMEOUT):
+        """Run a completion request against the resident server"""
+        response = requests.post(f"{self.base_url}/completion", json=payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def save_slot(self, slot, filename):
+        """Save a slot's evaluated KV state to KV_CACHE_DIR"""
+        response = requests.post(f"{self.base_url}/slots/{slot}?action=save",
+                                 json={"filename": filename}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+
+    def restore_slot(self, slot, filename):
+        """Load a KV state saved by save_slot into a slot"""
+        response = requests.post(f"{self.base_url}/slots/{slot}?action=restore",
+                                 json={"filename": filename}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+
+    def stream_completion(self, payload, timeout=REQUEST_TIMEOUT):
+        """Stream a completion from the resident server, yielding each event"""
+        payload = dict(payload, stream=True)
+        with requests.post(f"{self.base_url}/completion", json=payload,
+                           stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            # Server-sent events: one "data: {...}" line per generated token
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[len(b"data: "):])
+                yield event
+                if event.get("stop"):
+                    break
+
+    def _spawn(self):
+        self._terminate()
+        cmd = self.command()
+        print(f"Starting llama.cpp server: {' '.join(cmd)}")
+        self.process = subprocess.Popen(cmd)
+
+    def _terminate(self):
+        if self.is_running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def _watch(self):
+        """Restart the server after a crash or repeated failed health checks"""
+        failures = 0
+        while not self._stopping.wait(HEALTH_CHECK_INTERVAL):
+            if self.is_healthy(timeout=5):
+                failures = 0
+                continue
+
+            failures += 1
+            if self.is_running() and failures < MAX_HEALTH_FAILURES:
+                continue
+
+            print(f"llama.cpp server unhealthy ({failures} failed checks), restarting...")
+            with self._lock:
+                self._spawn()
+                self.restarts += 1
+            self.wait_until_ready()
+            failures = 0
+
+# Resident server instance, created at container start
+llama_server = None
+
+class KVStateCache:
+    """
+    Reuses evaluated KV state across jobs
+
+    System prompts are saved once per SHA-256 as prefix-<hash>.bin and
+    restored into a slot instead of being re-processed. Chat sessions are
+    saved as session-<hash>.bin after every turn, so a follow-up turn only
+    evaluates the tokens appended since. Restores are skipped when the
+    slot already holds the state. Saved states are evicted least recently
+    used first once their total size exceeds max_bytes.
+
+    The server compares cached tokens against each prompt itself, so a
+    stale or missing state only costs speed, never correctness. A restore
+    that fails, e.g. because another job evicted the file after it was
+    looked up, is handled as a miss.
     """
-    RunPod handler function
+
+    def __init__(self, server, max_bytes=KV_CACHE_MAX_BYTES):
+        self.server = server
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (saved state filename, size in bytes)
+        self.total_bytes = 0
+        self.slot_prefix = {}  # slot -> prefix key currently evaluated in it
+        self.slot_session = {}  # slot -> session key currently evaluated in it
+        self.hits = 0
+        self.restores = 0
+        self.misses = 0
+        self._restarts = server.restarts
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prefix_key(prefix):
+        return "prefix-" + hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def session_key(session_id):
+        return "session-" + hashlib.sha256(str(session_id).encode("utf-8")).hexdigest()
+
+    def prepare(self, slot, prefix, session_id=None):
+        """Load the best saved state for the job into the slot"""
+        prefix_key = self.prefix_key(prefix)
+        session_key = self.session_key(session_id) if session_id is not None else None
+
+        with self._lock:
+            # A restarted server has lost every slot's state
+            if self.server.restarts != self._restarts:
+                self._restarts = self.server.restarts
+                self.slot_prefix.clear()
+                self.slot_session.clear()
+
+            if session_key is not None and self.slot_session.get(slot) == session_key:
+                self.hits += 1
+                return
+            if session_key is not None and session_key in self.entries:
+                filename = self._touch(session_key)
+                key = session_key
+            elif self.slot_prefix.get(slot) == prefix_key:
+                self.slot_session.pop(slot, None)
+                self.hits += 1
+                return
+            else:
+                filename = self._touch(prefix_key)
+                key = prefix_key
+
+            self.slot_prefix.pop(slot, None)
+            self.slot_session.pop(slot, None)
+
+        restored = False
+        if filename is not None:
+            try:
+                self.server.restore_slot(slot, filename)
+                restored = True
+            except requests.exceptions.RequestException as e:
+                # Another job may have evicted the file since it was looked up
+                print(f"Could not restore {filename} into slot {slot}, evaluating the prefix instead: {e}")
+        if not restored:
+            self.server.completion({
+                "prompt": prefix,
+                "n_predict": 0,
+                "cache_prompt": True,
+                "id_slot": slot
+            })
+            self._save(slot, prefix_key)
+            key = prefix_key
+
+        with self._lock:
+            if restored:
+                self.restores += 1
+            else:
+                self.misses += 1
+            self.slot_prefix[slot] = prefix_key
+            if key == session_key:
+                self.slot_session[slot] = session_key
+
+    def preferred_slot(self, idle_slots, prefix, session_id=None):
+        """Pick the idle slot already holding the job's session or prefix, if any"""
+        prefix_key = self.prefix_key(prefix)
+        session_key = self.session_key(session_id) if session_id is not None else None
+        with self._lock:
+            if session_key is not None:
+                for slot in idle_slots:
+                    if self.slot_session.get(slot) == session_key:
+                        return slot
+            for slot in idle_slots:
+                if self.slot_prefix.get(slot) == prefix_key:
+                    return slot
+        return None
+
+    def save_session(self, slot, session_id):
+        """Save the slot's state after a turn so the next turn can resume it"""
+        session_key = self.session_key(session_id)
+        self._save(slot, session_key)
+        with self._lock:
+            self.slot_session[slot] = session_key
+
+    def _touch(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _save(self, slot, key):
+        filename = f"{key}.bin"
+        self.server.save_slot(slot, filename)
+        size = os.path.getsize(os.path.join(KV_CACHE_DIR, filename))
+
+        with self._lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][1]
+            self.entries[key] = (filename, size)
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_key, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                try:
+                    os.remove(os.path.join(KV_CACHE_DIR, evicted))
+                except OSError:
+                    pass
+
+class BatchScheduler:
+    """
+    Continuous batching front end for the resident llama.cpp server
+
+    Jobs that arrive within BATCH_WINDOW of each other are released
+    together, each on its own server slot, so their prompts and tokens
+    are decoded in the same batches. A job waits only while all slots
+    are busy; finished slots are handed to the next queued job at once.
+    """
+
+    def __init__(self, server, slots=PARALLEL_SLOTS, window=BATCH_WINDOW, kv_cache=None):
+        self.server = server
+        self.slots = slots
+        self.window = window
+        self.kv_cache = kv_cache
+        self.pending = queue.Queue()
+        self.idle_slots = list(range(slots))
+        self._slot_available = threading.Condition()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    async def stream(self, payload, prefix=None, session_id=None):
+        """Queue a completion and yield its server events as they arrive"""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def emit(item):
+            loop.call_soon_threadsafe(events.put_nowait, item)
+
+        self.pending.put((payload, prefix, session_id, emit))
+        while True:
+            item = await events.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _dispatch(self):
+        """Collect jobs arriving within the window and start them together"""
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.slots:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            for job in batch:
+                slot = self._acquire_slot(job)  # Blocks while every slot is busy
+                threading.Thread(target=self._run, args=(job, slot), daemon=True).start()
+
+    def _acquire_slot(self, job):
+        """Take an idle slot, preferring one that already holds the job's state"""
+        _, prefix, session_id, _ = job
+        with self._slot_available:
+            while not self.idle_slots:
+                self._slot_available.wait()
+
+            slot = self.idle_slots[0]
+            if prefix is not None and self.kv_cache is not None:
+                preferred = self.kv_cache.preferred_slot(self.idle_slots, prefix, session_id)
+                if preferred is not None:
+                    slot = preferred
+            self.idle_slots.remove(slot)
+            return slot
+
+    def _release_slot(self, slot):
+        with self._slot_available:
+            self.idle_slots.append(slot)
+            self._slot_available.notify()
+
+    def _run(self, job, slot):
+        payload, prefix, session_id, emit = job
+        try:
+            try:
+                if not self.server.ensure_running():
+                    raise RuntimeError("llama.cpp server is not available")
+                if prefix is not None and self.kv_cache is not None:
+                    try:
+                        self.kv_cache.prepare(slot, prefix, session_id)
+                    except requests.exceptions.RequestException as e:
+                        # The full prompt is still evaluated, just without reuse
+                        print(f"KV cache unavailable for slot {slot}: {e}")
+                for event in self.server.stream_completion(dict(payload, id_slot=slot)):
+                    emit(event)
+            except Exception as e:
+                emit(e)
+                session_id = None  # Don't save a failed turn
+            emit(None)
+
+            # Save the finished turn after the client has its response
+            if session_id is not None and self.kv_cache is not None:
+                try:
+                    self.kv_cache.save_session(slot, session_id)
+                except (requests.exceptions.RequestException, OSError) as e:
+                    print(f"Failed to save session state for slot {slot}: {e}")
+        finally:
+            self._release_slot(slot)
+
+# Batching scheduler in front of the resident server
+scheduler = None
+
+def start_inference_server():
+    """Start the resident llama.cpp server if a server binary is available"""
+    global llama_server, scheduler
+
+    binary = find_llama_binary(["llama-server", "server"])
+    if binary is None:
+        print("llama.cpp server binary not found, using per-request CLI inference")
+        return None
+
+    server = LlamaServer(binary, MODEL_PATH)
+    try:
+        server.start()
+    except Exception as e:
+        print(f"Failed to start llama.cpp server: {e}")
+        server.stop()
+        return None
+
+    llama_server = server
+    scheduler = BatchScheduler(server, kv_cache=KVStateCache(server))
+    print(f"llama.cpp server ready at {server.base_url} ({PARALLEL_SLOTS} parallel slots)")
+    return server
+
+def concurrency_modifier(current_concurrency):
+    """Let RunPod hand this worker one job per server slot"""
+    if scheduler is None:
+        return 1  # The CLI fallback runs one process per job
+    return PARALLEL_SLOTS
+
+def run_cli_inference(formatted_prompt, max_tokens, temperature, top_p):
+    """Generate a response by launching llama.cpp for a single prompt"""
+    # Run inference with llama.cpp; the prompt is piped in over stdin,
+    # so nothing is written to disk and argv length limits don't apply
+    cmd = [
+        find_llama_binary(["main", "llama-cli"]) or f"{LLAMA_CPP_PATH}/main",
+        "-m", MODEL_PATH,
+        "-f", "/dev/stdin",
+        "-n", str(max_tokens),
+        "--temp", str(temperature),
+        "--top-p", str(top_p),
+        "-c", str(CONTEXT_SIZE),  # Context size
+        "--gpu-layers", str(GPU_LAYERS),  # Offload layers to GPU
+        "-b", str(BATCH_SIZE),  # Batch size
+        "--no-display-prompt"
+    ]
+    
+    print(f"Running command: {' '.join(cmd)}")
+    
+    # Execute llama.cpp
+    result = subprocess.run(
+        cmd,
+        input=formatted_prompt,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    
+    return result.stdout, usage_from_cli_timings(result.stderr)
+
+def build_usage(prompt_tokens, completion_tokens, cached_prompt_tokens,
+                prompt_ms, predicted_ms):
+    """Token counts with prefill and decode throughput reported separately"""
+    evaluated = prompt_tokens - cached_prompt_tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "prefill_tokens_per_second": round(evaluated / prompt_ms * 1000, 2) if prompt_ms else None,
+        "decode_tokens_per_second": round(completion_tokens / predicted_ms * 1000, 2) if predicted_ms else None
+    }
+
+def usage_from_server_timings(event):
+    """Usage from the final event of a llama.cpp server completion"""
+    timings = event.get("timings", {})
+    prompt_tokens = event.get("tokens_evaluated", 0)
+    # prompt_n only counts tokens that were not already in the slot's cache
+    evaluated = timings.get("prompt_n", prompt_tokens)
+    return build_usage(
+        prompt_tokens,
+        event.get("tokens_predicted", timings.get("predicted_n", 0)),
+        max(prompt_tokens - evaluated, 0),
+        timings.get("prompt_ms"),
+        timings.get("predicted_ms")
+    )
+
+def usage_from_cli_timings(stderr):
+    """Usage from the timing summary llama.cpp prints to stderr"""
+    # llama_print_timings / llama_perf_context_print lines, e.g.
+    #   prompt eval time =   123.45 ms /    42 tokens (...)
+    #          eval time =   456.78 ms /    99 runs   (...)
+    prompt = re.search(r"prompt eval time\s*=\s*([\d.]+) ms /\s*(\d+) tokens", stderr)
+    decode = re.search(r"(?<!prompt )eval time\s*=\s*([\d.]+) ms /\s*(\d+) (?:runs|tokens)", stderr)
+    return build_usage(
+        int(prompt.group(2)) if prompt else 0,
+        int(decode.group(2)) if decode else 0,
+        0,
+        float(prompt.group(1)) if prompt else None,
+        float(decode.group(1)) if decode else None
+    )
+
+def format_messages(messages, system_prompt=None):
+    """
+    Build the Wisbee prompt from OpenAI-style messages
+
+    Returns the system prompt prefix and the full prompt. Each turn is
+    appended after the previous ones, so the prompt for a follow-up turn
+    extends the previous prompt plus its reply.
+    """
+    for message in messages:
+        if message.get("role") == "system":
+            system_prompt = message.get("content", "")
+
+    prefix = f"{system_prompt or DEFAULT_SYSTEM_PROMPT}\n\n"
+    turns = []
+    for message in messages:
+        role = message.get("role")
+        if role == "user":
+            turns.append(f"User: {message.get('content', '')}\n")
+        elif role == "assistant":
+            turns.append(f"Assistant: {message.get('content', '')}\n")
+
+    return prefix, prefix + "".join(turns) + "Assistant:"
+
+def clean_response(output):
+    """Remove prompt artifacts from generated text"""
+    response = output.strip()
+    if "Assistant:" in response:
+        response = response.split("Assistant:")[-1].strip()
+    return response
+
+async def handler(job):
+    """
+    RunPod streaming handler function
     Expected input format:
     {
         "prompt": "User message",
+        "messages": [{"role": "user", "content": "..."}],  # Instead of prompt
+        "session_id": "Optional id to keep the conversation's KV state",
+        "system_prompt": "Optional system prompt (defaults to the Wisbee preamble)",
         "max_tokens": 500,
         "temperature": 0.8,
         "top_p": 0.95,
         "frequency_penalty": 0.1,
         "presence_penalty": 0.1
     }
+
+    Yields {"text": ..., "status": "streaming"} chunks as tokens are
+    generated, followed by one summary chunk carrying the full response,
+    token counts and timings. With return_aggregate_stream enabled,
+    /runsync returns the list of all chunks.
     """
     try:
         # Get job input
@@ -73,79 +946,89 @@ def handler(job):
         max_tokens = job_input.get("max_tokens", 500)
         temperature = job_input.get("temperature", 0.8)
         top_p = job_input.get("top_p", 0.95)
+        messages = job_input.get("messages") or [{"role": "user", "content": prompt}]
+        session_id = job_input.get("session_id")
         
-        # Format prompt for Wisbee
-        formatted_prompt = f"""You are Wisbee, a helpful AI assistant powered by jan-nano XS model. You prioritize user privacy and provide accurate, helpful responses.
-
-User: {prompt}
-Assistant:"""
-        
-        # Create temp file for prompt
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as tmp:
-            tmp.write(formatted_prompt)
-            prompt_file = tmp.name
-        
-        # Run inference with llama.cpp
-        cmd = [
-            f"{LLAMA_CPP_PATH}/main",
-            "-m", MODEL_PATH,
-            "-f", prompt_file,
-            "-n", str(max_tokens),
-            "--temp", str(temperature),
-            "--top-p", str(top_p),
-            "-c", "2048",  # Context size
-            "--gpu-layers", "35",  # Offload layers to GPU
-            "-b", "512",  # Batch size
-            "--no-display-prompt"
-        ]
+        # Format prompt for Wisbee; the system prompt prefix is cached per hash
+        prefix, formatted_prompt = format_messages(messages, job_input.get("system_prompt"))
         
-        print(f"Running command: {' '.join(cmd)}")
+        start_time = time.time()
+        first_token_time = None
+        pieces = []
+        usage = None
         
-        # Execute llama.cpp
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        # Use the resident server when available, otherwise launch llama.cpp per request
+        if scheduler is not None:
+            payload = {
+                "prompt": formatted_prompt,
+                "n_predict": max_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "stop": ["\nUser:"],
+                "cache_prompt": True
+            }
+            async for event in scheduler.stream(payload, prefix=prefix, session_id=session_id):
+                text = event.get("content", "")
+                if text:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    pieces.append(text)
+                    yield {"text": text, "status": "streaming"}
+                if event.get("stop"):
+                    usage = usage_from_server_timings(event)
+        else:
+            output, usage = await asyncio.to_thread(
+                run_cli_inference, formatted_prompt, max_tokens, temperature, top_p
+            )
+            first_token_time = time.time()
+            pieces.append(output)
+            yield {"text": clean_response(output), "status": "streaming"}
         
-        # Clean up temp file
-        os.unlink(prompt_file)
+        end_time = time.time()
+        response = clean_response("".join(pieces))
         
-        # Extract response
-        response = result.stdout.strip()
-        
-        # Remove any remaining prompt artifacts
-        if "Assistant:" in response:
-            response = response.split("Assistant:")[-1].strip()
-        
-        # Return response
-        return {
+        # Final summary chunk
+        yield {
             "response": response,
             "model": "jan-nano-xs",
-            "tokens_generated": len(response.split()),  # Approximate
+            "tokens_generated": usage["completion_tokens"] if usage else 0,
+            "usage": usage,
+            "time_to_first_token": round((first_token_time or end_time) - start_time, 3),
+            "total_time": round(end_time - start_time, 3),
             "status": "success"
         }
         
     except subprocess.CalledProcessError as e:
         print(f"llama.cpp error: {e}")
         print(f"stderr: {e.stderr}")
-        return {
+        yield {
             "error": f"Model inference failed: {e.stderr}",
             "status": "error"
         }
+    except requests.exceptions.RequestException as e:
+        print(f"llama.cpp server error: {e}")
+        yield {
+            "error": f"Model inference failed: {e}",
+            "status": "error"
+        }
     except Exception as e:
         print(f"Handler error: {e}")
-        return {
+        yield {
             "error": str(e),
             "status": "error"
         }
 
-# Initialize on container start
-print("Initializing Wisbee AI handler...")
-download_model()
-setup_llama_cpp()
-print("Initialization complete!")
+if __name__ == "__main__":
+    # Initialize on container start
+    print("Initializing Wisbee AI handler...")
+    download_model()
+    setup_llama_cpp()
+    start_inference_server()
+    print("Initialization complete!")
 
-# Start RunPod serverless handler
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Start RunPod serverless handler
+    runpod.serverless.start({
+        "handler": handler,
+        "concurrency_modifier": concurrency_modifier,
+        "return_aggregate_stream": True  # /runsync still returns the full output
+    })
@@ -23,7 +23,8 @@ RUNPOD_CONFIG = {
         "MODEL_NAME": "jan-nano-xs",
         "QUANTIZATION": "Q4_K_XS",
         "MAX_TOKENS": 2048,
-        "TEMPERATURE": 0.8
+        "TEMPERATURE": 0.8,
+        "LLAMA_PARALLEL_SLOTS": 4  # Concurrent jobs per worker (continuous batching)
     }
 }
 
@@ -26,6 +26,15 @@ RESPONSES = [
     "Running AI locally has many advantages: complete privacy, no internet requirement, zero latency, and full control over your data. Plus, with the efficient jan-nano XS model, you get all this without sacrificing performance.",
 ]
 
+def approx_tokens(text):
+    """
+    Estimate tokens without a tokenizer: one per non-ASCII character, one per
+    4 ASCII characters. Same rule as shard_packer.approx_tokens, kept inline
+    so the test image only needs this file.
+    """
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
 def handler(job):
     """
     Test handler that returns realistic responses
@@ -48,13 +57,25 @@ def handler(job):
         if temperature > 0.9 and random.random() < 0.3:
             response += "\n\nIs there anything specific you'd like to know more about?"
         
-        # Simulate token count
-        tokens = len(response.split())
+        # Simulate token counts and the prefill/decode split of the real handler
+        prompt_tokens = approx_tokens(prompt)
+        completion_tokens = approx_tokens(response)
+        prefill_time = processing_time * 0.1
+        decode_time = processing_time - prefill_time
         
         return {
             "response": response,
             "model": "jan-nano-xs",
-            "tokens_generated": tokens,
+            "tokens_generated": completion_tokens,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "cached_prompt_tokens": 0,
+                "prefill_tokens_per_second": round(prompt_tokens / prefill_time, 2),
+                "decode_tokens_per_second": round(completion_tokens / decode_time, 2),
+                "estimated": True
+            },
             "inference_time": round(processing_time, 2),
             "status": "success"
         }
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+シャード連結ユーティリティ
+
+JSONLシャードを1本のファイルに連結します。データはPythonの
+文字列を経由せず、カーネル内コピー（os.copy_file_range → os.sendfile）
+で転送し、どちらも使えない環境では大きなバッファでのコピーに
+フォールバックします。
+
+- 改行で終わっていないシャードの後には改行を補う（行の連結を防ぐ）
+- シャード単位でのシャッフル（seed指定で再現可能）
+- 各シャードが出力のどこに入ったかを記録するマージインデックス
+"""
+
+import json
+import mmap
+import os
+import random
+from typing import Any, Dict, List, Optional, Sequence
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+O_BINARY = getattr(os, 'O_BINARY', 0)  # Windowsで改行が変換されないように
+
+# 使えなかったコピー方法は以降試さない
+_kernel_copy_available = {
+    'copy_file_range': hasattr(os, 'copy_file_range'),
+    'sendfile': hasattr(os, 'sendfile'),
+}
+
+
+def _copy_range(src_fd: int, dst_fd: int, size: int) -> int:
+    """src_fdの先頭からsizeバイトをdst_fdの現在位置へコピー"""
+    copied = 0
+
+    if _kernel_copy_available['copy_file_range']:
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied, copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return copied
+        except OSError:
+            if copied:
+                raise
+            _kernel_copy_available['copy_file_range'] = False
+
+    if _kernel_copy_available['sendfile']:
+        try:
+            while copied < size:
+                n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return copied
+        except OSError:
+            if copied:
+                raise
+            _kernel_copy_available['sendfile'] = False
+
+    # フォールバック: 大きなバッファでのコピー
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    while copied < size:
+        block = os.read(src_fd, min(COPY_BUFFER_SIZE, size - copied))
+        if not block:
+            break
+        view = memoryview(block)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        copied += len(block)
+    return copied
+
+
+def _count_lines(path: str, size: int) -> int:
+    """行数（最終行が改行で終わらない場合も1行と数える）"""
+    if size == 0:
+        return 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = sum(mm[i:i + COPY_BUFFER_SIZE].count(b'\n') for i in range(0, size, COPY_BUFFER_SIZE))
+        return lines + (0 if mm[size - 1:size] == b'\n' else 1)
+
+
+def _ends_with_newline(fd: int, size: int) -> bool:
+    os.lseek(fd, size - 1, os.SEEK_SET)
+    return os.read(fd, 1) == b'\n'
+
+
+def build_index(output_path: str, entries: List[Dict[str, Any]], shuffle: bool = False,
+                seed: Optional[int] = None, index_path: Optional[str] = None) -> Dict[str, Any]:
+    """マージインデックスを作成（index_pathを指定するとJSONで保存）
+
+    entriesは出力順に並んだ {'path', 'offset', 'bytes'[, 'lines']} のリスト。
+    """
+    index = {
+        'output': str(output_path),
+        'total_bytes': sum(entry['bytes'] for entry in entries),
+        'shuffled': shuffle,
+        'seed': seed,
+        'shards': entries,
+    }
+    if entries and all('lines' in entry for entry in entries):
+        index['total_lines'] = sum(entry['lines'] for entry in entries)
+
+    if index_path:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+
+    return index
+
+
+def append_shard(shard: str, dst_fd: int, offset: int, count_lines: bool = False) -> Dict[str, Any]:
+    """シャードをdst_fdの現在位置（出力中のoffset）へコピーし、インデックスのエントリを返す"""
+    src_fd = os.open(shard, os.O_RDONLY | O_BINARY)
+    try:
+        size = os.fstat(src_fd).st_size
+        copied = _copy_range(src_fd, dst_fd, size)
+        # 改行で終わらないシャードは改行を補う
+        if copied and not _ends_with_newline(src_fd, copied):
+            os.write(dst_fd, b'\n')
+            copied += 1
+    finally:
+        os.close(src_fd)
+
+    entry = {'path': str(shard), 'offset': offset, 'bytes': copied}
+    if count_lines:
+        entry['lines'] = _count_lines(str(shard), size)
+    return entry
+
+
+def open_output(output_path: str) -> int:
+    """連結先のファイルを書き込み用に開く（既存の内容は切り詰める）"""
+    return os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0o644)
+
+
+def concat_shards(shard_paths: Sequence[str], output_path: str, shuffle: bool = False,
+                  seed: Optional[int] = None, index_path: Optional[str] = None,
+                  count_lines: bool = False) -> Dict[str, Any]:
+    """シャードを連結してoutput_pathに書き出し、マージインデックスを返す
+
+    index_pathを指定するとインデックスをJSONで保存する。
+    count_linesを指定すると各シャードの行数もインデックスに含める。
+    """
+    shards = list(shard_paths)
+    if shuffle:
+        random.Random(seed).shuffle(shards)
+
+    entries: List[Dict[str, Any]] = []
+    offset = 0
+
+    dst_fd = open_output(output_path)
+    try:
+        for shard in shards:
+            entry = append_shard(shard, dst_fd, offset, count_lines)
+            entries.append(entry)
+            offset += entry['bytes']
+    finally:
+        os.close(dst_fd)
+
+    return build_index(output_path, entries, shuffle, seed, index_path)
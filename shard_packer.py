@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+予算ベースのシャード分割
+
+サンプル数ではなく、1シャードあたりのバイト数または推定トークン数の
+予算で分割します。短い雑談と長い技術解説が混ざっていても、シャードの
+大きさがそろうので、データローダーや並列ワーカーの負荷が均等になります。
+
+- 分割はサンプルの順序を保つ（連続した範囲に切る）
+- シャード数を ceil(合計 / 予算) に抑えたうえで、各シャードが
+  合計 / シャード数 に近くなるよう切れ目を選ぶ（最後だけ小さい端数シャードを作らない）
+- 1サンプルで予算を超える場合は、そのサンプルだけのシャードにする
+
+シャードごとのサンプル数・バイト数・推定トークン数は
+shard_manifest.json に書き出します。
+"""
+
+import json
+import math
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+BUDGET_UNITS = ('bytes', 'tokens')
+SHARD_MANIFEST_FILE = 'shard_manifest.json'
+
+
+def approx_tokens(text: str) -> int:
+    """推定トークン数（非ASCII文字は1文字1トークン、ASCIIは4文字で1トークン）"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+def measure(line: str, unit: str) -> int:
+    """1行の大きさ（unit: 'bytes' または 'tokens'）"""
+    if unit == 'tokens':
+        return approx_tokens(line)
+    return len(line.encode('utf-8'))
+
+
+def _pack(sizes: Sequence[int], budget: int, count: int) -> List[Tuple[int, int]]:
+    """count個のシャードを目標に、先頭から貪欲に切れ目を選ぶ"""
+    remaining = sum(sizes)
+    shards_left = count
+
+    ranges = []
+    start = 0
+    while start < len(sizes):
+        target = remaining / shards_left
+        size = 0
+        end = start
+        while end < len(sizes):
+            grown = size + sizes[end]
+            # 予算を超えるか、目標を超えて切れ目が目標から遠ざかるならここで切る
+            if end > start and (grown > budget or (grown > target and grown - target > target - size)):
+                break
+            size = grown
+            end += 1
+        ranges.append((start, end))
+        remaining -= size
+        shards_left = max(1, shards_left - 1)
+        start = end
+    return ranges
+
+
+def pack_balanced(sizes: Sequence[int], budget: int) -> List[Tuple[int, int]]:
+    """順序を保ったまま、予算以内でなるべく均等になる (start, end) の範囲に分割"""
+    if budget <= 0:
+        raise ValueError(f"予算は正の値を指定してください: {budget}")
+    count = max(1, math.ceil(sum(sizes) / budget))
+    while True:
+        ranges = _pack(sizes, budget, count)
+        # 予算で早めに切れた分が積み重なり、最後に小さな端数シャードができた場合は
+        # シャード数を増やして目標を下げ、詰め直す
+        if len(ranges) <= count:
+            return ranges
+        count = len(ranges)
+
+
+def fixed_ranges(count: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """サンプル数で区切った (start, end) の範囲"""
+    return [(i, min(i + chunk_size, count)) for i in range(0, count, chunk_size)]
+
+
+def shard_ranges(lines: Sequence[str], chunk_size: int = 100, budget: Optional[int] = None,
+                 unit: str = 'bytes') -> List[Tuple[int, int]]:
+    """budget が無ければchunk_size件ごと、あれば予算ベースで分割した範囲"""
+    if budget is None:
+        return fixed_ranges(len(lines), chunk_size)
+    return pack_balanced([measure(line, unit) for line in lines], budget)
+
+
+def shard_entry(base_dir: str, filepath: str, category: str, lines: Sequence[str]) -> Dict[str, Any]:
+    """シャードマニフェストの1エントリ（bytes / tokens はJSONLとしての大きさ）"""
+    return {
+        'path': os.path.relpath(filepath, base_dir),
+        'category': category,
+        'samples': len(lines),
+        'bytes': sum(measure(line, 'bytes') for line in lines),
+        'tokens': sum(approx_tokens(line) for line in lines),
+    }
+
+
+def load_shard_manifest(base_dir: str) -> Dict[str, Any]:
+    manifest_file = os.path.join(base_dir, SHARD_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_shard_manifest(base_dir: str, shards: List[Dict[str, Any]], budget: Optional[int] = None,
+                         unit: str = 'bytes', chunk_size: Optional[int] = None) -> Dict[str, Any]:
+    """シャードの一覧と大きさの統計を shard_manifest.json に保存"""
+    sizes = [shard['bytes'] for shard in shards]
+    manifest = {
+        'budget': budget,
+        'unit': unit if budget is not None else 'samples',
+        'samples_per_shard': chunk_size if budget is None else None,
+        'total_shards': len(shards),
+        'total_samples': sum(shard['samples'] for shard in shards),
+        'total_bytes': sum(sizes),
+        'total_tokens': sum(shard['tokens'] for shard in shards),
+        'min_bytes': min(sizes, default=0),
+        'max_bytes': max(sizes, default=0),
+        'shards': shards,
+    }
+    manifest_file = os.path.join(base_dir, SHARD_MANIFEST_FILE)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, manifest_file)
+    return manifest
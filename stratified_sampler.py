@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+カテゴリ層別・重み付きサンプラー
+
+detailed_categorized_wisbee_data のカテゴリ別シャードから、カテゴリごとの
+重みに従って学習用の混合データを抽出します。
+
+- 件数はシャードマニフェスト（無ければ各シャードの索引ファイルのヘッダ）から
+  取り、category_summary.json の件数と照合する。全件の読み込みは行わない
+- カテゴリへの割り当て: proportional（件数比）/ uniform（均等）/
+  temperature（件数^(1/T) に比例）。--weight でカテゴリごとに上書きできる
+- 非復元抽出では、件数が足りないカテゴリの不足分を他のカテゴリに配り直す
+- 抽出はカテゴリごとに seed から決まる乱数で行い、同じ seed なら同じ結果になる
+- 出力はカテゴリをランダムに交互に並べながら1行ずつ書き出す。行は索引から
+  mmap 経由でそのままコピーし、JSONのパースはしない
+"""
+
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from columnar_store import COLUMNAR_SUFFIX, columnar_row_count, load_columnar_file
+from jsonl_index import JsonlIndex, build_index, index_is_current, index_path_for
+from jsonl_io import dumps, loads
+from shard_packer import load_shard_manifest
+
+DEFAULT_DATA_DIR = 'detailed_categorized_wisbee_data'
+SUMMARY_FILE = 'category_summary.json'
+STRATEGIES = ('proportional', 'uniform', 'temperature')
+MAX_OPEN_SHARDS = 64
+
+_SHARD_NAME = re.compile(r'_(\d+)(\.jsonl|' + re.escape(COLUMNAR_SUFFIX) + r')$')
+
+
+class _Shard:
+    """1シャードの場所と件数"""
+
+    def __init__(self, path: str, category: str, count: Optional[int] = None):
+        self.path = path
+        self.category = category
+        self.columnar = path.endswith(COLUMNAR_SUFFIX)
+        self.count = count if count is not None else self._count()
+
+    def _count(self) -> int:
+        if self.columnar:
+            return columnar_row_count(self.path)
+        with self.open() as index:
+            return len(index)
+
+    def open(self):
+        """行単位で読めるオブジェクト（JSONLは索引、カラム形式は展開したリスト）"""
+        if self.columnar:
+            return _ColumnarRows(load_columnar_file(self.path))
+        if not index_is_current(self.path):
+            print(f"索引ファイルを作成: {index_path_for(self.path)}")
+            build_index(self.path, self.category)
+        return JsonlIndex(self.path)
+
+
+class _ColumnarRows:
+    """カラム形式シャードを JsonlIndex と同じ使い方で読むためのラッパー"""
+
+    def __init__(self, samples: List[Dict[str, Any]]):
+        self.samples = samples
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def raw(self, i: int) -> bytes:
+        return dumps(self.samples[i]).encode('utf-8')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _shard_sort_key(path: str):
+    match = _SHARD_NAME.search(path)
+    return (int(match.group(1)) if match else 0, path)
+
+
+def discover_shards(data_dir: str) -> Dict[str, List[_Shard]]:
+    """カテゴリごとのシャード一覧（シャードマニフェストがあればそれを使う）"""
+    shards: Dict[str, List[_Shard]] = {}
+    manifest = load_shard_manifest(data_dir)
+    if manifest.get('shards'):
+        for entry in manifest['shards']:
+            path = os.path.join(data_dir, entry['path'])
+            if os.path.exists(path):
+                shards.setdefault(entry['category'], []).append(_Shard(path, entry['category'], entry['samples']))
+        return shards
+
+    for category in sorted(os.listdir(data_dir)):
+        category_dir = os.path.join(data_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        paths = [os.path.join(category_dir, name) for name in os.listdir(category_dir)
+                 if name.startswith(f"{category}_") and _SHARD_NAME.search(name)]
+        for path in sorted(paths, key=_shard_sort_key):
+            shards.setdefault(category, []).append(_Shard(path, category))
+    return shards
+
+
+def category_weights(counts: Dict[str, int], strategy: str = 'proportional', temperature: float = 1.0,
+                     overrides: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """カテゴリごとの重み（合計1に正規化）"""
+    if strategy == 'uniform':
+        weights = {category: 1.0 for category, count in counts.items() if count}
+    elif strategy == 'temperature':
+        weights = {category: count ** (1.0 / temperature) for category, count in counts.items() if count}
+    elif strategy == 'proportional':
+        weights = {category: float(count) for category, count in counts.items() if count}
+    else:
+        raise ValueError(f"不明な重み付け方式: {strategy}")
+
+    for category, weight in (overrides or {}).items():
+        if category not in counts:
+            raise ValueError(f"不明なカテゴリ: {category}")
+        weights[category] = weight
+    weights = {category: weight for category, weight in weights.items() if weight > 0 and counts.get(category)}
+
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("重みが正のカテゴリがありません")
+    return {category: weight / total for category, weight in weights.items()}
+
+
+def allocate(counts: Dict[str, int], weights: Dict[str, float], total: int,
+             replacement: bool = False) -> Dict[str, int]:
+    """重みに従って total 件をカテゴリに割り当てる
+
+    非復元抽出では各カテゴリの件数を上限とし、上限に達したカテゴリの
+    不足分は残りのカテゴリに重みの比で配り直す。
+    """
+    if not replacement:
+        total = min(total, sum(counts[category] for category in weights))
+
+    shares: Dict[str, float] = {}
+    active = dict(weights)
+    remaining = float(total)
+    while active:
+        weight_sum = sum(active.values())
+        capped = {} if replacement else {
+            category: counts[category] for category, weight in active.items()
+            if remaining * weight / weight_sum > counts[category]
+        }
+        if not capped:
+            for category, weight in active.items():
+                shares[category] = remaining * weight / weight_sum
+            break
+        for category, count in capped.items():
+            shares[category] = float(count)
+            remaining -= count
+            del active[category]
+
+    # 最大剰余方式で整数にする
+    allocation = {category: int(math.floor(share)) for category, share in shares.items()}
+    leftover = total - sum(allocation.values())
+    by_remainder = sorted(shares, key=lambda category: (allocation[category] - shares[category], category))
+    for category in by_remainder:
+        if leftover <= 0:
+            break
+        if replacement or allocation[category] < counts[category]:
+            allocation[category] += 1
+            leftover -= 1
+    return allocation
+
+
+class StratifiedSampler:
+    """カテゴリ別シャードからの層別・重み付き抽出"""
+
+    def __init__(self, data_dir: str = DEFAULT_DATA_DIR):
+        self.data_dir = data_dir
+        self.shards = discover_shards(data_dir)
+        self.counts = {category: sum(shard.count for shard in shards) for category, shards in self.shards.items()}
+        # カテゴリ内の通し行番号 → シャードの変換用に、各シャードの先頭行番号を持つ
+        self._starts = {}
+        for category, shards in self.shards.items():
+            starts, start = [], 0
+            for shard in shards:
+                starts.append(start)
+                start += shard.count
+            self._starts[category] = starts
+        self.summary = self._load_summary()
+        self._open: 'OrderedDict[str, Any]' = OrderedDict()
+
+    def _load_summary(self) -> Dict[str, Any]:
+        summary_file = os.path.join(self.data_dir, SUMMARY_FILE)
+        if not os.path.exists(summary_file):
+            return {}
+        with open(summary_file, 'r', encoding='utf-8') as f:
+            summary = json.load(f)
+        for category, info in summary.get('categories', {}).items():
+            if info.get('sample_count') != self.counts.get(category, 0):
+                print(f"⚠️ {category}: サマリーの件数 {info.get('sample_count')} と"
+                      f"シャードの件数 {self.counts.get(category, 0)} が一致しません（シャードの件数を使います）")
+        return summary
+
+    def plan(self, total: int, strategy: str = 'proportional', temperature: float = 1.0,
+             overrides: Optional[Dict[str, float]] = None, replacement: bool = False) -> Dict[str, int]:
+        """カテゴリごとの抽出件数"""
+        weights = category_weights(self.counts, strategy, temperature, overrides)
+        return allocate(self.counts, weights, total, replacement)
+
+    def _draw_rows(self, category: str, k: int, seed: Optional[int], replacement: bool) -> List[int]:
+        """カテゴリ内の行番号（全シャード通し）をk件、ランダムな順で選ぶ"""
+        rng = random.Random(f"{seed}:{category}")
+        n = self.counts[category]
+        if replacement:
+            return [rng.randrange(n) for _ in range(k)]
+        return rng.sample(range(n), k)
+
+    def _locate(self, category: str, row: int) -> Tuple[_Shard, int]:
+        starts = self._starts[category]
+        i = bisect.bisect_right(starts, row) - 1
+        return self.shards[category][i], row - starts[i]
+
+    def _reader(self, shard: _Shard):
+        reader = self._open.get(shard.path)
+        if reader is not None:
+            self._open.move_to_end(shard.path)
+            return reader
+        reader = shard.open()
+        if len(reader) != shard.count:
+            reader.close()
+            raise ValueError(f"シャードの件数 {len(reader)} がマニフェストの {shard.count} と一致しません: {shard.path}")
+        self._open[shard.path] = reader
+        if len(self._open) > MAX_OPEN_SHARDS:
+            _, oldest = self._open.popitem(last=False)
+            oldest.close()
+        return reader
+
+    def iter_raw(self, allocation: Dict[str, int], seed: Optional[int] = None,
+                 replacement: bool = False) -> Iterator[Tuple[str, bytes]]:
+        """(カテゴリ, 行のバイト列) をカテゴリがランダムに混ざる順で返す
+
+        各時点で残り件数に比例した確率で次のカテゴリを選ぶので、
+        並びは割り当て件数の一様ランダムな交互配置になる。
+        """
+        rows = {category: self._draw_rows(category, k, seed, replacement)
+                for category, k in allocation.items() if k > 0}
+        positions = {category: 0 for category in rows}
+        categories = list(rows)
+        remaining = [len(rows[category]) for category in categories]
+        order_rng = random.Random(f"{seed}:order")
+
+        left = sum(remaining)
+        while left:
+            i = order_rng.choices(range(len(categories)), weights=remaining)[0]
+            category = categories[i]
+            row = rows[category][positions[category]]
+            positions[category] += 1
+            remaining[i] -= 1
+            left -= 1
+            shard, local_row = self._locate(category, row)
+            yield category, self._reader(shard).raw(local_row)
+
+    def iter_samples(self, allocation: Dict[str, int], seed: Optional[int] = None,
+                     replacement: bool = False) -> Iterator[Dict[str, Any]]:
+        """抽出したサンプルを辞書で返す"""
+        for _, raw in self.iter_raw(allocation, seed, replacement):
+            yield loads(raw)
+
+    def write(self, output_file: str, allocation: Dict[str, int], seed: Optional[int] = None,
+              replacement: bool = False) -> Dict[str, int]:
+        """抽出結果をJSONLで書き出し、カテゴリごとの件数を返す"""
+        written = {category: 0 for category in allocation}
+        with open(output_file, 'wb') as f:
+            for category, raw in self.iter_raw(allocation, seed, replacement):
+                f.write(raw)
+                f.write(b'\n')
+                written[category] += 1
+        return written
+
+    def close(self):
+        for reader in self._open.values():
+            reader.close()
+        self._open.clear()
+
+
+def parse_weight_overrides(values: List[str]) -> Dict[str, float]:
+    overrides = {}
+    for value in values:
+        category, sep, weight = value.partition('=')
+        if not sep:
+            raise ValueError(f"--weight は CATEGORY=WEIGHT の形式で指定してください: {value}")
+        overrides[category] = float(weight)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description="カテゴリ層別・重み付きサンプリング")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help="カテゴリ別シャードのディレクトリ")
+    parser.add_argument('--total', type=int, required=True, help="抽出する件数")
+    parser.add_argument('--output', default='wisbee_mixed_training_data.jsonl', help="出力するJSONLファイル")
+    parser.add_argument('--strategy', choices=STRATEGIES, default='proportional', help="カテゴリの重み付け方式")
+    parser.add_argument('--temperature', type=float, default=2.0,
+                        help="--strategy temperature のときの温度（大きいほど均等に近づく）")
+    parser.add_argument('--weight', action='append', default=[], metavar='CATEGORY=WEIGHT',
+                        help="カテゴリの重みを上書き（0で除外、複数指定可）")
+    parser.add_argument('--replacement', action='store_true', help="復元抽出（件数の少ないカテゴリも重みどおりに抽出）")
+    parser.add_argument('--seed', type=int, default=0, help="乱数シード（同じシードなら同じ結果）")
+    args = parser.parse_args()
+    if args.total <= 0:
+        parser.error("--total は正の値を指定してください")
+    if args.strategy == 'temperature' and args.temperature <= 0:
+        parser.error("--temperature は正の値を指定してください")
+    try:
+        overrides = parse_weight_overrides(args.weight)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sampler = StratifiedSampler(args.data_dir)
+    print(f"📂 {args.data_dir}: {len(sampler.counts)}カテゴリ / {sum(sampler.counts.values()):,}サンプル")
+
+    allocation = sampler.plan(args.total, args.strategy, args.temperature, overrides, args.replacement)
+    if sum(allocation.values()) < args.total:
+        print(f"⚠️ 非復元抽出のため {sum(allocation.values()):,}件（全件）までしか抽出できません")
+
+    try:
+        written = sampler.write(args.output, allocation, args.seed, args.replacement)
+    finally:
+        sampler.close()
+
+    report = {
+        'data_dir': args.data_dir,
+        'output': args.output,
+        'total': sum(written.values()),
+        'strategy': args.strategy,
+        'temperature': args.temperature if args.strategy == 'temperature' else None,
+        'weight_overrides': overrides,
+        'replacement': args.replacement,
+        'seed': args.seed,
+        'categories': {
+            category: {'available': sampler.counts[category], 'sampled': written.get(category, 0)}
+            for category in sorted(sampler.counts, key=lambda c: -written.get(c, 0))
+        },
+    }
+    report_file = os.path.splitext(args.output)[0] + '.mix.json'
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"\n📈 カテゴリ別の抽出件数（{args.strategy}）:")
+    for category, info in report['categories'].items():
+        if info['sampled']:
+            print(f"   {category}: {info['sampled']:,} / {info['available']:,}")
+    print(f"\n✅ {report['total']:,}サンプルを保存: {args.output}")
+    print(f"   内訳: {report_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+create_detailed_categories の差分モードで古いシャードが残らないことの検証
+
+一時ディレクトリに小さな入力ファイルと「以前の実行で書かれた」シャードを
+用意し、create_detailed_categories.py --incremental を実行します。
+各シナリオの後で、ディスク上のシャードの行数が category_summary.json の
+件数と一致し、今回書いていない番号のシャードが残っていないことを確かめます。
+
+- 初回: マニフェストのない出力ディレクトリに古いシャードがある
+- 縮小: 入力が減って、前回より少ないシャードで足りる
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent / 'create_detailed_categories.py'
+OUTPUT_DIR = 'detailed_categorized_wisbee_data'
+INPUT_FILE = 'wisbee_training_data.jsonl'
+
+TOPICS = [
+    ('Pythonのリスト内包表記について教えて', 'Pythonではリスト内包表記で簡潔に書けます。'),
+    ('料理のレシピを教えて', '簡単な料理のレシピを紹介します。'),
+    ('英語の勉強方法は？', '英語は毎日少しずつ勉強するのがおすすめです。'),
+    ('投資の始め方を知りたい', '投資はまず少額から始めましょう。'),
+]
+
+
+def write_input(work_dir: Path, count: int):
+    """countサンプルの入力ファイル（すべて別の内容）"""
+    with open(work_dir / INPUT_FILE, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            instruction, output = TOPICS[i % len(TOPICS)]
+            sample = {'instruction': f"{instruction}（{i}）", 'input': '', 'output': f"{output} No.{i}"}
+            f.write(json.dumps(sample, ensure_ascii=False) + '\n')
+
+
+def seed_stale_shards(work_dir: Path):
+    """マニフェストに記録されていない、以前の実行のシャード"""
+    stale = {'wisbee_character': 6, 'programming_python': 40}
+    for category, shards in stale.items():
+        category_dir = work_dir / OUTPUT_DIR / category
+        category_dir.mkdir(parents=True, exist_ok=True)
+        for file_num in range(1, shards + 1):
+            path = category_dir / f"{category}_{file_num:03d}.jsonl"
+            with open(path, 'w', encoding='utf-8') as f:
+                for i in range(100):
+                    f.write(json.dumps({'instruction': f"古いサンプル {file_num}-{i}", 'output': '古い'},
+                                       ensure_ascii=False) + '\n')
+            (category_dir / f"{path.name}.idx").write_bytes(b'')
+
+
+def run_incremental(work_dir: Path):
+    result = subprocess.run([sys.executable, str(SCRIPT), '--incremental'], cwd=work_dir,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError(f"実行に失敗しました:\n{result.stdout[-2000:]}\n{result.stderr[-2000:]}")
+
+
+def check_output(work_dir: Path, expected_total: int):
+    """ディスク上の行数とサマリーの件数を比べる"""
+    output_dir = work_dir / OUTPUT_DIR
+    with open(output_dir / 'category_summary.json', 'r', encoding='utf-8') as f:
+        summary = json.load(f)
+    reported = {category: info['sample_count'] for category, info in summary['categories'].items()}
+
+    on_disk = {}
+    for shard in sorted(output_dir.glob('*/*.jsonl')):
+        with open(shard, 'r', encoding='utf-8') as f:
+            on_disk[shard.parent.name] = on_disk.get(shard.parent.name, 0) + sum(1 for line in f if line.strip())
+
+    if sum(reported.values()) != expected_total:
+        raise AssertionError(f"サマリーの合計が {sum(reported.values())} 件（期待値 {expected_total} 件）")
+    for category in sorted(set(on_disk) | set(reported)):
+        if on_disk.get(category, 0) != reported.get(category, 0):
+            raise AssertionError(f"{category}: ディスク上 {on_disk.get(category, 0)}行 / "
+                                 f"サマリー {reported.get(category, 0)}件")
+        shards = sorted(p.name for p in (output_dir / category).glob(f"{category}_*.jsonl"))
+        expected = [f"{category}_{n:03d}.jsonl" for n in range(1, len(shards) + 1)]
+        if shards != expected:
+            raise AssertionError(f"{category}: シャード番号が連続していません: {shards}")
+        missing_index = [name for name in shards if not (output_dir / category / f"{name}.idx").exists()]
+        if missing_index:
+            raise AssertionError(f"{category}: 索引ファイルがありません: {missing_index}")
+
+
+def scenario_first_run(work_dir: Path, samples: int):
+    write_input(work_dir, samples)
+    seed_stale_shards(work_dir)
+    run_incremental(work_dir)
+    check_output(work_dir, samples)
+    if (work_dir / OUTPUT_DIR / 'wisbee_character').exists():
+        raise AssertionError("今回サンプルのないカテゴリのディレクトリが残っています")
+
+
+def scenario_shrink(work_dir: Path, samples: int):
+    write_input(work_dir, samples)
+    run_incremental(work_dir)
+    write_input(work_dir, samples // 4)
+    run_incremental(work_dir)
+    check_output(work_dir, samples // 4)
+
+
+SCENARIOS = [
+    ('初回', scenario_first_run),
+    ('縮小', scenario_shrink),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="差分モードで古いシャードが残らないことの検証")
+    parser.add_argument('--samples', type=int, default=1200, help="入力のサンプル数")
+    args = parser.parse_args()
+
+    failures = 0
+    for name, scenario in SCENARIOS:
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                scenario(Path(work_dir), args.samples)
+                print(f"✅ {name}")
+            except AssertionError as e:
+                print(f"❌ {name}: {e}")
+                failures += 1
+
+    if failures:
+        sys.exit(1)
+    print("\n✅ 全シナリオ成功")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Verify the installers' ModelDownloader against a local HTTP stand-in
+
+A threaded http.server serves an in-memory payload with Range support
+and can drop a response halfway through, answer with a shorter range
+than requested, or throttle its output. Each
+scenario runs against every download/wisbee-installer-*.py:
+
+- parallel: the file arrives in several concurrent byte ranges
+- retry: a segment cut off mid-stream continues from where it stopped
+- resume: an interrupted download continues in a new downloader and
+  only fetches the missing bytes
+- checksum: a SHA-256 mismatch removes the partial file and its state
+- short: a segment that ends early without an error is not moved into
+  place, even with no SHA-256 to check, and the next run completes it
+- etag: a plain ETag is not trusted as the SHA-256, X-Linked-Etag is
+- interrupt: Ctrl-C returns promptly and leaves resumable state
+"""
+
+import _thread
+import argparse
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+INSTALLERS = sorted(Path(__file__).resolve().parent.glob('download/wisbee-installer-*.py'))
+
+
+class StandIn:
+    """Range-capable HTTP server for one payload"""
+
+    def __init__(self, payload, linked_etag=None, etag=None):
+        self.payload = payload
+        self.linked_etag = linked_etag
+        self.etag = etag
+        self.drop_after = None  # cut the next GET off after this many bytes
+        self.short_after = None  # answer the next GET with at most this many bytes
+        self.throttle = 0  # seconds to sleep per 4 KiB sent
+        self.requests = []  # (start, end) of every GET
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _headers(self, status, start, end):
+                self.send_response(status)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+                if status == 206:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(stand_in.payload)}')
+                if stand_in.linked_etag:
+                    self.send_header('X-Linked-Etag', f'"{stand_in.linked_etag}"')
+                if stand_in.etag:
+                    self.send_header('ETag', f'"{stand_in.etag}"')
+                self.end_headers()
+
+            def _range(self):
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if not match:
+                    return 200, 0, len(stand_in.payload) - 1
+                end = int(match.group(2)) if match.group(2) else len(stand_in.payload) - 1
+                return 206, int(match.group(1)), end
+
+            def do_HEAD(self):
+                self._headers(200, 0, len(stand_in.payload) - 1)
+
+            def do_GET(self):
+                status, start, end = self._range()
+                with stand_in._lock:
+                    stand_in.requests.append((start, end))
+                    drop_after, stand_in.drop_after = stand_in.drop_after, None
+                    short_after, stand_in.short_after = stand_in.short_after, None
+                if short_after is not None:
+                    # A complete, well-formed response that covers less than was asked for
+                    end = min(end, start + short_after - 1)
+                self._headers(status, start, end)
+
+                body = memoryview(stand_in.payload)[start:end + 1]
+                if drop_after is not None:
+                    body = body[:drop_after]
+                try:
+                    for offset in range(0, len(body), 4096):
+                        self.wfile.write(body[offset:offset + 4096])
+                        with stand_in._lock:
+                            stand_in.bytes_sent += len(body[offset:offset + 4096])
+                        if stand_in.throttle:
+                            time.sleep(stand_in.throttle)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                if drop_after is not None:
+                    self.close_connection = True
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/model.gguf'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def load_installer(path):
+    """Import an installer script (its file name is not a module name)"""
+    spec = importlib.util.spec_from_file_location(path.stem.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def leftovers(dest):
+    return [p.name for p in dest.parent.glob(dest.name + '.part*')]
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def scenario_parallel(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    try:
+        dest = work_dir / 'parallel.gguf'
+        installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=16 * 1024,
+                                  expected_sha256=hashlib.sha256(payload).hexdigest()).download()
+        check(dest.read_bytes() == payload, "downloaded file differs from the payload")
+        check(len({start for start, _ in stand_in.requests}) == 4, f"expected 4 ranges, got {stand_in.requests}")
+        check(not leftovers(dest), f"partial files left behind: {leftovers(dest)}")
+    finally:
+        stand_in.close()
+
+
+def scenario_retry(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    try:
+        dest = work_dir / 'retry.gguf'
+        stand_in.drop_after = len(payload) // 3
+        installer.ModelDownloader(stand_in.url, dest, segments=1, chunk_size=16 * 1024,
+                                  expected_sha256=hashlib.sha256(payload).hexdigest()).download()
+        check(dest.read_bytes() == payload, "downloaded file differs from the payload")
+        check(len(stand_in.requests) == 2 and stand_in.requests[1][0] > 0,
+              f"retry did not continue from the cut-off point: {stand_in.requests}")
+        # At most the chunk being read when the stream broke is fetched twice
+        check(stand_in.bytes_sent <= len(payload) + 16 * 1024,
+              f"retry re-fetched too much: sent {stand_in.bytes_sent} of {len(payload)}")
+    finally:
+        stand_in.close()
+
+
+def scenario_resume(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    try:
+        dest = work_dir / 'resume.gguf'
+        expected = hashlib.sha256(payload).hexdigest()
+        stand_in.drop_after = len(payload) // 8
+        try:
+            installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=16 * 1024, retries=1,
+                                      expected_sha256=expected).download()
+            raise AssertionError("interrupted download did not fail")
+        except installer.requests.exceptions.RequestException:
+            pass
+        check(sorted(leftovers(dest)) == ['resume.gguf.part', 'resume.gguf.part.json'],
+              f"no resumable state after the interruption: {leftovers(dest)}")
+
+        first_run = stand_in.bytes_sent
+        installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=16 * 1024,
+                                  expected_sha256=expected).download()
+        check(dest.read_bytes() == payload, "resumed file differs from the payload")
+        check(stand_in.bytes_sent - first_run <= len(payload) - first_run + 16 * 1024,
+              f"resume re-fetched {stand_in.bytes_sent - first_run} bytes after {first_run} were kept")
+        check(not leftovers(dest), f"partial files left behind: {leftovers(dest)}")
+    finally:
+        stand_in.close()
+
+
+def scenario_checksum(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    try:
+        dest = work_dir / 'checksum.gguf'
+        try:
+            installer.ModelDownloader(stand_in.url, dest, segments=4, expected_sha256='0' * 64).download()
+            raise AssertionError("SHA-256 mismatch was not reported")
+        except ValueError:
+            pass
+        check(not dest.exists() and not leftovers(dest), f"mismatched download left files: {leftovers(dest)}")
+    finally:
+        stand_in.close()
+
+
+def scenario_short(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    try:
+        dest = work_dir / 'short.gguf'
+        stand_in.short_after = len(payload) // 16
+        try:
+            installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=16 * 1024).download()
+            raise AssertionError("short download was moved into place")
+        except OSError:
+            pass
+        check(not dest.exists(), "incomplete download was moved into place")
+        check(sorted(leftovers(dest)) == ['short.gguf.part', 'short.gguf.part.json'],
+              f"no resumable state after the short download: {leftovers(dest)}")
+
+        installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=16 * 1024).download()
+        check(dest.read_bytes() == payload, "resumed file differs from the payload")
+        check(not leftovers(dest), f"partial files left behind: {leftovers(dest)}")
+    finally:
+        stand_in.close()
+
+
+def scenario_etag(installer, payload, work_dir):
+    digest = hashlib.sha256(payload).hexdigest()
+    # A 64-hex ETag that is not the content hash must be ignored
+    stand_in = StandIn(payload, etag=hashlib.sha256(b'not the payload').hexdigest())
+    try:
+        dest = work_dir / 'etag.gguf'
+        installer.ModelDownloader(stand_in.url, dest, segments=2).download()
+        check(dest.read_bytes() == payload, "download with a plain ETag failed")
+    finally:
+        stand_in.close()
+
+    stand_in = StandIn(payload, linked_etag=digest)
+    try:
+        check(installer.ModelDownloader(stand_in.url, work_dir / 'x').probe()[2] == digest,
+              "X-Linked-Etag was not used as the SHA-256")
+    finally:
+        stand_in.close()
+
+    stand_in = StandIn(payload, linked_etag='f' * 64)
+    try:
+        dest = work_dir / 'linked.gguf'
+        try:
+            installer.ModelDownloader(stand_in.url, dest, segments=2).download()
+            raise AssertionError("wrong X-Linked-Etag was not rejected")
+        except ValueError:
+            pass
+    finally:
+        stand_in.close()
+
+
+def scenario_interrupt(installer, payload, work_dir):
+    stand_in = StandIn(payload)
+    stand_in.throttle = 0.01
+    try:
+        dest = work_dir / 'interrupt.gguf'
+        downloader = installer.ModelDownloader(stand_in.url, dest, segments=4, chunk_size=4096)
+        timer = threading.Timer(0.5, _thread.interrupt_main)
+        timer.start()
+        started = time.time()
+        try:
+            downloader.download()
+            raise AssertionError("download finished before the interrupt")
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.time() - started
+        check(elapsed < 2, f"Ctrl-C took {elapsed:.1f}s to return")
+        check(sorted(leftovers(dest)) == ['interrupt.gguf.part', 'interrupt.gguf.part.json'],
+              f"no resumable state after Ctrl-C: {leftovers(dest)}")
+
+        # The segments stop at their next chunk
+        stopped = stand_in.bytes_sent
+        time.sleep(0.5)
+        check(stand_in.bytes_sent - stopped <= 4 * 4096 * 2, "segments kept downloading after Ctrl-C")
+        check(downloader.downloaded() < len(payload), "nothing was left to resume")
+
+        stand_in.throttle = 0
+        installer.ModelDownloader(stand_in.url, dest, segments=4).download()
+        check(dest.read_bytes() == payload, "resumed file differs from the payload")
+    finally:
+        stand_in.close()
+
+
+SCENARIOS = [
+    ('parallel', scenario_parallel),
+    ('retry', scenario_retry),
+    ('resume', scenario_resume),
+    ('checksum', scenario_checksum),
+    ('short', scenario_short),
+    ('etag', scenario_etag),
+    ('interrupt', scenario_interrupt),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify ModelDownloader against a local HTTP stand-in")
+    parser.add_argument('--size', type=int, default=3 * 1024 * 1024 + 123, help="payload size in bytes")
+    parser.add_argument('--installer', action='append', type=Path, default=None,
+                        help="installer script to check (default: all of download/)")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    failures = 0
+    for path in args.installer or INSTALLERS:
+        installer = load_installer(path)
+        print(f"📦 {path.name}")
+        for name, scenario in SCENARIOS:
+            with tempfile.TemporaryDirectory() as work_dir:
+                try:
+                    scenario(installer, payload, Path(work_dir))
+                    print(f"   ✅ {name}")
+                except AssertionError as e:
+                    print(f"   ❌ {name}: {e}")
+                    failures += 1
+
+    if failures:
+        sys.exit(1)
+    print("\n✅ All downloader scenarios passed")
+
+
+if __name__ == "__main__":
+    main()
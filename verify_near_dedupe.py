@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+ニア重複除去でどのサンプルが残るかの検証
+
+- create_detailed_categories.remove_near_duplicates: カテゴリの並びや
+  カテゴリ内の並びを入れ替えても、残るサンプルの集合が変わらないこと
+  （ニア重複の組では内容ハッシュの小さい方が残る）
+- near_dedupe.iter_near_unique: 流した順で先に現れたサンプルが残ること
+
+ニア重複の組はカテゴリをまたいで置くため、カテゴリの並び順に
+左右される実装ではこの検証に失敗します。
+"""
+
+import argparse
+import random
+import sys
+
+from create_detailed_categories import remove_near_duplicates, sample_hash
+from jsonl_io import dumps
+from near_dedupe import NearDuplicateDetector, iter_near_unique
+
+CATEGORIES = ['programming_python', 'business_finance', 'health_fitness', 'general_other']
+
+CHARACTERS = 'あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'
+ENDINGS = ['！', '。', '〜', '♪', '！！', 'よ。']
+
+
+def make_pairs(count: int, rng: random.Random):
+    """語尾だけが違うニア重複の組（組どうしは似ていないランダムな文）"""
+    pairs = []
+    for i in range(count):
+        base = ''.join(rng.choice(CHARACTERS) for _ in range(60))
+        first, second = rng.sample(ENDINGS, 2)
+        pairs.append(({'instruction': f"質問{i}", 'input': '', 'output': base + first},
+                      {'instruction': f"質問{i}", 'input': '', 'output': base + second}))
+    return pairs
+
+
+def kept_keys(categorized_data):
+    return sorted(dumps(sample, sort_keys=True) for samples in categorized_data.values() for sample in samples)
+
+
+def check_remove_near_duplicates(pairs, threshold: float, trials: int, rng: random.Random):
+    """カテゴリ・サンプルの並びを入れ替えても残る集合が同じで、内容ハッシュの小さい方が残る"""
+    expected = None
+    for _ in range(trials):
+        categorized_data = {category: [] for category in rng.sample(CATEGORIES, len(CATEGORIES))}
+        for first, second in pairs:
+            a, b = rng.sample(CATEGORIES, 2)
+            categorized_data[a].append(first)
+            categorized_data[b].append(second)
+        for samples in categorized_data.values():
+            rng.shuffle(samples)
+
+        filtered, detector = remove_near_duplicates(categorized_data, threshold)
+        keys = kept_keys(filtered)
+        if detector.duplicates != len(pairs):
+            raise AssertionError(f"ニア重複 {detector.duplicates}件（期待値 {len(pairs)}件）")
+        if expected is None:
+            expected = keys
+            winners = sorted(dumps(min(pair, key=sample_hash), sort_keys=True) for pair in pairs)
+            if keys != winners:
+                raise AssertionError("内容ハッシュの小さい方が残っていない組があります")
+        elif keys != expected:
+            raise AssertionError("並び順を変えると残るサンプルが変わりました")
+
+
+def check_iter_near_unique(pairs, threshold: float):
+    """流した順で先に現れた方が残る（逆順に流せばもう一方が残る）"""
+    for order in ('forward', 'reversed'):
+        stream = [sample for pair in pairs for sample in (pair if order == 'forward' else pair[::-1])]
+        kept = list(iter_near_unique(stream, NearDuplicateDetector(threshold=threshold)))
+        expected = stream[::2]
+        if kept != expected:
+            raise AssertionError(f"{order}: 先に現れたサンプルが残っていません")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ニア重複除去で残るサンプルの検証")
+    parser.add_argument('--pairs', type=int, default=200, help="ニア重複の組の数")
+    parser.add_argument('--trials', type=int, default=10, help="並び順を入れ替える回数")
+    parser.add_argument('--threshold', type=float, default=0.8, help="ニア重複のしきい値")
+    parser.add_argument('--seed', type=int, default=0, help="乱数シード")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pairs = make_pairs(args.pairs, rng)
+
+    failures = 0
+    for name, check in [
+        ('remove_near_duplicates', lambda: check_remove_near_duplicates(pairs, args.threshold, args.trials, rng)),
+        ('iter_near_unique', lambda: check_iter_near_unique(pairs, args.threshold)),
+    ]:
+        try:
+            check()
+            print(f"✅ {name}")
+        except AssertionError as e:
+            print(f"❌ {name}: {e}")
+            failures += 1
+
+    if failures:
+        sys.exit(1)
+    print("\n✅ 全検証成功")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+トーン調整エンジンの差分検証
+
+improve_wisbee_tone のコンパイル済みエンジン（improve_tone /
+adjust_kansai_dialect）が、同じルール表を1つずつ適用する参照実装
+（RewriteEngine.apply_sequential）と同じ結果を返すことをコーパス全体で
+確認します。
+
+ルール同士の連鎖（例: 「だよね〜〜！」→「だよね〜！」→「ですね。」）は
+実データにはほとんど現れないため、ルールの断片をランダムに
+つなげた文字列でも検証します。
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+from improve_wisbee_tone import (
+    TONE_FIXES, TONE_CLEANUPS, KANSAI_ADJUSTMENTS, TONE_ENGINE, KANSAI_ENGINE,
+    improve_tone, adjust_kansai_dialect,
+)
+
+CORPUS_DIRS = [
+    'wisbee_character_improved',
+    'detailed_categorized_wisbee_data/wisbee_character',
+]
+
+def improve_tone_sequential(text):
+    """improve_tone の参照実装（ルールを1つずつ適用してから strip）"""
+    return TONE_ENGINE.apply_sequential(text).strip()
+
+
+PAIRS = [
+    ('improve_tone', improve_tone, improve_tone_sequential),
+    ('adjust_kansai_dialect', adjust_kansai_dialect, KANSAI_ENGINE.apply_sequential),
+]
+
+
+def load_corpus_texts(dirs):
+    """コーパスの各サンプルから instruction / input / output を取り出す"""
+    texts = []
+    for corpus_dir in dirs:
+        for jsonl_file in sorted(Path(corpus_dir).glob('*.jsonl')):
+            with open(jsonl_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    for key in ('instruction', 'input', 'output'):
+                        if isinstance(data.get(key), str) and data[key]:
+                            texts.append(data[key])
+    return texts
+
+
+def fuzz_texts(count, seed=0):
+    """ルールのパターン・置換結果の断片をつなげたランダムな文字列"""
+    fragments = ['〜', '！', '？', '。', ' ', '\n', 'だ', 'よ', 'ね', 'や', 'ん', 'で', 'す', 'ごく',
+                 '✨', '🎵', '💡', 'ちゃう', 'なっ', 'はる', 'し', 'から', 'Wisbee']
+    for table in (TONE_FIXES, KANSAI_ADJUSTMENTS, dict(TONE_CLEANUPS)):
+        for pattern, replacement in table.items():
+            fragments.append(pattern.split('(')[0].rstrip('+\\s*$'))
+            fragments.append(replacement.replace('\\1', ''))
+    fragments = [fragment for fragment in fragments if fragment]
+
+    rng = random.Random(seed)
+    return [''.join(rng.choice(fragments) for _ in range(rng.randint(1, 12))) for _ in range(count)]
+
+
+def verify(texts, label):
+    """各テキストで新旧実装を比較し、不一致の件数を返す"""
+    mismatches = 0
+    for name, compiled, sequential in PAIRS:
+        failed = 0
+        for text in texts:
+            expected = sequential(text)
+            actual = compiled(text)
+            if actual != expected:
+                failed += 1
+                if failed <= 5:
+                    print(f"  ❌ {name}: {text!r}")
+                    print(f"     従来: {expected!r}")
+                    print(f"     新  : {actual!r}")
+        status = "✅" if failed == 0 else "❌"
+        print(f"{status} [{label}] {name}: {len(texts) - failed}/{len(texts)} 一致")
+        mismatches += failed
+    return mismatches
+
+
+def benchmark(texts, repeat=3):
+    """新旧実装の処理時間を比較"""
+    for name, compiled, sequential in PAIRS:
+        timings = {}
+        for label, func in (('従来', sequential), ('新', compiled)):
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for text in texts:
+                    func(text)
+                best = min(best, time.perf_counter() - start)
+            timings[label] = best
+        print(f"⏱️  {name}: 従来 {timings['従来']:.3f}s → 新 {timings['新']:.3f}s "
+              f"({timings['従来'] / timings['新']:.1f}倍)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="トーン調整エンジンの差分検証")
+    parser.add_argument('--fuzz', type=int, default=20000, help="ランダム文字列の件数")
+    parser.add_argument('--benchmark', action='store_true', help="処理時間も比較する")
+    args = parser.parse_args()
+
+    texts = load_corpus_texts(CORPUS_DIRS)
+    print(f"📚 コーパス: {len(texts)}テキスト")
+
+    mismatches = verify(texts, 'コーパス')
+    mismatches += verify(fuzz_texts(args.fuzz), 'ランダム')
+
+    if args.benchmark and texts:
+        benchmark(texts)
+
+    if mismatches:
+        print(f"\n❌ 不一致: {mismatches}件")
+        sys.exit(1)
+    print("\n✅ 全件一致")
+
+
+if __name__ == "__main__":
+    main()